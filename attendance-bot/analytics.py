@@ -0,0 +1,128 @@
+import io
+import numpy as np
+import dbutils
+
+# what each cell of the members x posts matrix holds
+PRESENT = 1
+ABSENT = 0
+NO_REPLY = -1
+NOT_ASKED = -2  # no attendance row, e.g. the member joined later or was ignored
+
+# (member index, post index, code) for every attendance row, streamed as text through COPY
+MATRIX_QUERY = ("COPY (WITH p AS (SELECT post_timestamp, row_number() OVER (ORDER BY post_timestamp) - 1 AS i "
+                "FROM posts WHERE tenant = %s), "
+                "m AS (SELECT slack_id, row_number() OVER (ORDER BY slack_id) - 1 AS j "
+                "FROM members WHERE tenant = %s) "
+                "SELECT m.j, p.i, CASE WHEN a.present THEN 1 WHEN NOT a.present THEN 0 ELSE -1 END "
+                "FROM attendance AS a JOIN m ON m.slack_id = a.slack_id JOIN p ON p.post_timestamp = a.post_timestamp "
+                "WHERE a.tenant = %s) TO STDOUT WITH (DELIMITER ' ')")
+
+
+def load_matrix(db, tenant):
+    with dbutils.checkout(db) as conn:
+        cur = conn.cursor()
+        try:
+            # the three queries must see the same posts and members for the indexes to line up
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cur.execute("SELECT post_timestamp, rehearsal_date FROM posts WHERE tenant = %s ORDER BY post_timestamp",
+                        (tenant,))
+            posts = cur.fetchall()
+            cur.execute("SELECT slack_id, real_name FROM members WHERE tenant = %s ORDER BY slack_id", (tenant,))
+            members = cur.fetchall()
+            buf = io.BytesIO()
+            cur.copy_expert(cur.mogrify(MATRIX_QUERY, (tenant, tenant, tenant)).decode(), buf)
+        finally:
+            conn.rollback()
+    cells = np.fromstring(buf.getvalue().decode(), dtype=np.int32, sep=" ").reshape(-1, 3)
+    codes = np.full((len(members), len(posts)), NOT_ASKED, dtype=np.int8)
+    codes[cells[:, 0], cells[:, 1]] = cells[:, 2]
+    return AttendanceMatrix([m[0] for m in members], [m[1] for m in members], [str(p[0]) for p in posts],
+                            np.array([p[1] for p in posts], dtype="datetime64[D]"), codes)
+
+
+# share of a by b, or nan where b is 0
+def ratio(a, b):
+    return np.divide(a, b, out=np.full(np.shape(a), np.nan), where=np.asarray(b) > 0)
+
+
+class AttendanceMatrix(object):
+    def __init__(self, slack_ids, names, timestamps, dates, codes):
+        self.slack_ids = slack_ids
+        self.names = names
+        self.index = {slack_id: i for i, slack_id in enumerate(slack_ids)}
+        self.timestamps = timestamps
+        self.dates = dates
+        self.codes = codes
+        self.present = codes == PRESENT
+        self.asked = codes >= NO_REPLY
+
+    def member_totals(self):
+        return {"present": self.present.sum(axis=1), "absent": (self.codes == ABSENT).sum(axis=1),
+                "no_reply": (self.codes == NO_REPLY).sum(axis=1), "asked": self.asked.sum(axis=1)}
+
+    def member_rates(self):
+        totals = self.member_totals()
+        return ratio(totals["present"], totals["asked"])
+
+    # (present, asked) for each member (or just those in rows) over each run of `window` posts
+    # ending at every post
+    def rolling(self, window, rows=slice(None)):
+        posts = self.codes.shape[1]
+        start = np.maximum(np.arange(posts) - window + 1, 0)
+
+        def windowed(flags):
+            sums = np.zeros((flags.shape[0], posts + 1), dtype=np.int32)
+            np.cumsum(flags, axis=1, out=sums[:, 1:])
+            return sums[:, 1:] - sums[:, start]
+        return windowed(self.present[rows]), windowed(self.asked[rows])
+
+    def rolling_rates(self, window, rows=slice(None)):
+        present, asked = self.rolling(window, rows)
+        return ratio(present, asked)
+
+    # present and asked counts for every post
+    def turnout(self):
+        return self.present.sum(axis=0), self.asked.sum(axis=0)
+
+    # least squares slope of the number present over the last `window` posts, in people per post
+    def turnout_trend(self, window):
+        present = self.turnout()[0][-window:]
+        if len(present) < 2:
+            return 0.0
+        return float(np.polyfit(np.arange(len(present)), present, 1)[0])
+
+    # members grouped by the year of the first rehearsal they were asked about
+    def cohorts(self, window):
+        joined = self.asked.any(axis=1)
+        first = self.asked.argmax(axis=1)[joined]
+        years = self.dates[first].astype("datetime64[Y]").astype(int) + 1970
+        cohort_years, cohort = np.unique(years, return_inverse=True)
+        recent = self.present[joined][:, -window:].any(axis=1)
+        present = np.bincount(cohort, weights=self.present[joined].sum(axis=1), minlength=len(cohort_years))
+        asked = np.bincount(cohort, weights=self.asked[joined].sum(axis=1), minlength=len(cohort_years))
+        return [{"year": int(year), "members": int(members), "rate": float(rate), "active": int(active)}
+                for year, members, rate, active in zip(cohort_years, np.bincount(cohort), ratio(present, asked),
+                                                       np.bincount(cohort, weights=recent))]
+
+    def member_summary(self, slack_id, window):
+        i = self.index.get(slack_id)
+        if i is None:
+            return None
+        present = self.present[i]
+        asked = self.asked[i]
+        # the rate over the `window` posts before the recent ones, nan if there weren't that many
+        rates = self.rolling_rates(window, [i])[0]
+        previous_rate = rates[-window - 1] if len(rates) > window else np.nan
+        return {"present": int(present.sum()), "asked": int(asked.sum()),
+                "no_reply": int((self.codes[i] == NO_REPLY).sum()),
+                "recent_present": int(present[-window:].sum()), "recent_asked": int(asked[-window:].sum()),
+                "previous_rate": float(previous_rate)}
+
+    def summary(self, window):
+        present, asked = self.turnout()
+        recent_present = self.present[:, -window:].sum()
+        recent_asked = self.asked[:, -window:].sum()
+        return {"recent_rate": float(ratio(recent_present, recent_asked)), "last_date": str(self.dates[-1]),
+                "last_present": int(present[-1]), "last_asked": int(asked[-1]),
+                "trend": self.turnout_trend(window), "cohorts": self.cohorts(window)}
+
@@ -1,25 +1,65 @@
-from flask import Flask
+from flask import Flask, Response, abort, jsonify, request
 from settings import config
 from flask_slack import Slack
-from bot import AttendanceBot
+from bot import AttendanceBot, ENTRY_DUPLICATE, ENTRY_NOT_FOUND, ENTRY_UNCHANGED
+from bus import InvalidationBus
+from jobs import JobRunner, DUPLICATE, BUSY, progress_reporter
+from slackapi import SlackAPIError
+from events import ReactionQueue, verify_signature
+from tenants import TenantRegistry, team_ids
+from export import ExportError, FORMATS, export
+from metrics import registry as metrics
+from outbox import OutboxDispatcher, pending_count
+from commands import Arg, CommandRouter, Invocation, ParseError, DATE, FLAG, LIST, REST
+import dbutils
+import hmac
+import json
+import migrations
 import os
+import threading
 
 app = Flask(__name__)
 slack = Slack(app)
-bot = AttendanceBot(config)
 SLASH_TOKEN = os.environ.get("SLASH_TOKEN")
 TEAM_ID = os.environ.get("SLACK_TEAM_ID")
+# The bot, the tenant registry, the invalidation bus and the scheduler are built on first use
+# by get_tenants(), so importing the app (and so waking a sleeping dyno) connects to nothing.
+bot = None
+tenants = None
+bus = None
+scheduler = None
+init_lock = threading.Lock()
+scheduler_lock = threading.Lock()
+jobs = JobRunner(config["job-workers"], config["job-queue-size"])
+SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET")
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
 HELP_TEXT = ("I am the attendance bot! :robot_face::memo:\n"
              "Type `/attendance` followed by `here` or `absent`, the date as DD/MM/YY, and the name, e.g.:\n"
              "`/attendance here 02/10/17 Beyonce Knowles` \n"
-             "`/attendance absent 02/01/17 Chaka Khan`")
+             "`/attendance absent 02/01/17 Chaka Khan`\n"
+             "For several people at once, separate the names with commas or new lines, e.g.:\n"
+             "`/attendance here 02/10/17 Beyonce Knowles, Kelly Rowland, Michelle Williams`")
 BAD_COMMAND = ("Sorry, I didn't understand that command. :disappointed:"
                "\nType `/attendance help` for instructions.")
 BAD_DATE = ("Sorry, that date doesn't seem to match up with any of our rehearsals. :confused:\n"
             "Please make sure you write it in the format DD/MM/YY and that it's a Monday!\n"
             "Type `/attendance help` for more info.")
+NO_SCHEDULER = "Sorry, scheduled jobs aren't running at the moment. :confused:"
+SLACK_ERROR = "Sorry, Slack isn't cooperating right now. Please try again in a minute. :disappointed:"
 BAD_NAME = "Sorry, I couldn't find anyone with that name. :confused:"
 THANKS = "Thanks! I have updated attendance for {real_name} on {date}. :thumbsup:"
+THANKS_LIST = "Thanks! I have updated attendance on {date} for {count} of {total} names:\n"
+YOU_TYPED = "You typed: `{text}`\n"
+CHECK_NAME = "Please check the name and try again."
+DID_YOU_MEAN = "Sorry, I'm not sure who you mean. Did you mean {}? :thinking_face:"
+PAST_DATE_NEEDED = "Date needed! Type `/attendance past DD/MM/YY` or `/attendance past DD/MM/YY DD/MM/YY`."
+HOLIDAY_DATE_NEEDED = "Date needed! Type `/attendance bankholiday DD/MM/YY`."
+NO_PERMISSION = ":no_entry: Sorry, you don't have permission to do that. :closed_lock_with_key:"
+JOB_STARTED = "On it! I'll post here when I'm done. :hourglass_flowing_sand:"
+JOB_DUPLICATE = "I'm already working on that - hang tight! :hourglass:"
+JOB_BUSY = "I'm a bit busy right now, please try again in a minute. :sweat_smile:"
+BACKFILL_PROGRESS = "Processed {done} of {total} rehearsals so far... :hourglass_flowing_sand:"
 ATTENDANCE_MSG = (":dancing_banana: Rehearsal day! :dancing_banana: <!channel> \n"
                     "{}"
                     "Please indicate whether or not you can attend tonight by reacting to this message with :thumbsup:"
@@ -36,89 +76,354 @@ def hello_world():
 app.add_url_rule('/attendance', view_func=slack.dispatch)
 
 
-@slack.command('attendance', token=SLASH_TOKEN,
-               team_id=TEAM_ID, methods=['POST'])
+def get_tenants():
+    global bot, tenants, bus
+    if tenants is None:
+        with init_lock:
+            if tenants is None:
+                if config.get("bus-enabled") and bus is None:
+                    bus = InvalidationBus(config)
+                    bus.start()
+                bot = AttendanceBot(config, bus=bus)
+                tenants = TenantRegistry(config, bot, TEAM_ID)
+                jobs.db = bot.db
+                if config.get("outbox-enabled"):
+                    outbox.start(bot.db)
+                if config.get("scheduler-enabled"):
+                    threading.Thread(target=start_scheduler, name="scheduler-start", daemon=True).start()
+    return tenants
+
+def get_bot():
+    return get_tenants().default
+
+# Starting the scheduler means importing APScheduler and SQLAlchemy and loading the jobs,
+# which would hold up the first command, so it happens off the request path. Until it has
+# started, bankholiday and resumejobs answer NO_SCHEDULER.
+def start_scheduler():
+    global scheduler
+    registry = get_tenants()
+    with scheduler_lock:
+        if scheduler is None:
+            from scheduler import JobScheduler
+            job_scheduler = JobScheduler(config)
+            job_scheduler.start(registry, ATTENDANCE_MSG.format(""))
+            scheduler = job_scheduler
+
+# build everything on a background thread, so it is usually ready by the first request
+def warm_up():
+    threading.Thread(target=get_tenants, name="warm-up", daemon=True).start()
+
+
+def apply_reaction_events(events):
+    get_tenants().apply_reaction_events(events)
+
+def deliver_outbox(tenant, kind, payload):
+    return get_tenants().get(tenant).deliver(kind, payload)
+
+reactions = ReactionQueue(apply_reaction_events, config["event-batch-size"], config["event-flush-interval"])
+reactions.start()
+
+# started by get_tenants, since it needs the bot's connection pool
+outbox = OutboxDispatcher(deliver_outbox, config)
+
+
+# Events API: reactions are queued and written in small batches so Slack gets its 200 straight away
+@app.route('/events', methods=['POST'])
+def slack_events():
+    body = request.get_data()
+    if not verify_signature(SIGNING_SECRET, request.headers.get('X-Slack-Request-Timestamp'), body,
+                            request.headers.get('X-Slack-Signature')):
+        abort(403)
+    payload = json.loads(body.decode('utf-8'))
+    if payload.get('type') == 'url_verification':
+        return jsonify(challenge=payload.get('challenge'))
+    event = payload.get('event', {})
+    if payload.get('type') == 'event_callback' and event.get('type') in ('reaction_added', 'reaction_removed'):
+        reactions.put(event)
+    return '', 200
+
+
+# Attendance history as CSV or Parquet, streamed with chunked transfer encoding, e.g.
+#   curl -H "Authorization: Bearer $EXPORT_TOKEN" "$URL/export?format=csv&from=01/09/17&to=31/12/17&member=Chaka+Khan"
+@app.route('/export')
+def export_attendance():
+    auth = request.headers.get('Authorization', '')
+    if not EXPORT_TOKEN or not hmac.compare_digest(auth.encode(), "Bearer {}".format(EXPORT_TOKEN).encode()):
+        abort(401)
+    fmt = request.args.get('format', 'csv')
+    tenant = request.args.get('tenant', '')
+    if tenant and tenant not in config["tenants"]:
+        abort(404)
+    try:
+        chunks = export(get_bot().db, get_tenants().settings_for(tenant), fmt, tenant, request.args.get('from'),
+                        request.args.get('to'), request.args.getlist('member'))
+    except ExportError as e:
+        return str(e), 400
+    filename = "attendance.{}".format(fmt)
+    return Response(chunks, mimetype=FORMATS[fmt],
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+# Prometheus text format. Protected by METRICS_TOKEN as a bearer token when that is set.
+@app.route('/metrics')
+def prometheus_metrics():
+    if METRICS_TOKEN:
+        auth = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth.encode(), "Bearer {}".format(METRICS_TOKEN).encode()):
+            abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def collect_gauges():
+    yield "jobs_active", {}, len(jobs.active)
+    yield "reaction_queue_size", {}, reactions.queue.qsize()
+    if tenants is None:
+        return
+    for name, value in bot.db.stats().items():
+        yield "db_pool_" + name, {}, value
+    yield "outbox_pending", {}, pending_count(bot.db)
+    if bus is not None:
+        yield "bus_live", {}, int(bus.is_live())
+    for tenant_bot in tenants.loaded():
+        for key, counts in tenant_bot.cache.stats().items():
+            yield "cache_hits", {"tenant": tenant_bot.tenant, "key": key}, counts["hits"]
+            yield "cache_misses", {"tenant": tenant_bot.tenant, "key": key}, counts["misses"]
+        for name, value in tenant_bot.members.stats().items():
+            yield "members_" + name, {"tenant": tenant_bot.tenant}, value
+
+metrics.add_collector(collect_gauges)
+metrics.describe("jobs_active", "gauge", "Background jobs queued or running")
+metrics.describe("reaction_queue_size", "gauge", "Reaction events waiting to be written")
+metrics.describe("outbox_pending", "gauge", "Queued Slack actions not yet carried out")
+metrics.describe("bus_live", "gauge", "1 while the invalidation listener is connected")
+metrics.describe("cache_hits", "gauge", "Versioned cache hits since startup")
+metrics.describe("cache_misses", "gauge", "Versioned cache misses since startup")
+for name in ("checkouts", "in_use", "reconnects", "wait_time_total", "wait_time_max"):
+    metrics.describe("db_pool_" + name, "gauge", "Connection pool " + name.replace("_", " "))
+metrics.describe("members_size", "gauge", "Members in the member directory")
+metrics.describe("members_ignored", "gauge", "Members left out of the absence report")
+metrics.describe("members_hits", "gauge", "Names matched exactly since startup")
+metrics.describe("members_fuzzy_hits", "gauge", "Names matched fuzzily since startup")
+metrics.describe("members_misses", "gauge", "Names matched to nobody since startup")
+metrics.describe("members_negative_hits", "gauge", "Names already known to match nobody since startup")
+metrics.describe("members_negative_entries", "gauge", "Names remembered as matching nobody")
+metrics.describe("members_resyncs", "gauge", "Member syncs triggered by unknown names since startup")
+
+
 def attendance(**kwargs):
-    input_text = kwargs.get('text')
-    user_id = kwargs.get('user_id')
-    if len(input_text) == 0 or 'help' in input_text:
-        return slack.response(HELP_TEXT)
-    elif 'report' in input_text:
-        return slack.response(bot.create_absence_message())
-    elif 'updatemembers' in input_text:
-        return slack.response(check_admin(user_id, trigger_update))
-    elif 'post' in input_text:
-        return slack.response(check_admin(user_id,post_attendance_message,input_text))
-    elif 'process' in input_text:
-        return slack.response(check_admin(user_id,process_all))
-    elif 'here' in input_text:
-        return slack.response(process_single_attendance(input_text, bot.record_presence))
-    elif 'absent' in input_text:
-        return slack.response(process_single_attendance(input_text, bot.record_absence))
-    elif 'ignore' in input_text:
-        return slack.response(check_admin(user_id, set_ignore, input_text))
-    elif 'past' in input_text:
-        return slack.response(check_admin(user_id, process_date, input_text))
-    else:
-        return slack.response(BAD_COMMAND)
-
-def post_attendance_message(input_text):
-    message_text = ' '.join(input_text.strip().split(' ')[1:]).strip()
+    command, rest = router.resolve(kwargs.get('text', ''))
+    name = command.name if command is not None else 'unknown'
+    with metrics.timed("attendance_command_seconds", command=name):
+        try:
+            return slack.response(run_command(command, rest, kwargs))
+        except SlackAPIError as e:
+            app.logger.error("Slack call failed: %s", e)
+            metrics.inc("attendance_command_errors_total", command=name)
+            return slack.response(SLACK_ERROR)
+
+# the same command serves every workspace that has a tenant
+for team_id in team_ids(config, TEAM_ID):
+    slack.command('attendance', token=SLASH_TOKEN, team_id=team_id, methods=['POST'])(attendance)
+
+# kwargs is the slash command form, which has its own 'command' field
+def run_command(command, rest, kwargs):
+    if command is None:
+        return BAD_COMMAND
+    bot = get_tenants().for_request(kwargs.get('team_id'), kwargs.get('channel_id'))
+    if command.admin:
+        return check_admin(bot, kwargs.get('user_id'), invoke, bot, command, rest, kwargs)
+    return invoke(bot, command, rest, kwargs)
+
+# admins are checked before the arguments are, so nobody else learns how a command is used
+def invoke(bot, command, rest, kwargs):
+    text = kwargs.get('text', '')
+    try:
+        args = command.parse_args(rest, text)
+    except ParseError as e:
+        return str(e)
+    call = Invocation(command, args, text, kwargs.get('user_id'), kwargs.get('response_url'))
+    if command.background:
+        return run_in_background((bot.tenant, command.name), call.response_url, command.handler, bot, call)
+    return command.handler(bot, call)
+
+# run slow commands on the job pool and reply through response_url so Slack's 3 second deadline is never hit
+def run_in_background(key, response_url, func, *args):
+    if not config.get("async-commands") or not response_url:
+        return func(*args)
+    status = jobs.submit(key, response_url, func, *args)
+    if status == DUPLICATE:
+        return JOB_DUPLICATE
+    if status == BUSY:
+        return JOB_BUSY
+    return JOB_STARTED
+
+def check_admin(bot, user_id, func, *args):
+    if bot.is_admin(user_id):
+        return func(*args)
+    return NO_PERMISSION
+
+
+# Every /attendance command, looked up by its first word. Handlers take the tenant's bot and
+# the parsed Invocation and return the reply.
+router = CommandRouter(default='help')
+ATTENDANCE_ARGS = [Arg('date', DATE, missing=YOU_TYPED + BAD_DATE, invalid=YOU_TYPED + BAD_DATE),
+                   Arg('real_names', LIST, missing=YOU_TYPED + BAD_NAME)]
+
+@router.command('help')
+def show_help(bot, call):
+    return HELP_TEXT
+
+@router.command('report')
+def absence_report(bot, call):
+    return bot.create_absence_message()
+
+@router.command('stats', [Arg('real_name', REST, required=False)])
+def attendance_stats(bot, call):
+    real_name = call.args['real_name']
+    if not real_name:
+        return bot.create_stats_message()
+    match = bot.find_member(real_name)
+    if match.slack_id is None:
+        return unknown_name(match, BAD_NAME)
+    return bot.create_member_stats_message(match.slack_id, match.real_name)
+
+@router.command('updatemembers', admin=True, background=True)
+def trigger_update(bot, call):
+    result = bot.update_members()
+    return ("Member database has been updated: {inserted} added, {updated} changed, "
+            "{deleted} removed. :thumbsup:".format(**result))
+
+@router.command('post', [Arg('song', REST, required=False)], admin=True)
+def post_attendance_message(bot, call):
+    message_text = call.args['song'] or ''
     msg = ATTENDANCE_MSG
     if len(message_text) > 2:
         song_info ="Today we'll be doing *{}*.\n".format(message_text)
         msg = ATTENDANCE_MSG.format(song_info)
-    bot.post_message_with_reactions(msg)
+    bot.queue_post(msg)
+    outbox.notify()
     return "OK, posting a message now. :carlton:"
 
-def process_date(input_text):
-    input_list = input_text.strip().split(' ')
-    date = input_list[1]
-    return bot.process_with_date(date)
-
-def process_all():
+@router.command('process', admin=True, background=True)
+def process_all(bot, call):
     return bot.process_attendance()
 
-def check_admin(user_id, func, *args):
-    if bot.is_admin(user_id):
-        return func(*args)
-    return ":no_entry: Sorry, you don't have permission to do that. :closed_lock_with_key:"
-
-def trigger_update():
-    bot.update_members()
-    return "Member database has been updated. :thumbsup:"
-
-
-def set_ignore(input_text):
-    input_list = input_text.strip().split(' ')
-    if 'stop' in input_text:
-        flag = False
-        real_name = ' '.join(input_list[2:]).strip()
-    else:
-        flag = True
-        real_name = ' '.join(input_list[1:]).strip()
-    slack_id = bot.get_slack_id(real_name)
-    if slack_id is None:
-        return "Please check the name and try again."
-    bot.set_ignore(slack_id, flag)
-    return "{} has been set to ignore = {}.".format(real_name, flag)
-
-
-def process_single_attendance(input_text, attendance_func):
-    msg = "You typed: `{}`\n".format(input_text)
-    input_list = input_text.strip().split(' ')
-    date = input_list[1]
-    real_name = ' '.join(input_list[2:]).strip()
+@router.command('here', ATTENDANCE_ARGS)
+def record_presence(bot, call):
+    if len(call.args['real_names']) > 1:
+        return process_attendance_list(bot, call, True)
+    return process_single_attendance(bot, call, True)
+
+@router.command('absent', ATTENDANCE_ARGS)
+def record_absence(bot, call):
+    if len(call.args['real_names']) > 1:
+        return process_attendance_list(bot, call, False)
+    return process_single_attendance(bot, call, False)
+
+# written the same way as a list of one, so the reply is all that differs
+def process_single_attendance(bot, call, present):
+    msg = YOU_TYPED.format(text=call.text)
+    date = call.args['date']
+    ts = bot.get_timestamp(date)
+    if ts is None:
+        return msg + BAD_DATE
+    [(_, match, status)] = bot.record_attendance_by_name(ts, call.args['real_names'][:1], present)
+    if status == ENTRY_NOT_FOUND:
+        return msg + unknown_name(match, BAD_NAME)
+    return msg + THANKS.format(real_name=match.real_name, date=date)
+
+# several names in one command: matched together, written together, and a line for each
+def process_attendance_list(bot, call, present):
+    msg = YOU_TYPED.format(text=call.text)
+    date = call.args['date']
     ts = bot.get_timestamp(date)
     if ts is None:
         return msg + BAD_DATE
-    slack_id = bot.get_slack_id(real_name)
-    if not slack_id:
-        return msg + BAD_NAME
-    attendance_func(slack_id, ts)
-    return msg + THANKS.format(real_name=real_name, date=date)
+    results = bot.record_attendance_by_name(ts, call.args['real_names'], present)
+    lines = []
+    for real_name, match, status in results:
+        if status == ENTRY_NOT_FOUND:
+            suggestions = " or ".join("`{}`".format(name) for _, name in match.candidates)
+            lines.append(":x: {} - {}".format(real_name, "did you mean {}?".format(suggestions) if suggestions
+                                                            else "I couldn't find anyone with that name"))
+        elif status == ENTRY_DUPLICATE:
+            lines.append(":heavy_minus_sign: {} - {} is already on the list".format(real_name, match.real_name))
+        elif status == ENTRY_UNCHANGED:
+            lines.append(":heavy_minus_sign: {} was already marked {}".format(
+                match.real_name, "present" if present else "absent"))
+        else:
+            lines.append(":white_check_mark: {}".format(match.real_name))
+    count = sum(1 for _, _, status in results if status not in (ENTRY_NOT_FOUND, ENTRY_DUPLICATE))
+    return msg + THANKS_LIST.format(date=date, count=count, total=len(results)) + "\n".join(lines)
+
+# offer the closest names, if any, when a typed name didn't match anyone clearly
+def unknown_name(match, message):
+    if not match.candidates:
+        return message
+    return DID_YOU_MEAN.format(" or ".join("`{}`".format(name) for _, name in match.candidates))
+
+# `ignore NAME` leaves someone out of the absence report, `ignore stop NAME` puts them back
+@router.command('ignore', [Arg('stop', FLAG), Arg('real_name', REST, missing=CHECK_NAME)], admin=True)
+def set_ignore(bot, call):
+    flag = not call.args['stop']
+    match = bot.find_member(call.args['real_name'], writing=True)
+    if match.slack_id is None:
+        return unknown_name(match, CHECK_NAME)
+    bot.set_ignore(match.slack_id, flag)
+    return "{} has been set to ignore = {}.".format(match.real_name, flag)
+
+# `past DD/MM/YY` reprocesses one rehearsal, `past DD/MM/YY DD/MM/YY` every rehearsal in between
+@router.command('past', [Arg('start', DATE, missing=PAST_DATE_NEEDED, invalid=BAD_DATE),
+                         Arg('end', DATE, required=False, invalid=BAD_DATE)], admin=True, background=True)
+def process_date(bot, call):
+    start, end = call.args['start'], call.args['end']
+    if end is None:
+        return bot.process_with_date(start)
+    progress = progress_reporter(call.response_url, BACKFILL_PROGRESS) if call.response_url else None
+    result = bot.backfill(start, end, progress)
+    if result is None:
+        return BAD_DATE
+    return result
+
+@router.command('bankholiday', [Arg('date', DATE, missing=HOLIDAY_DATE_NEEDED, invalid=BAD_DATE)], admin=True)
+def pause_jobs(bot, call):
+    date = call.args['date']
+    if not bot.pause_scheduled_jobs(date):
+        return NO_SCHEDULER
+    return "OK, I have been paused until the week after {}. :palm_tree:".format(date)
+
+@router.command('resumejobs', admin=True)
+def resume_jobs(bot, call):
+    if not bot.resume_scheduled_jobs():
+        return NO_SCHEDULER
+    return "OK, scheduled jobs resumed. :thumbsup:"
+
+
+# Let background work finish before the process exits: jobs already accepted still post
+# their replies, queued reactions are written, the outbox batch in hand is sent and the
+# scheduler lock is released.
+def shutdown():
+    jobs.shutdown(wait=True)
+    reactions.stop()
+    outbox.stop()
+    with scheduler_lock:
+        if scheduler is not None:
+            scheduler.shutdown()
+    with init_lock:
+        if bus is not None:
+            bus.stop()
+        if bot is not None:
+            bot.db.close()
 
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    # in production the release phase migrates (see the Procfile); locally, do it on start
+    conn = dbutils.connect_to_db()
+    migrations.migrate(conn)
+    conn.close()
+    warm_up()
+    try:
+        app.run(host='0.0.0.0', port=port)
+    finally:
+        shutdown()
@@ -1,87 +1,192 @@
 from slackclient import SlackClient
+import logging
+import math
 import os
+import time
 import dbutils
+import migrations
+import outbox
+import slackapi
+from analytics import load_matrix
+from bus import DATA, MEMBERS, POSTS
+from cache import VersionedCache
+from members import MemberDirectory
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
 
+RECORD_ATTENDANCE_QUERY = ("UPDATE attendance AS a SET present = v.present "
+                           "FROM (VALUES %s) AS v(tenant, slack_id, post_timestamp, present) "
+                           "WHERE a.tenant = v.tenant AND a.slack_id = v.slack_id "
+                           "AND a.post_timestamp = v.post_timestamp::numeric "
+                           "AND a.present IS DISTINCT FROM v.present")
+
+# Every write also bumps its tenant's row here, in the same transaction. Anything worked out
+# from the data (reports, the stats matrix) is cached against this version, in every process.
+BUMP_DATA_VERSION = ("INSERT INTO data_versions(tenant, version) VALUES(%s, 1) "
+                     "ON CONFLICT (tenant) DO UPDATE SET version = data_versions.version + 1, updated_at = now()")
+
+RECORD_POST_QUERY = ("INSERT INTO posts(post_timestamp, rehearsal_date, channel_id, tenant) "
+                     "VALUES(%s, %s, %s, %s) ON CONFLICT DO NOTHING")
+
+# what happened to each name given to record_attendance_by_name
+ENTRY_RECORDED = "recorded"
+ENTRY_UNCHANGED = "unchanged"  # it was already recorded that way
+ENTRY_DUPLICATE = "duplicate"  # an earlier name in the list matched the same member
+ENTRY_NOT_FOUND = "not found"
+
+
+# a rate from the attendance matrix, which is nan when nobody was asked
+def percent(rate):
+    return "n/a" if math.isnan(rate) else "{:.0%}".format(rate)
+
+
+# One bot per tenant. The default tenant '' is configured through the environment; other
+# tenants come from settings["tenants"] and override it (see tenants.py).
 class AttendanceBot(object):
-    def __init__(self, settings):
+    def __init__(self, settings, tenant="", db=None, bus=None):
         self.settings = settings
-        token = os.environ.get("BOT_TOKEN")
+        self.tenant = tenant
+        token = os.environ.get(settings.get("token-env", "BOT_TOKEN"))
 
-        self.bot_name = os.environ.get("BOT_NAME")
-        self.bot_emoji = ":{emoji}:".format(emoji=os.environ.get("BOT_EMOJI"))  # wrap emoji name in colons
-        self.client = SlackClient(token)
-        self.channel = os.environ.get("CHANNEL")
-        self.emoji_present = os.environ.get("EMOJI_PRESENT")
-        self.emoji_absent = os.environ.get("EMOJI_ABSENT")
+        self.bot_name = settings.get("bot-name") or os.environ.get("BOT_NAME")
+        emoji = settings.get("bot-emoji") or os.environ.get("BOT_EMOJI")
+        self.bot_emoji = ":{emoji}:".format(emoji=emoji)  # wrap emoji name in colons
+        # SLACK_API_URL points the bot at another Slack API root, e.g. a local fake for testing
+        api_url = os.environ.get("SLACK_API_URL")
+        self.client = slackapi.HTTPClient(token, api_url) if api_url else SlackClient(token)
+        self.slack = slackapi.SlackAPI(self.client, settings)
+        self.channel = settings.get("channel") or os.environ.get("CHANNEL")
+        self.emoji_present = settings.get("emoji-present") or os.environ.get("EMOJI_PRESENT")
+        self.emoji_absent = settings.get("emoji-absent") or os.environ.get("EMOJI_ABSENT")
 
-        self.db = dbutils.connect_to_db()
-        self.create_tables()
+        self.scheduler = None
+        self.members = MemberDirectory(settings["member-cache-ttl"], settings["member-negative-ttl"],
+                                       settings["member-resync-interval"])
+        # Tenants share the default bot's pool. Nothing connects until the first query, and the
+        # schema is left alone: run `cli.py migrate` (the Procfile's release phase) beforehand.
+        self.db = db if db is not None else dbutils.create_pool(settings)
+        self.cache = VersionedCache()
+        # Without an InvalidationBus, posts and members are read from Postgres every time (members
+        # at most every member-cache-ttl) and the data version is checked on every cached read.
+        self.bus = bus
 
     def create_tables(self):
-        cur = self.db.cursor()
-
-        members_query = ("CREATE TABLE IF NOT EXISTS members"
-                         "(slack_id varchar(255) PRIMARY KEY, "
-                         "real_name varchar(255) NOT NULL,"
-                         "ignore boolean)")
-        posts_query = ("CREATE TABLE IF NOT EXISTS posts"
-                       "(post_timestamp varchar(255) PRIMARY KEY, "
-                       "rehearsal_date varchar(255) UNIQUE NOT NULL, "
-                       "channel_id varchar(255) NOT NULL)")
-        attendance_query = ("CREATE TABLE IF NOT EXISTS attendance"
-                            "(slack_id varchar(255) REFERENCES members(slack_id) ON DELETE CASCADE, "
-                            "post_timestamp varchar(255) REFERENCES posts(post_timestamp), "
-                            "present boolean, "
-                            "PRIMARY KEY (slack_id, post_timestamp))")
-
-        cur.execute(members_query)
-        cur.execute(posts_query)
-        cur.execute(attendance_query)
-        dbutils.commit_or_rollback(self.db)
+        migrations.migrate(self.db)
 
+    # stream users.list a page at a time
+    def fetch_members(self):
+        cursor = None
+        while True:
+            kwargs = {"limit": self.settings["member-page-size"]}
+            if cursor:
+                kwargs["cursor"] = cursor
+            res = self.slack.call("users.list", **kwargs)
+            for member in res["members"]:
+                yield member
+            cursor = res.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+    # sync the members table with Slack, writing only the rows that changed
     def update_members(self):
-        res = self.client.api_call("users.list")
-        members = res["members"]
-        cur = self.db.cursor()
-        current_member_data = []
+        start = time.monotonic()
+        # a directory that is current now stays current with the rows below applied to it
+        seen = None if self.members_stale() else self.cache_version(MEMBERS)
+        rows = dbutils.execute_fetchall(self.db, "SELECT slack_id, real_name, is_admin FROM members WHERE tenant = %s",
+                                        (self.tenant,)) or []
+        stored = {slack_id: (real_name, bool(is_admin)) for slack_id, real_name, is_admin in rows}
+        new_members = []
+        changed_members = []
         ids_for_deletion = []
-        for member in members:
-            if not member["deleted"]:
-                slack_id = member["id"]
-                real_name = member["real_name"]
-                current_member_data.append({"id": slack_id, "realname": real_name})
-            else:
-                ids_for_deletion.append((member["id"],))
+        for member in self.fetch_members():
+            slack_id = member["id"]
+            if member["deleted"]:
+                if slack_id in stored:
+                    ids_for_deletion.append(slack_id)
+                continue
+            data = (member.get("real_name") or member.get("name"), bool(member.get("is_admin", False)))
+            if slack_id not in stored:
+                new_members.append((slack_id,) + data)
+            elif stored[slack_id] != data:
+                changed_members.append((slack_id,) + data)
 
-        insertion_query = ("INSERT INTO members VALUES(%(id)s, %(realname)s, FALSE) "
-                           "ON CONFLICT (slack_id) DO UPDATE "
-                           "SET real_name = %(realname)s "
-                           "WHERE members.slack_id = %(id)s")
-        cur.executemany(insertion_query, current_member_data)
-        cur.executemany("DELETE FROM members WHERE slack_id = (%s)", ids_for_deletion)
-        dbutils.commit_or_rollback(self.db)
+        insertion_query = ("INSERT INTO members(tenant, slack_id, real_name, ignore, is_admin) VALUES %s "
+                           "ON CONFLICT (tenant, slack_id) DO UPDATE "
+                           "SET real_name = EXCLUDED.real_name, is_admin = EXCLUDED.is_admin")
+        update_query = ("UPDATE members AS m SET real_name = v.real_name, is_admin = v.is_admin "
+                        "FROM (VALUES %s) AS v(tenant, slack_id, real_name, is_admin) "
+                        "WHERE m.tenant = v.tenant AND m.slack_id = v.slack_id")
+        if new_members or changed_members or ids_for_deletion:
+            with dbutils.transaction(self.db) as cur:
+                if new_members:
+                    dbutils.execute_values(cur, insertion_query, [(self.tenant,) + row for row in new_members],
+                                           "(%s, %s, %s, FALSE, %s)")
+                if changed_members:
+                    dbutils.execute_values(cur, update_query, [(self.tenant,) + row for row in changed_members])
+                if ids_for_deletion:
+                    cur.execute("DELETE FROM members WHERE tenant = %s AND slack_id = ANY(%s)",
+                                (self.tenant, ids_for_deletion))
+                cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+                # before the commit, so the notification it sends can't arrive first
+                generation = self.bus.own_write(self.tenant, MEMBERS, seen) if self.bus is not None else None
+            self.changed(DATA)
+            self.members.remove(ids_for_deletion)
+            self.members.update(new_members + changed_members, generation)
+
+        result = {"inserted": len(new_members), "updated": len(changed_members), "deleted": len(ids_for_deletion),
+                  "duration": time.monotonic() - start}
+        logger.info("Member sync: %(inserted)d inserted, %(updated)d updated, %(deleted)d deleted "
+                    "in %(duration).2fs", result)
+        return result
 
     def update_attendance_table(self, timestamp):
-        query = ("INSERT INTO attendance(slack_id, post_timestamp)"
-                 "SELECT slack_id, (%s) FROM Members WHERE ignore = FALSE ON CONFLICT DO NOTHING")
-        cur = self.db.cursor()
-        cur.execute(query, (timestamp,))
-        dbutils.commit_or_rollback(self.db)
+        query = ("INSERT INTO attendance(tenant, slack_id, post_timestamp)"
+                 "SELECT tenant, slack_id, (%s)::numeric FROM Members WHERE tenant = %s AND ignore = FALSE "
+                 "ON CONFLICT DO NOTHING")
+        self.execute_write(query, (timestamp, self.tenant))
 
-    # post a message and return the timestamp of the message
-    def post_message(self, message):
-        res = self.client.api_call(
+    # run a write and bump the tenant's data version in the same transaction
+    def execute_write(self, query, args):
+        dbutils.execute_and_commit(self.db, query + "; " + BUMP_DATA_VERSION, tuple(args) + (self.tenant,))
+        self.changed(DATA)
+
+    def data_version(self):
+        result = dbutils.execute_fetchone(self.db, "SELECT version FROM data_versions WHERE tenant = %s",
+                                          (self.tenant,))
+        return result[0] if result is not None else 0
+
+    # Invalidate this process's copies of what a committed write changed straight away. Other
+    # processes hear about it from the tables' triggers.
+    def changed(self, *topics):
+        if self.bus is not None:
+            self.bus.invalidate(self.tenant, *topics)
+
+    # what values worked out from topic's tables are cached against: the bus's count of
+    # changes to them, or None if there is no bus listening
+    def cache_version(self, topic):
+        return self.bus.generation(self.tenant, topic) if self.bus is not None else None
+
+    # compute() if the bus can't say when its result goes out of date, otherwise the cached result
+    def cached(self, key, topic, compute):
+        version = self.cache_version(topic)
+        if version is None:
+            return compute()
+        return self.cache.get(key, version, compute)
+
+    # send a message to the channel without recording it as a rehearsal post
+    def send_message(self, message):
+        return self.slack.call(
             "chat.postMessage", channel=self.channel, text=message,
             username=self.bot_name, icon_emoji=self.bot_emoji
         )
-        ts = res.get("ts")
-        channel_id = res.get("channel")
 
-        post_date = datetime.fromtimestamp(float(ts)).strftime("%d/%m/%y")
-        self.db.cursor().execute("INSERT INTO posts VALUES(%s, %s, %s) ON CONFLICT DO NOTHING", (ts, post_date, channel_id))
-        dbutils.commit_or_rollback(self.db)
+    # post a message and return the timestamp of the message
+    def post_message(self, message):
+        ts, channel_id = self.posted(self.send_message(message))
+        self.execute_write(RECORD_POST_QUERY, (ts, datetime.fromtimestamp(float(ts)).date(), channel_id,
+                                               self.tenant))
+        self.changed(POSTS)
         return [ts, channel_id]
 
     # post a message, react to it, and return the timestamp of the message
@@ -90,46 +195,150 @@ class AttendanceBot(object):
         ts = post_data[0]
         channel = post_data[1]
 
-        print(self.client.api_call(
-            "reactions.add", channel=channel, timestamp=ts, name=self.emoji_present
-        ))
-
-        self.client.api_call(
-            "reactions.add", channel=channel, timestamp=ts, name=self.emoji_absent
-        )
+        self.slack.call_many([
+            ("reactions.add", {"channel": channel, "timestamp": ts, "name": self.emoji_present}),
+            ("reactions.add", {"channel": channel, "timestamp": ts, "name": self.emoji_absent}),
+        ])
         return ts
 
+    # the timestamp and channel of a chat.postMessage result
+    def posted(self, res):
+        if not res.get("ts") or not res.get("channel"):
+            raise slackapi.SlackAPIError("chat.postMessage", "no_ts")
+        return res["ts"], res["channel"]
+
+    # Queue the attendance message, with its reactions, to be posted by the outbox rather than
+    # while the caller waits. With a dedupe_key, it is only ever queued once. Returns whether
+    # it was queued.
+    def queue_post(self, message, dedupe_key=None):
+        with dbutils.transaction(self.db) as cur:
+            payload = {"text": message, "reactions": [self.emoji_present, self.emoji_absent]}
+            return outbox.enqueue(cur, self.tenant, "post", payload, dedupe_key) is not None
+
+    # queue a message that isn't a rehearsal post, such as the absence report
+    def queue_message(self, message):
+        with dbutils.transaction(self.db) as cur:
+            outbox.enqueue(cur, self.tenant, "message", {"text": message})
+
+    # Carry out one of this tenant's queued actions for the outbox dispatcher. A post is
+    # recorded, and its reactions queued, in the transaction that marks it sent.
+    def deliver(self, kind, payload):
+        if kind == "react":
+            try:
+                self.slack.call("reactions.add", channel=payload["channel"], timestamp=payload["timestamp"],
+                                name=payload["name"])
+            except slackapi.SlackAPIError as e:
+                # a retry after the first attempt went through but wasn't recorded
+                if e.error != "already_reacted":
+                    raise
+            return None
+        res = self.send_message(payload["text"])
+        if kind != "post":
+            return None
+        ts, channel_id = self.posted(res)
+
+        def record(cur):
+            cur.execute(RECORD_POST_QUERY, (ts, datetime.fromtimestamp(float(ts)).date(), channel_id, self.tenant))
+            cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+            for name in payload.get("reactions", ()):
+                outbox.enqueue(cur, self.tenant, "react", {"channel": channel_id, "timestamp": ts, "name": name})
+        return record
+
     def get_latest_post_data(self):
-        query = "SELECT post_timestamp, channel_id FROM posts ORDER BY post_timestamp DESC LIMIT 1"
-        result = dbutils.execute_fetchone(self.db, query)
+        if self.cache_version(POSTS) is not None:
+            return self.post_index()["latest"]
+        query = "SELECT post_timestamp, channel_id FROM posts WHERE tenant = %s ORDER BY post_timestamp DESC LIMIT 1"
+        result = dbutils.execute_fetchone(self.db, query, (self.tenant,))
         if result is None:
             return result
-        ts = result[0]
+        ts = str(result[0])
         channel_id = result[1]
         return {"ts": ts, "channel_id": channel_id}
 
+    # Every post by rehearsal date, and the latest, while the bus keeps them current. There is
+    # one post a week, so even years of them are small.
+    def post_index(self):
+        return self.cached("posts", POSTS, self.load_post_index)
+
+    def load_post_index(self):
+        rows = dbutils.execute_fetchall(self.db, "SELECT rehearsal_date, post_timestamp, channel_id FROM posts "
+                                                 "WHERE tenant = %s ORDER BY post_timestamp", (self.tenant,)) or []
+        by_date = {}
+        for rehearsal_date, ts, channel_id in rows:
+            by_date[rehearsal_date] = {"ts": str(ts), "channel_id": channel_id}
+        latest = {"ts": str(rows[-1][1]), "channel_id": rows[-1][2]} if rows else None
+        return {"by_date": by_date, "latest": latest}
+
     def get_reactions(self, ts, channel):
-        res = self.client.api_call(
+        res = self.slack.call(
             "reactions.get", channel=channel, timestamp=ts
         )
         return res.get("message").get("reactions")
 
+    def load_member_directory(self):
+        version = self.cache_version(MEMBERS)
+        rows = dbutils.execute_fetchall(self.db, "SELECT slack_id, real_name, is_admin, ignore FROM members "
+                                                 "WHERE tenant = %s", (self.tenant,))
+        if rows is not None:
+            self.members.load([row[:3] for row in rows], [row[0] for row in rows if row[3]], version)
+
+    # while the bus is listening, the directory is current until the members table changes
+    def members_stale(self):
+        return self.members.is_stale(self.cache_version(MEMBERS))
+
     def get_slack_id(self, real_name):
-        query = "SELECT slack_id FROM members WHERE real_name = (%s)"
-        result = dbutils.execute_fetchone(self.db, query, (real_name,))
-        if result is None:
-            self.update_members()
-            result = dbutils.execute_fetchone(self.db, query, (real_name,))
-            if result is None:
-                return result
-        return result[0]
+        return self.find_member(real_name).slack_id
 
-    def get_timestamp(self, date):
-        query = "SELECT post_timestamp FROM posts WHERE rehearsal_date = (%s)"
-        result = dbutils.execute_fetchone(self.db, query, (date,))
+    # A NameMatch for what someone typed: exact names first, then close ones.
+    def find_member(self, real_name, writing=False):
+        return self.find_members([real_name], writing)[real_name]
+
+    # NameMatches for several typed names. Only names nobody matches clearly are worth a
+    # members sync, and one sync covers all of them. When writing, a guessed match could be
+    # someone who joined since the last sync, so guesses are checked with a sync too; if one
+    # isn't allowed yet, they come back as suggestions instead.
+    def find_members(self, real_names, writing=False):
+        if self.members_stale():
+            self.load_member_directory()
+        matches = {real_name: self.members.match(real_name) for real_name in real_names}
+        unmatched = [real_name for real_name, match in matches.items()
+                     if match.slack_id is None and not self.members.is_known_missing(real_name)]
+        guessed = [real_name for real_name, match in matches.items()
+                   if writing and match.slack_id is not None and not match.exact]
+        if not (unmatched or guessed) or not self.members.claim_resync():
+            for real_name in guessed:
+                matches[real_name] = matches[real_name].as_suggestion()
+            return matches
+        self.update_members()
+        for real_name in unmatched + guessed:
+            matches[real_name] = self.members.match(real_name)
+        for real_name in unmatched:
+            if matches[real_name].slack_id is None:
+                self.members.remember_missing(real_name)
+        return matches
+
+    def suggest_members(self, real_name):
+        return self.members.suggest(real_name)
+
+    # date is DD/MM/YY, as typed by users
+    def get_post_data(self, date):
+        try:
+            rehearsal_date = datetime.strptime(date, "%d/%m/%y").date()
+        except ValueError:
+            return None
+        if self.cache_version(POSTS) is not None:
+            return self.post_index()["by_date"].get(rehearsal_date)
+        query = "SELECT post_timestamp, channel_id FROM posts WHERE tenant = %s AND rehearsal_date = (%s)"
+        result = dbutils.execute_fetchone(self.db, query, (self.tenant, rehearsal_date))
         if result is None:
             return result
-        return result[0]
+        return {"ts": str(result[0]), "channel_id": result[1]}
+
+    def get_timestamp(self, date):
+        post_data = self.get_post_data(date)
+        if post_data is None:
+            return None
+        return post_data.get("ts")
 
     def record_presence(self, slack_id, timestamp):
         self.record_attendance(slack_id, timestamp, True)
@@ -138,31 +347,210 @@ class AttendanceBot(object):
         self.record_attendance(slack_id, timestamp, False)
 
     def record_attendance(self, slack_id, timestamp, present):
-        query = "UPDATE attendance SET present=(%s) WHERE slack_id=(%s) AND post_timestamp=(%s)"
-        dbutils.execute_and_commit(self.db, query, [present, slack_id, timestamp])
+        query = "UPDATE attendance SET present=(%s) WHERE tenant=(%s) AND slack_id=(%s) AND post_timestamp=(%s)"
+        self.execute_write(query, [present, self.tenant, slack_id, timestamp])
+        self.refresh_member_stats([slack_id])
 
-    def process_with_ts(self, ts, channel_id):
-        self.update_attendance_table(ts)
-        reactions = self.get_reactions(ts, channel_id)
+    # record attendance for many members at once; attendance maps slack_id -> present
+    def record_attendance_bulk(self, timestamp, attendance):
+        if len(attendance) == 0:
+            return
+        values = [(self.tenant, slack_id, timestamp, present) for slack_id, present in attendance.items()]
+        with dbutils.transaction(self.db) as cur:
+            dbutils.execute_values(cur, RECORD_ATTENDANCE_QUERY, values)
+            cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+        self.changed(DATA)
+
+    # Manual entries for a list of typed names, matched together and written in one
+    # transaction. Returns (real_name, NameMatch, status) for each name, in the order given;
+    # status is one of the ENTRY_ constants above.
+    def record_attendance_by_name(self, timestamp, real_names, present):
+        matches = self.find_members(real_names, writing=True)
+        results, attendance = [], {}
+        for real_name in real_names:
+            match = matches[real_name]
+            if match.slack_id is None:
+                status = ENTRY_NOT_FOUND
+            elif match.slack_id in attendance:
+                status = ENTRY_DUPLICATE
+            else:
+                attendance[match.slack_id] = present
+                status = ENTRY_RECORDED
+            results.append((real_name, match, status))
+        changed, found = self.record_manual_attendance(timestamp, attendance)
+        return [(real_name, match, self.entry_status(status, match.slack_id, changed, found))
+                for real_name, match, status in results]
+
+    # a member matched since the directory was loaded may have been deleted, and then nothing is written
+    @staticmethod
+    def entry_status(status, slack_id, changed, found):
+        if status != ENTRY_RECORDED or slack_id in changed:
+            return status
+        return ENTRY_UNCHANGED if slack_id in found else ENTRY_NOT_FOUND
+
+    # Unlike reactions, manual entries also count for members who joined after the post.
+    # Returns the slack_ids whose attendance changed, and those who have attendance for the
+    # post at all, which leaves out anyone no longer in members.
+    def record_manual_attendance(self, timestamp, attendance):
+        if not attendance:
+            return set(), set()
+        values = [(self.tenant, slack_id, timestamp, present) for slack_id, present in attendance.items()]
+        with dbutils.transaction(self.db) as cur:
+            cur.execute("INSERT INTO attendance(tenant, slack_id, post_timestamp) "
+                        "SELECT tenant, slack_id, %s::numeric FROM members WHERE tenant = %s AND slack_id = ANY(%s) "
+                        "ON CONFLICT DO NOTHING", (timestamp, self.tenant, list(attendance)))
+            dbutils.execute_values(cur, RECORD_ATTENDANCE_QUERY + " RETURNING a.slack_id", values)
+            changed = {row[0] for row in cur.fetchall()}
+            cur.execute("SELECT slack_id FROM attendance WHERE tenant = %s AND post_timestamp = %s::numeric "
+                        "AND slack_id = ANY(%s)", (self.tenant, timestamp, list(attendance)))
+            found = {row[0] for row in cur.fetchall()}
+            cur.execute(*self.member_stats_query(list(attendance)))
+            cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+        self.changed(DATA)
+        return changed, found
+
+    # Record attendance for several posts in one transaction, adding rows for members who have
+    # none yet. attendance_by_post maps post timestamp -> {slack_id: present}.
+    def record_attendance_for_posts(self, attendance_by_post):
+        if not attendance_by_post:
+            return
+        values = [(self.tenant, slack_id, ts, present)
+                  for ts, attendance in attendance_by_post.items() for slack_id, present in attendance.items()]
+        with dbutils.transaction(self.db) as cur:
+            cur.execute("INSERT INTO attendance(tenant, slack_id, post_timestamp) "
+                        "SELECT m.tenant, m.slack_id, p.post_timestamp FROM members AS m "
+                        "JOIN posts AS p ON p.tenant = m.tenant "
+                        "WHERE m.tenant = %s AND m.ignore = FALSE AND p.post_timestamp = ANY(%s::numeric[]) "
+                        "ON CONFLICT DO NOTHING", (self.tenant, list(attendance_by_post)))
+            if values:
+                dbutils.execute_values(cur, RECORD_ATTENDANCE_QUERY, values)
+            cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+        self.changed(DATA)
+
+    # Apply reaction_added/reaction_removed events from the Events API in one transaction.
+    # Only reactions on messages recorded in posts, by members who aren't ignored, count.
+    def apply_reaction_events(self, events):
+        emoji = {self.emoji_present: True, self.emoji_absent: False}
+        changes = {}
+        for event in events:
+            item = event.get("item", {})
+            if item.get("type") != "message" or event.get("reaction") not in emoji:
+                continue
+            key = (event.get("user"), item.get("ts"))
+            value = emoji[event["reaction"]]
+            # fold each member's events into either "set present to x" or "clear present if it is one of xs"
+            action, arg = changes.get(key, ("clear", frozenset()))
+            if event.get("type") == "reaction_added":
+                changes[key] = ("set", value)
+            elif action == "set":
+                changes[key] = ("set", None if arg == value else arg)
+            else:
+                changes[key] = ("clear", arg | {value})
+
+        sets = [(self.tenant, user, ts, arg) for (user, ts), (action, arg) in changes.items() if action == "set"]
+        clears = [(self.tenant, user, ts, True in arg, False in arg)
+                  for (user, ts), (action, arg) in changes.items() if action == "clear"]
+        set_query = ("INSERT INTO attendance(tenant, slack_id, post_timestamp, present) "
+                     "SELECT m.tenant, m.slack_id, p.post_timestamp, v.present "
+                     "FROM (VALUES %s) AS v(tenant, slack_id, post_timestamp, present) "
+                     "JOIN members AS m ON m.tenant = v.tenant AND m.slack_id = v.slack_id "
+                     "JOIN posts AS p ON p.tenant = v.tenant AND p.post_timestamp = v.post_timestamp::numeric "
+                     "WHERE m.ignore IS NOT TRUE "
+                     "ON CONFLICT (tenant, slack_id, post_timestamp) DO UPDATE SET present = EXCLUDED.present")
+        clear_query = ("UPDATE attendance AS a SET present = NULL "
+                       "FROM (VALUES %s) AS v(tenant, slack_id, post_timestamp, clear_present, clear_absent) "
+                       "WHERE a.tenant = v.tenant AND a.slack_id = v.slack_id "
+                       "AND a.post_timestamp = v.post_timestamp::numeric "
+                       "AND ((a.present AND v.clear_present) OR (NOT a.present AND v.clear_absent))")
+        if not sets and not clears:
+            return
+        with dbutils.transaction(self.db) as cur:
+            if sets:
+                dbutils.execute_values(cur, set_query, sets, "(%s, %s, %s, %s::boolean)")
+            if clears:
+                dbutils.execute_values(cur, clear_query, clears)
+            cur.execute(BUMP_DATA_VERSION, (self.tenant,))
+        self.changed(DATA)
+        self.refresh_member_stats(set(user for user, _ in changes))
+
+    # turn a message's reactions into (attendance, present_count, absent_count)
+    def count_reactions(self, reactions):
         present_count = 0
         absent_count = 0
-        for reaction in reactions:
+        attendance = {}
+        for reaction in reactions or []:
             if reaction.get("name") == self.emoji_present:
                 for user in reaction.get("users"):
                     present_count += 1
-                    self.record_presence(user, ts)
+                    attendance[user] = True
             elif reaction.get("name") == self.emoji_absent:
                 for user in reaction.get("users"):
                     absent_count += 1
-                    self.record_absence(user, ts)
+                    attendance[user] = False
             else:
                 pass
+        return attendance, present_count, absent_count
+
+    def process_with_ts(self, ts, channel_id):
+        self.update_attendance_table(ts)
+        reactions = self.get_reactions(ts, channel_id)
+        attendance, present_count, absent_count = self.count_reactions(reactions)
+        self.record_attendance_bulk(ts, attendance)
+        self.refresh_member_stats()
         return "Attendance processed! There were {} present and {} absences.".format(present_count, absent_count)
 
+    # start and end are dates; returns the posts in between, oldest first
+    def get_posts_between(self, start, end):
+        query = ("SELECT post_timestamp, channel_id FROM posts "
+                 "WHERE tenant = %s AND rehearsal_date BETWEEN %s AND %s ORDER BY post_timestamp")
+        rows = dbutils.execute_fetchall(self.db, query, (self.tenant, start, end)) or []
+        return [{"ts": str(ts), "channel_id": channel_id} for ts, channel_id in rows]
+
+    # Reprocess every post between two DD/MM/YY dates. Reactions for a batch of posts are
+    # fetched concurrently and the batch is written in one transaction; progress(done, total)
+    # is called after each batch. Returns None if a date doesn't parse.
+    def backfill(self, start, end, progress=None):
+        try:
+            start_date = datetime.strptime(start, "%d/%m/%y").date()
+            end_date = datetime.strptime(end, "%d/%m/%y").date()
+        except ValueError:
+            return None
+        posts = self.get_posts_between(min(start_date, end_date), max(start_date, end_date))
+        batch_size = self.settings["backfill-batch-size"]
+        present_count = 0
+        absent_count = 0
+        skipped = []
+        for i in range(0, len(posts), batch_size):
+            batch = posts[i:i + batch_size]
+            results = self.slack.call_many([("reactions.get", {"channel": post["channel_id"], "timestamp": post["ts"]})
+                                            for post in batch], return_errors=True)
+            attendance_by_post = {}
+            for post, res in zip(batch, results):
+                if isinstance(res, slackapi.SlackAPIError):
+                    logger.warning("Skipping post %s: %s", post["ts"], res)
+                    skipped.append(post["ts"])
+                    continue
+                attendance, present, absent = self.count_reactions(res.get("message", {}).get("reactions"))
+                attendance_by_post[post["ts"]] = attendance
+                present_count += present
+                absent_count += absent
+            self.record_attendance_for_posts(attendance_by_post)
+            if progress is not None:
+                progress(i + len(batch), len(posts))
+        if not posts:
+            return "Sorry, there were no rehearsal posts between {} and {}. :confused:".format(start, end)
+        self.refresh_member_stats()
+        msg = ("Backfill done! I processed {} rehearsals between {} and {}: {} present and {} absences."
+               .format(len(posts) - len(skipped), start, end, present_count, absent_count))
+        if skipped:
+            msg += " I couldn't read {} of the posts from Slack, so they were skipped.".format(len(skipped))
+        return msg
+
     def process_with_date(self, date):
-        ts = self.get_timestamp(date)
-        channel_id = self.get_latest_post_data().get("channel_id")
-        return self.process_with_ts(ts, channel_id)
+        post_data = self.get_post_data(date)
+        if post_data is None:
+            return "Sorry, there was no rehearsal post on {}. :confused:".format(date)
+        return self.process_with_ts(post_data.get("ts"), post_data.get("channel_id"))
 
     def process_attendance(self):
         self.update_members()
@@ -173,17 +561,52 @@ class AttendanceBot(object):
         channel_id = post_data.get("channel_id")
         return self.process_with_ts(ts, channel_id)
 
+    # Recompute member_stats from attendance, for everyone or just the given members.
+    # absence_streak counts the most recent posts someone hasn't reacted to at all.
+    def refresh_member_stats(self, slack_ids=None):
+        self.execute_write(*self.member_stats_query(slack_ids))
+
+    # the query and arguments refresh_member_stats runs, for writes that refresh the stats in
+    # their own transaction
+    def member_stats_query(self, slack_ids=None):
+        member_filter = ""
+        args = (self.tenant,)
+        if slack_ids is not None:
+            member_filter = "AND a.slack_id = ANY(%s) "
+            args = (self.tenant, list(slack_ids))
+        query = ("WITH history AS ("
+                 "SELECT a.tenant, a.slack_id, a.present, a.post_timestamp, p.rehearsal_date "
+                 "FROM attendance AS a "
+                 "JOIN posts AS p ON p.tenant = a.tenant AND p.post_timestamp = a.post_timestamp "
+                 "WHERE a.tenant = %s " + member_filter +
+                 "), last_reply AS ("
+                 "SELECT slack_id, MAX(post_timestamp) FILTER (WHERE present IS NOT NULL) AS ts "
+                 "FROM history GROUP BY slack_id) "
+                 "INSERT INTO member_stats(tenant, slack_id, absence_streak, last_present_ts, last_present_date, "
+                 "present_total, absent_total, no_reply_total, updated_at) "
+                 "SELECT h.tenant, h.slack_id, "
+                 "COUNT(*) FILTER (WHERE h.present IS NULL AND h.post_timestamp > COALESCE(r.ts, 0)), "
+                 "MAX(h.post_timestamp) FILTER (WHERE h.present), "
+                 "MAX(h.rehearsal_date) FILTER (WHERE h.present), "
+                 "COUNT(*) FILTER (WHERE h.present), "
+                 "COUNT(*) FILTER (WHERE NOT h.present), "
+                 "COUNT(*) FILTER (WHERE h.present IS NULL), "
+                 "now() "
+                 "FROM history AS h JOIN last_reply AS r ON r.slack_id = h.slack_id "
+                 "GROUP BY h.tenant, h.slack_id, r.ts "
+                 "ON CONFLICT (tenant, slack_id) DO UPDATE SET "
+                 "absence_streak = EXCLUDED.absence_streak, last_present_ts = EXCLUDED.last_present_ts, "
+                 "last_present_date = EXCLUDED.last_present_date, present_total = EXCLUDED.present_total, "
+                 "absent_total = EXCLUDED.absent_total, no_reply_total = EXCLUDED.no_reply_total, "
+                 "updated_at = EXCLUDED.updated_at")
+        return query, args
+
     def get_absent_names(self):
-        query = ("SELECT DISTINCT m.real_name "
-                 "FROM (SELECT a.slack_id FROM attendance as a "
-                 "WHERE a.post_timestamp IN "
-                 "(SELECT p.post_timestamp FROM posts AS p "
-                 "ORDER BY p.post_timestamp DESC LIMIT 5) "
-                 "AND a.present IS NULL "
-                 "GROUP BY slack_id "
-                 "HAVING COUNT(slack_id) = 4) "
-                 "AS Q NATURAL JOIN MEMBERS AS M")
-        results = dbutils.execute_fetchall(self.db, query)
+        query = ("SELECT m.real_name FROM member_stats AS s "
+                 "JOIN members AS m ON m.tenant = s.tenant AND m.slack_id = s.slack_id "
+                 "WHERE s.tenant = (%s) AND s.absence_streak >= (%s) AND m.ignore IS NOT TRUE "
+                 "ORDER BY m.real_name")
+        results = dbutils.execute_fetchall(self.db, query, (self.tenant, self.settings["absence-threshold"]))
         names = []
         for result_tuple in results:
             names.append("\n")
@@ -191,17 +614,90 @@ class AttendanceBot(object):
         return names
 
     def set_ignore(self, slack_id, flag):
-        query = "UPDATE members SET ignore = (%s) WHERE SLACK_ID = (%s)"
-        dbutils.execute_and_commit(self.db, query, [flag, slack_id])
+        # only a directory the bus is keeping current can be trusted to say nothing would change
+        version = self.cache_version(MEMBERS)
+        if version is not None and not self.members.is_stale(version) and self.members.is_ignored(slack_id) == flag:
+            return
+        query = "UPDATE members SET ignore = (%s) WHERE tenant = (%s) AND SLACK_ID = (%s)"
+        self.execute_write(query, [flag, self.tenant, slack_id])
+        self.changed(MEMBERS)
+        self.members.set_ignored(slack_id, flag)
 
+    # admin flags come from the last member sync; run update_members to refresh them
     def is_admin(self, slack_id):
-        res = self.client.api_call('users.info', user=slack_id)
-        return res.get("user").get("is_admin")
+        if self.members_stale():
+            self.load_member_directory()
+        is_admin = self.members.is_admin(slack_id)
+        if is_admin is None:
+            # not synced yet, e.g. someone who joined since the last update
+            res = self.slack.call('users.info', user=slack_id)
+            is_admin = bool(res.get("user").get("is_admin"))
+            self.members.set_admin(slack_id, is_admin)
+        return is_admin
+
+    def pause_scheduled_jobs(self, date):
+        if self.scheduler is None:
+            return False
+        return self.scheduler.pause_until(date, self.tenant)
+
+    def resume_scheduled_jobs(self):
+        if self.scheduler is None:
+            return False
+        return self.scheduler.resume(self.tenant)
 
+    # the bus's count of writes if it is listening, saving a round trip; the shared version otherwise
+    def data_cache_version(self):
+        version = self.cache_version(DATA)
+        return version if version is not None else self.data_version()
+
+    # the report only changes when the data does, so it is served from the cache in between
     def create_absence_message(self):
+        return self.cache.get("absence-report", self.data_cache_version(), self.build_absence_message)
+
+    def build_absence_message(self):
         absent_list = self.get_absent_names()
         if len(absent_list) == 0:
-            return "Nobody has been absent 4 weeks in a row! :tada:"
-        msg = ":robot_face: :memo: The following members have been absent for the last 4 rehearsals: "
+            return "Nobody has been absent {} weeks in a row! :tada:".format(self.settings["absence-threshold"])
+        msg = (":robot_face: :memo: The following members have been absent for the last {} rehearsals: "
+               .format(self.settings["absence-threshold"]))
         msg += ''.join(absent_list)
         return msg
+
+    def attendance_matrix(self):
+        return self.cache.get("matrix", self.data_cache_version(), lambda: load_matrix(self.db, self.tenant))
+
+    def create_stats_message(self):
+        matrix = self.attendance_matrix()
+        if not matrix.timestamps:
+            return "There haven't been any rehearsals yet! :shrug:"
+        window = self.settings["stats-window"]
+        summary = matrix.summary(window)
+        trend = summary["trend"]
+        if abs(trend) < 0.5:
+            trend_text = "holding steady"
+        else:
+            trend_text = "{} by about {:.1f} people a week".format("up" if trend > 0 else "down", abs(trend))
+        msg = (":bar_chart: Attendance over the last {} rehearsals was {}.\n"
+               "{} of {} were at the last one ({}), and turnout is {}.\n"
+               .format(window, percent(summary["recent_rate"]), summary["last_present"], summary["last_asked"],
+                       datetime.strptime(summary["last_date"], "%Y-%m-%d").strftime("%d/%m/%y"), trend_text))
+        msg += "By the year people joined:"
+        for cohort in summary["cohorts"]:
+            msg += ("\n{year}: {members} members, {rate:.0%} attendance, {active} came in the last {window} weeks"
+                    .format(window=window, **cohort))
+        return msg
+
+    def create_member_stats_message(self, slack_id, real_name):
+        window = self.settings["stats-window"]
+        summary = self.attendance_matrix().member_summary(slack_id, window)
+        if summary is None or summary["asked"] == 0:
+            return "I don't have any attendance for {} yet. :shrug:".format(real_name)
+        recent = "{} of the last {}".format(summary["recent_present"], summary["recent_asked"])
+        # once there's a window before the recent one, compare the two rolling rates
+        if summary["recent_asked"] and not math.isnan(summary["previous_rate"]):
+            recent += " ({:.0%}, against {:.0%} over the {} before)".format(
+                summary["recent_present"] / summary["recent_asked"], summary["previous_rate"], window)
+        return ("{} has been at {} of {} rehearsals ({:.0%}), and {}. "
+                "They didn't reply {} times. :bar_chart:"
+                .format(real_name, summary["present"], summary["asked"], summary["present"] / summary["asked"],
+                        recent, summary["no_reply"]))
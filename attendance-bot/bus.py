@@ -0,0 +1,128 @@
+import logging
+import os
+import select
+import threading
+import dbutils
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Triggers on these tables (migration 6) send "<tenant>:<table>" on CHANNEL for every
+# committed change, whichever process made it.
+CHANNEL = "attendance_changes"
+POSTS = "posts"
+MEMBERS = "members"
+DATA = "data_versions"  # bumped by every write, so anything worked out from attendance
+
+
+# Per-process invalidation over Postgres LISTEN/NOTIFY. A listener thread holds its own
+# connection and counts the changes to each (tenant, table); values cached against
+# generation() are served from memory until the next change to the tables they come from.
+# generation() is None while the listener isn't connected, since changes could be missed,
+# and callers should go to Postgres then. Every reconnection starts a new epoch, which
+# invalidates anything cached before it.
+class InvalidationBus(object):
+    def __init__(self, settings, connect=dbutils.connect_to_db):
+        self.connect = connect
+        self.ping_interval = settings["bus-ping-interval"]
+        self.reconnect_interval = settings["bus-reconnect-interval"]
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.epoch = 0
+        self.live = False
+        self.conn = None
+        self.listening = threading.Event()
+        self.stopping = threading.Event()
+        # written to by stop() to wake the listener out of select
+        self.wakeup = os.pipe()
+        self.worker = threading.Thread(target=self.run, name="invalidation-bus", daemon=True)
+
+    def start(self):
+        if self.worker.ident is None:
+            self.worker.start()
+
+    def is_live(self):
+        with self.lock:
+            return self.live
+
+    # Something that can be compared with a later call to see whether (tenant, topic) has
+    # changed in between, or None if that can't be known.
+    def generation(self, tenant, topic):
+        with self.lock:
+            if not self.live:
+                return None
+            return self.epoch, self.generations.get((tenant, topic), 0)
+
+    # for this process's own writes, which shouldn't wait for their notification to come back
+    def invalidate(self, tenant, *topics):
+        with self.lock:
+            for topic in topics:
+                key = (tenant, topic)
+                self.generations[key] = self.generations.get(key, 0) + 1
+
+    # For a transaction this process is about to commit, which changes topic's table and so sends
+    # one notification: counts the change now, and returns the generation (tenant, topic) will be
+    # at once that notification arrives, if it is still at `seen`. Otherwise None, since changes
+    # from elsewhere could be mixed in.
+    def own_write(self, tenant, topic, seen):
+        with self.lock:
+            key = (tenant, topic)
+            current = (self.epoch, self.generations.get(key, 0)) if self.live else None
+            self.generations[key] = self.generations.get(key, 0) + 1
+            if seen is None or current != seen:
+                return None
+            return self.epoch, self.generations[key] + 1
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.listen()
+            except Exception:
+                if not self.stopping.is_set():
+                    logger.exception("Lost the invalidation listener, reconnecting in %ss", self.reconnect_interval)
+            self.disconnected()
+            self.stopping.wait(self.reconnect_interval)
+
+    def listen(self):
+        self.conn = self.connect()
+        self.conn.autocommit = True
+        self.conn.cursor().execute("LISTEN " + CHANNEL)
+        with self.lock:
+            self.epoch += 1
+            self.live = True
+        self.listening.set()
+        metrics.inc("bus_connects_total")
+        while not self.stopping.is_set():
+            readable, _, _ = select.select([self.conn, self.wakeup[0]], [], [], self.ping_interval)
+            if not readable:
+                # nothing for a while; make sure the connection is still there
+                self.conn.cursor().execute("SELECT 1")
+            self.conn.poll()
+            while self.conn.notifies:
+                self.received(self.conn.notifies.pop(0).payload)
+
+    def received(self, payload):
+        tenant, _, topic = payload.rpartition(":")
+        self.invalidate(tenant, topic)
+        metrics.inc("bus_notifications_total", topic=topic)
+
+    def disconnected(self):
+        with self.lock:
+            self.live = False
+        self.listening.clear()
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    def stop(self):
+        self.stopping.set()
+        os.write(self.wakeup[1], b"x")
+        if self.worker.is_alive():
+            self.worker.join()
+
+
+metrics.describe("bus_connects_total", "counter", "Times the invalidation listener has (re)connected")
+metrics.describe("bus_notifications_total", "counter", "Change notifications received by the invalidation listener")
@@ -0,0 +1,36 @@
+import threading
+
+
+# Per-process memo of values that are worked out from the database. Each entry remembers the
+# data version it was computed at and is only served while the caller still sees that version,
+# so every process can share one version counter in Postgres and keep its own copies.
+class VersionedCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.counts = {}
+
+    def get(self, key, version, compute):
+        with self.lock:
+            counts = self.counts.setdefault(key, {"hits": 0, "misses": 0})
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                counts["hits"] += 1
+                return entry[1]
+            counts["misses"] += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = (version, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for key, counts in self.counts.items():
+                total = counts["hits"] + counts["misses"]
+                stats[key] = dict(counts, hit_rate=counts["hits"] / total if total else 0.0)
+            return stats
@@ -0,0 +1,92 @@
+# Runs the bot's long jobs from a shell (e.g. a one-off Heroku dyno) instead of Slack:
+#
+#   python attendance-bot/cli.py migrate
+#   python attendance-bot/cli.py backfill 04/09/17 18/12/17 [--tenant altos]
+#   python attendance-bot/cli.py export --format parquet --from 01/09/17 -o autumn.parquet
+import argparse
+import logging
+import sys
+from settings import config
+from bot import AttendanceBot
+from export import ExportError, FORMATS, export
+import migrations
+from tenants import TenantRegistry
+
+
+# brings the schema up to date; the Procfile runs this as the release phase of every deploy
+def migrate(registry, args):
+    applied = migrations.migrate(registry.default.db, args.target)
+    if applied:
+        print("Applied migrations {}".format(", ".join(str(version) for version in applied)))
+    else:
+        print("The schema is up to date")
+    return 0
+
+
+def backfill(registry, args):
+    bot = registry.get(args.tenant)
+
+    def progress(done, total):
+        print("Processed {} of {} rehearsals".format(done, total))
+
+    result = bot.backfill(args.start, args.end, progress)
+    if result is None:
+        print("Dates must be written as DD/MM/YY")
+        return 1
+    print(result)
+    return 0
+
+
+def export_attendance(registry, args):
+    bot = registry.default
+    try:
+        chunks = export(bot.db, registry.settings_for(args.tenant), args.format, args.tenant,
+                        args.start, args.end, args.member)
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+    except ExportError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Attendance bot maintenance commands")
+    commands = parser.add_subparsers(dest="command")
+    migrate_parser = commands.add_parser("migrate", help="apply any database migrations that haven't been")
+    migrate_parser.add_argument("--target", type=int, help="stop after this migration version")
+    migrate_parser.set_defaults(func=migrate)
+    backfill_parser = commands.add_parser("backfill", help="reprocess every rehearsal between two dates")
+    backfill_parser.add_argument("start", help="first date, DD/MM/YY")
+    backfill_parser.add_argument("end", help="last date, DD/MM/YY")
+    backfill_parser.add_argument("--tenant", default="", help="tenant from settings.config, default the environment's")
+    backfill_parser.set_defaults(func=backfill)
+    export_parser = commands.add_parser("export", help="write attendance history as CSV or Parquet")
+    export_parser.add_argument("--format", default="csv", choices=sorted(FORMATS))
+    export_parser.add_argument("--from", dest="start", help="first rehearsal date, DD/MM/YY")
+    export_parser.add_argument("--to", dest="end", help="last rehearsal date, DD/MM/YY")
+    export_parser.add_argument("--member", action="append", help="Slack id or real name, may be repeated")
+    export_parser.add_argument("--tenant", default="", help="tenant from settings.config, default the environment's")
+    export_parser.add_argument("-o", "--output", help="file to write, default stdout")
+    export_parser.set_defaults(func=export_attendance)
+    args = parser.parse_args(argv)
+    if not hasattr(args, "func"):
+        parser.print_help()
+        return 2
+
+    logging.basicConfig(level=logging.INFO)
+    bot = AttendanceBot(config)
+    try:
+        return args.func(TenantRegistry(config, bot), args)
+    finally:
+        bot.slack.shutdown()
+        bot.db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+from datetime import date
+import re
+
+# argument kinds
+DATE = "date"  # one word, a DD/MM/YY date
+WORD = "word"  # one word
+FLAG = "flag"  # the argument's own name, if it is the next word; True or False
+REST = "rest"  # everything left over, as typed, e.g. a name or a song title
+LIST = "list"  # everything left over, split on commas and new lines, e.g. a list of names
+
+DATE_FORMAT = "%d/%m/%y"
+LIST_SEPARATOR = re.compile(r"[,\n]")
+DATE_PATTERN = re.compile(r"(\d{1,2})/(\d{1,2})/(\d\d)$")
+
+
+# raised with the message to show the user
+class ParseError(Exception):
+    pass
+
+
+def split_token(text):
+    parts = text.split(None, 1)
+    if not parts:
+        return "", ""
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+# the same dates strptime accepts for DATE_FORMAT, at a fraction of the cost
+def is_date(token):
+    match = DATE_PATTERN.match(token)
+    if not match:
+        return False
+    day, month, year = (int(part) for part in match.groups())
+    try:
+        date(year + (2000 if year < 69 else 1900), month, day)
+        return True
+    except ValueError:
+        return False
+
+
+# Messages may use {text}, which is replaced with the command as typed
+class Arg(object):
+    def __init__(self, name, kind, required=True, missing=None, invalid=None):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.missing = missing
+        self.invalid = invalid
+
+
+class Command(object):
+    def __init__(self, name, handler, args=(), admin=False, background=False):
+        self.name = name
+        self.handler = handler
+        self.args = tuple(args)
+        self.admin = admin
+        self.background = background
+
+    # Consume the arguments from the text after the command name, in order. Anything after
+    # the last one is ignored.
+    def parse_args(self, rest, text=""):
+        values = {}
+        for arg in self.args:
+            if arg.kind == FLAG:
+                token, tail = split_token(rest)
+                values[arg.name] = token.lower() == arg.name
+                if values[arg.name]:
+                    rest = tail
+                continue
+            if arg.kind == REST:
+                token, rest = rest.strip(), ""
+            elif arg.kind == LIST:
+                token = [item.strip() for item in LIST_SEPARATOR.split(rest) if item.strip()]
+                rest = ""
+            else:
+                token, rest = split_token(rest)
+            if not token:
+                if arg.required:
+                    raise ParseError(arg.missing.format(text=text))
+                values[arg.name] = None
+            elif arg.kind == DATE and not is_date(token):
+                raise ParseError(arg.invalid.format(text=text))
+            else:
+                values[arg.name] = token
+        return values
+
+
+# a parsed command, with what the handler needs to know about the request it came in
+class Invocation(object):
+    def __init__(self, command, args, text="", user_id=None, response_url=None):
+        self.command = command
+        self.args = args
+        self.text = text
+        self.user_id = user_id
+        self.response_url = response_url
+
+
+# Commands are looked up by their first word, so adding one costs nothing per request.
+# Text with no words goes to the default command.
+class CommandRouter(object):
+    def __init__(self, default=None):
+        self.commands = {}
+        self.default = default
+
+    def register(self, name, handler, args=(), admin=False, background=False):
+        if name in self.commands:
+            raise ValueError("{} is already a command".format(name))
+        self.commands[name] = Command(name, handler, args, admin, background)
+
+    def command(self, name, args=(), admin=False, background=False):
+        def decorator(handler):
+            self.register(name, handler, args, admin, background)
+            return handler
+        return decorator
+
+    # the command named by the first word of text and the text after it, or None and the
+    # text if there is no such command
+    def resolve(self, text):
+        name, rest = split_token(text)
+        command = self.commands.get(name.lower() if name else self.default)
+        return command, rest
+
+    def parse(self, text, user_id=None, response_url=None):
+        command, rest = self.resolve(text)
+        if command is None:
+            return None
+        return Invocation(command, command.parse_args(rest, text), text, user_id, response_url)
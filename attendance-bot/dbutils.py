@@ -1,58 +1,266 @@
+from contextlib import contextmanager
 from urllib.parse import urlparse
+import logging
+import re
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import os
+from metrics import registry as metrics
 
-def connect_to_db():
+logger = logging.getLogger(__name__)
+
+# the statement's verb and the first table it names, e.g. "select:members", used to label timings
+QUERY_LABEL = re.compile(r"^\s*(?:(update)\s+(\w+)|(\w+)(?:.*?\b(?:FROM|INTO|TABLE|JOIN)\s+(\w+))?)",
+                         re.IGNORECASE | re.DOTALL)
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+def query_label(query):
+    if isinstance(query, bytes):
+        query = query[:500].decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        return "unknown"
+    match = QUERY_LABEL.match(query[:500])
+    if match is None:
+        return "unknown"
+    verb, table = match.group(1, 2) if match.group(1) else match.group(3, 4)
+    return "{}:{}".format(verb.lower(), table.lower()) if table else verb.lower()
+
+
+# Every cursor times its queries into db_query_seconds, and logs the ones slower than
+# slow_query_ms when that is set (create_pool sets it from the slow-query-ms setting).
+class TimedCursor(psycopg2.extensions.cursor):
+    slow_query_ms = None
+
+    def execute(self, query, vars=None):
+        with self.timed(query):
+            return super(TimedCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with self.timed(query):
+            return super(TimedCursor, self).executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with self.timed(sql):
+            return super(TimedCursor, self).copy_expert(sql, file, size)
+
+    @contextmanager
+    def timed(self, query):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            label = query_label(query)
+            metrics.observe("db_query_seconds", elapsed, query=label)
+            if self.slow_query_ms is not None and elapsed * 1000 >= self.slow_query_ms:
+                metrics.inc("db_slow_queries_total", query=label)
+                text = query.decode("utf-8", "replace") if isinstance(query, bytes) else str(query)
+                logger.warning("Slow query (%.0fms): %s", elapsed * 1000, " ".join(text.split())[:1000])
+
+
+def connection_params():
     url = urlparse(os.environ.get("DATABASE_URL"))
 
-    return psycopg2.connect(
+    return dict(
         database=url.path[1:],
         user=url.username,
         password=url.password,
         host=url.hostname,
-        port=url.port
+        port=url.port,
+        # users type dates as DD/MM/YY, so read ambiguous date strings the same way.
+        # Setting options replaces PGOPTIONS, so anything given there is carried over.
+        options=(os.environ.get("PGOPTIONS", "") + " -c datestyle=ISO,DMY").strip(),
+        cursor_factory=TimedCursor
     )
 
+def connect_to_db():
+    return psycopg2.connect(**connection_params())
+
+def create_pool(settings):
+    TimedCursor.slow_query_ms = settings.get("slow-query-ms")
+    return ConnectionPool(settings["db-pool-min"], settings["db-pool-max"],
+                          settings["db-pool-timeout"], settings["db-pool-ping-after"])
+
+
+class ConnectionPool(object):
+    def __init__(self, minconn, maxconn, timeout, ping_after):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        # opened on first checkout, so creating a pool doesn't hold up startup
+        self._pool = None
+        # psycopg2's pool raises as soon as it is exhausted, so callers queue on this instead
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.checkouts = 0
+        self.in_use = 0
+        self.reconnects = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self.lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn,
+                                                                      **connection_params())
+        return self._pool
+
+    @contextmanager
+    def connection(self):
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout("no database connection available after {}s".format(self.timeout))
+        waited = time.monotonic() - start
+        try:
+            conn = self._checkout()
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    # Every idle connection can die at once (after a database restart, say), so dead ones are
+    # discarded until one answers. The pool holds at most maxconn, so by then it opens a new one.
+    def _checkout(self):
+        for _ in range(self.maxconn + 1):
+            conn = self.pool.getconn()
+            if self.is_healthy(conn):
+                return conn
+            logger.warning("Discarding dead database connection and reconnecting")
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            with self.lock:
+                self.reconnects += 1
+        raise psycopg2.OperationalError("no working database connection after {} tries".format(self.maxconn + 1))
+
+    def _checkin(self, conn, broken):
+        if not broken and not conn.closed:
+            try:
+                # never hand an open or aborted transaction to the next caller
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        close = broken or bool(conn.closed)
+        if close:
+            self.last_used.pop(id(conn), None)
+        else:
+            self.last_used[id(conn)] = time.monotonic()
+        self.pool.putconn(conn, close=close)
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    # connections that have sat idle for a while are pinged before being handed out
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "in_use": self.in_use,
+                "reconnects": self.reconnects,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.max_wait_time,
+            }
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+
+
+# the helpers below accept either a ConnectionPool or a single connection
+@contextmanager
+def checkout(db):
+    if isinstance(db, ConnectionPool):
+        with db.connection() as conn:
+            yield conn
+    else:
+        yield db
+
+# run several statements in one transaction, rolling back if any of them fails
+@contextmanager
+def transaction(db):
+    with checkout(db) as conn:
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 def commit_or_rollback(db):
     try:
         db.commit()
-    except Exception as e:
+    except psycopg2.Error as e:
+        logger.error("Commit failed, rolling back: %s", e)
         db.rollback()
-    finally:
-        pass
 
+# the *_with_cursor helpers take a connection, since the cursor is only usable while it is checked out
 def execute_with_cursor(db, query, *args):
     try:
         cur = db.cursor()
         cur.execute(query, *args)
         return cur
     except psycopg2.Error as e:
+        logger.error("Query failed: %s", e)
+        db.rollback()
         return None
 
-def executemany_with_cursor(db, query, *args):
-    try:
-        cur = db.cursor()
-        cur.executemany(query, *args)
-        return cur
-    except psycopg2.Error as e:
-        return None
+# page_size covers every row so the whole batch goes out as a single statement
+def execute_values(cur, query, values, template=None):
+    psycopg2.extras.execute_values(cur, query, values, template=template, page_size=max(len(values), 1))
 
 def execute_fetchone(db, query, *args):
-    res = execute_with_cursor(db, query, *args)
-    if res is None:
-        return res
-    return res.fetchone()
+    with checkout(db) as conn:
+        res = execute_with_cursor(conn, query, *args)
+        if res is None:
+            return res
+        return res.fetchone()
 
 def execute_fetchall(db, query, *args):
-    res = execute_with_cursor(db, query, *args)
-    if res is None:
-        return res
-    return res.fetchall()
+    with checkout(db) as conn:
+        res = execute_with_cursor(conn, query, *args)
+        if res is None:
+            return res
+        return res.fetchall()
 
 def execute_and_commit(db, query, *args):
-    execute_with_cursor(db, query, *args)
-    commit_or_rollback(db)
-
-def executemany_and_commit(db, query, *args):
-    executemany_with_cursor(db, query, *args)
-    commit_or_rollback(db)
\ No newline at end of file
+    with checkout(db) as conn:
+        if execute_with_cursor(conn, query, *args) is not None:
+            commit_or_rollback(conn)
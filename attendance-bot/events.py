@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# requests older than this are rejected to stop replays
+MAX_REQUEST_AGE = 60 * 5
+
+
+# https://api.slack.com/authentication/verifying-requests-from-slack
+def verify_signature(signing_secret, timestamp, body, signature, now=None):
+    if not signing_secret or not timestamp or not signature:
+        return False
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return False
+    if age > MAX_REQUEST_AGE:
+        return False
+    base = b"v0:" + timestamp.encode() + b":" + body
+    expected = "v0=" + hmac.new(signing_secret.encode(), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+# Collects reaction events and hands them to apply() in batches, either once
+# batch_size events are waiting or flush_interval seconds after the first one arrived.
+class ReactionQueue(object):
+    def __init__(self, apply, batch_size, flush_interval):
+        self.apply = apply
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target=self.run, name="reaction-queue", daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def put(self, event):
+        self.queue.put(event)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.apply_batch(batch)
+
+    # apply whatever is waiting right now, on the calling thread
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.apply_batch(batch)
+
+    def apply_batch(self, batch):
+        try:
+            self.apply(batch)
+        except Exception:
+            logger.exception("Could not apply %d reaction events", len(batch))
+
+    def stop(self):
+        self.stopping.set()
+        if self.worker.is_alive():
+            self.worker.join()
+        self.flush()
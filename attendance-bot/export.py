@@ -0,0 +1,144 @@
+from datetime import datetime
+import csv
+import importlib.util
+import io
+import dbutils
+
+# one row per member per rehearsal post, oldest rehearsal first
+COLUMNS = ("rehearsal_date", "post_timestamp", "channel_id", "slack_id", "real_name", "present")
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+class ExportError(Exception):
+    pass
+
+
+def parse_date(date):
+    try:
+        return datetime.strptime(date, "%d/%m/%y").date()
+    except ValueError:
+        raise ExportError("Dates must be written as DD/MM/YY, not {}".format(date))
+
+
+# start and end are DD/MM/YY strings and members a list of Slack ids or real names; all optional
+def build_query(tenant, start=None, end=None, members=None):
+    clauses = ["a.tenant = %s"]
+    args = [tenant]
+    if start:
+        clauses.append("p.rehearsal_date >= %s")
+        args.append(parse_date(start))
+    if end:
+        clauses.append("p.rehearsal_date <= %s")
+        args.append(parse_date(end))
+    if members:
+        clauses.append("(m.slack_id = ANY(%s) OR m.real_name = ANY(%s))")
+        args.extend([list(members), list(members)])
+    query = ("SELECT p.rehearsal_date, p.post_timestamp, p.channel_id, m.slack_id, m.real_name, a.present "
+             "FROM attendance AS a "
+             "JOIN members AS m ON m.tenant = a.tenant AND m.slack_id = a.slack_id "
+             "JOIN posts AS p ON p.tenant = a.tenant AND p.post_timestamp = a.post_timestamp "
+             "WHERE " + " AND ".join(clauses) + " ORDER BY p.post_timestamp, m.real_name, m.slack_id")
+    return query, args
+
+
+# Rows come from a server-side (named) cursor fetch_size at a time, so memory use stays
+# flat however much history there is. The connection is held until the generator finishes
+# or is closed, e.g. when an HTTP client goes away.
+def iter_rows(db, query, args, fetch_size):
+    with dbutils.checkout(db) as conn:
+        cur = conn.cursor(name="attendance_export")
+        cur.itersize = fetch_size
+        try:
+            cur.execute(query, args)
+            for row in cur:
+                yield row
+        finally:
+            conn.rollback()
+
+
+def iter_csv(rows, chunk_rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_rows == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+# file-like object that pyarrow writes into and we empty after every row group
+class ChunkSink(object):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema():
+    import pyarrow as pa
+    return pa.schema([("rehearsal_date", pa.date32()), ("post_timestamp", pa.string()),
+                      ("channel_id", pa.string()), ("slack_id", pa.string()),
+                      ("real_name", pa.string()), ("present", pa.bool_())])
+
+
+# each chunk of rows becomes a Parquet row group
+def iter_parquet(rows, chunk_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = parquet_schema()
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            writer.write_table(parquet_table(pa, schema, chunk))
+            chunk = []
+            yield sink.drain()
+    if chunk:
+        writer.write_table(parquet_table(pa, schema, chunk))
+    writer.close()
+    yield sink.drain()
+
+
+def parquet_table(pa, schema, rows):
+    columns = list(zip(*rows))
+    columns[1] = [str(ts) for ts in columns[1]]
+    return pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                schema=schema)
+
+
+# Check the arguments straight away and return a generator of bytes in the given format.
+# Parquet needs the optional pyarrow package.
+def export(db, settings, fmt="csv", tenant="", start=None, end=None, members=None):
+    if fmt not in FORMATS:
+        raise ExportError("Unknown export format {}, use one of {}".format(fmt, ", ".join(sorted(FORMATS))))
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ExportError("Parquet export needs pyarrow, install it with `pip install pyarrow`")
+    query, args = build_query(tenant, start, end, members)
+    rows = iter_rows(db, query, args, settings["export-batch-size"])
+    if fmt == "parquet":
+        return iter_parquet(rows, settings["export-batch-size"])
+    return iter_csv(rows, settings["export-batch-size"])
@@ -0,0 +1,41 @@
+# Production server settings, used by the Procfile:
+#   gunicorn --config attendance-bot/gunicorn.conf.py --chdir attendance-bot app:app
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# every top-level name here is read as a gunicorn setting, and "config" is one of them
+import settings
+
+logger = logging.getLogger("gunicorn.error")
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", 5000))
+workers = int(os.environ.get("WEB_CONCURRENCY", settings.config["web-workers"]))
+# threads let a worker keep answering while other requests wait on Slack or the database
+worker_class = "gthread"
+threads = settings.config["web-threads"]
+timeout = settings.config["web-timeout"]
+# on SIGTERM workers stop accepting connections and get this long to finish what they have;
+# Heroku kills the dyno 30 seconds after asking it to stop
+graceful_timeout = settings.config["web-graceful-timeout"]
+# the app's bot, connection pool and threads can't be shared across a fork, so the app must
+# be loaded in each worker rather than in the master
+preload_app = False
+accesslog = "-"
+
+
+# the bot and its connection pool are built in the background, so the worker can take
+# requests straight away; the first ones wait for it if they arrive early
+def post_fork(server, worker):
+    import app
+    app.warm_up()
+    logger.info("Worker %s is building its own bot and connection pool", worker.pid)
+
+
+# runs once the worker has stopped taking requests and the in-flight ones have finished
+def worker_exit(server, worker):
+    import app
+    app.shutdown()
+    logger.info("Worker %s drained background jobs and reactions", worker.pid)
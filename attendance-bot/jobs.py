@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import threading
+import psycopg2
+import requests
+import dbutils
+
+logger = logging.getLogger(__name__)
+
+# pg advisory locks on (JOB_LOCK_SPACE, hash of the job's key) are held while a job runs, so
+# other web processes don't run the same job at the same time
+JOB_LOCK_SPACE = 724165
+LOCK_QUERY = "SELECT pg_try_advisory_lock(%s, hashtext(%s))"
+UNLOCK_QUERY = "SELECT pg_advisory_unlock(%s, hashtext(%s))"
+
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+BUSY = "busy"
+
+JOB_FAILED = "Sorry, something went wrong while I was doing that. :disappointed:"
+JOB_RUNNING_ELSEWHERE = "That's already running, so I've left it to finish. :hourglass:"
+
+
+def post_delayed_response(response_url, text):
+    res = requests.post(response_url, json={"response_type": "ephemeral", "text": text}, timeout=10)
+    res.raise_for_status()
+
+
+# Slack takes at most five replies per response_url, so long jobs report progress at a few
+# evenly spaced points and keep the last reply for their result
+def progress_reporter(response_url, message, updates=3):
+    reported = set()
+
+    def progress(done, total):
+        step = done * (updates + 1) // total
+        if 0 < step <= updates and step not in reported:
+            reported.add(step)
+            try:
+                post_delayed_response(response_url, message.format(done=done, total=total))
+            except requests.RequestException:
+                logger.exception("Could not post progress to Slack")
+    return progress
+
+
+# The lock for each job is taken on a connection from db, the bot's ConnectionPool, which is
+# set once the bot is built; without one, jobs are only deduped within this process.
+class JobRunner(object):
+    def __init__(self, max_workers, max_pending, db=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.db = db
+        self.lock = threading.Lock()
+        self.active = set()
+
+    # run func in the background and post the message it returns to response_url.
+    # Only one job per key can be queued or running at a time.
+    def submit(self, key, response_url, func, *args):
+        with self.lock:
+            if key in self.active:
+                return DUPLICATE
+            if len(self.active) >= self.max_pending:
+                return BUSY
+            self.active.add(key)
+        self.executor.submit(self._run, key, response_url, func, *args)
+        return ACCEPTED
+
+    def is_running(self, key):
+        with self.lock:
+            return key in self.active
+
+    # whether key's lock was free; it is held, on a pooled connection, until the block ends
+    @contextmanager
+    def locked(self, key):
+        if self.db is None:
+            yield True
+            return
+        lock_args = (JOB_LOCK_SPACE, str(key))
+        with dbutils.checkout(self.db) as conn:
+            cur = conn.cursor()
+            cur.execute(LOCK_QUERY, lock_args)
+            acquired = cur.fetchone()[0]
+            conn.commit()
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    try:
+                        cur.execute(UNLOCK_QUERY, lock_args)
+                        conn.commit()
+                    except psycopg2.Error:
+                        # the lock goes with the session, rather than to whoever gets the connection next
+                        logger.exception("Could not release the lock for job %s", key)
+                        conn.close()
+
+    def _run(self, key, response_url, func, *args):
+        try:
+            with self.locked(key) as acquired:
+                result = func(*args) if acquired else JOB_RUNNING_ELSEWHERE
+        except Exception:
+            logger.exception("Job %s failed", key)
+            result = JOB_FAILED
+        finally:
+            with self.lock:
+                self.active.discard(key)
+        try:
+            post_delayed_response(response_url, result)
+        except requests.RequestException:
+            logger.exception("Could not deliver the result of job %s", key)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,165 @@
+from names import NameIndex, NameMatch
+import threading
+import time
+
+
+# In-memory real_name -> slack_id index and admin flags over the members table.
+# Names that could not be found are remembered for negative_ttl seconds so that
+# repeated typos don't each trigger a full users.list sync. Names that aren't exact are
+# matched against a NameIndex of the same members. The directory goes stale after ttl
+# seconds, or, when it was loaded at a generation from the invalidation bus, as soon as
+# the bus has a different one.
+class MemberDirectory(object):
+    def __init__(self, ttl, negative_ttl, resync_interval, clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resync_interval = resync_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.ids_by_name = {}
+            self.names_by_id = {}
+            self.admins = {}
+            self.ignored = set()
+            self.names = NameIndex()
+            self.missing = {}
+            self.loaded_at = None
+            self.generation = None
+            self.last_resync = None
+            self.hits = 0
+            self.fuzzy_hits = 0
+            self.misses = 0
+            self.negative_hits = 0
+            self.resyncs = 0
+
+    def is_stale(self, generation=None):
+        if self.loaded_at is None:
+            return True
+        if generation is not None and self.generation is not None:
+            return generation != self.generation
+        return self.clock() - self.loaded_at >= self.ttl
+
+    # replace the whole index with rows of (slack_id, real_name, is_admin) and the ids of
+    # ignored members
+    def load(self, rows, ignored=(), generation=None):
+        with self.lock:
+            self.ids_by_name = {}
+            self.names_by_id = {}
+            self.admins = {}
+            self.ignored = set(ignored)
+            self.names.clear()
+            self._add(rows)
+            self.loaded_at = self.clock()
+            self.generation = generation
+
+    # apply changed rows of (slack_id, real_name, is_admin) without reloading everything. A
+    # generation says the directory is now current at it.
+    def update(self, rows, generation=None):
+        with self.lock:
+            self._add(rows)
+            if generation is not None:
+                self.generation = generation
+
+    def remove(self, slack_ids):
+        with self.lock:
+            for slack_id in slack_ids:
+                name = self.names_by_id.pop(slack_id, None)
+                self.admins.pop(slack_id, None)
+                self.ignored.discard(slack_id)
+                self.names.remove(slack_id)
+                if name is not None and self.ids_by_name.get(name) == slack_id:
+                    del self.ids_by_name[name]
+
+    def _add(self, rows):
+        for slack_id, real_name, is_admin in rows:
+            old_name = self.names_by_id.get(slack_id)
+            if old_name is not None and old_name != real_name and self.ids_by_name.get(old_name) == slack_id:
+                del self.ids_by_name[old_name]
+            self.ids_by_name[real_name] = slack_id
+            self.names_by_id[slack_id] = real_name
+            self.admins[slack_id] = bool(is_admin)
+            self.names.add(slack_id, real_name)
+            self.missing.pop(real_name, None)
+
+    # the exact name if there is one, otherwise the NameIndex's best guess
+    def match(self, real_name):
+        with self.lock:
+            slack_id = self.ids_by_name.get(real_name)
+            if slack_id is not None:
+                self.hits += 1
+                return NameMatch(slack_id, real_name, exact=True)
+            result = self.names.match(real_name)
+            if result.slack_id is None:
+                self.misses += 1
+            else:
+                self.fuzzy_hits += 1
+            return result
+
+    # names close to real_name, best first, to offer when it doesn't match anyone clearly
+    def suggest(self, real_name, limit=5):
+        with self.lock:
+            return [name for _, name in self.names.match(real_name, limit).candidates]
+
+    # None means the member isn't in the directory yet
+    def is_admin(self, slack_id):
+        with self.lock:
+            return self.admins.get(slack_id)
+
+    def set_admin(self, slack_id, is_admin):
+        with self.lock:
+            self.admins[slack_id] = bool(is_admin)
+
+    # None means the member isn't in the directory yet
+    def is_ignored(self, slack_id):
+        with self.lock:
+            if slack_id not in self.names_by_id:
+                return None
+            return slack_id in self.ignored
+
+    def set_ignored(self, slack_id, ignored):
+        with self.lock:
+            if ignored:
+                self.ignored.add(slack_id)
+            else:
+                self.ignored.discard(slack_id)
+
+    def is_known_missing(self, real_name):
+        with self.lock:
+            expires = self.missing.get(real_name)
+            if expires is None:
+                return False
+            if self.clock() >= expires:
+                del self.missing[real_name]
+                return False
+            self.negative_hits += 1
+            return True
+
+    def remember_missing(self, real_name):
+        with self.lock:
+            self.missing[real_name] = self.clock() + self.negative_ttl
+
+    # resyncs caused by unknown names are limited to one per resync_interval
+    def claim_resync(self):
+        with self.lock:
+            now = self.clock()
+            if self.last_resync is not None and now - self.last_resync < self.resync_interval:
+                return False
+            self.last_resync = now
+            self.resyncs += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.ids_by_name),
+                "ignored": len(self.ignored),
+                "hits": self.hits,
+                "fuzzy_hits": self.fuzzy_hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "negative_entries": len(self.missing),
+                "resyncs": self.resyncs,
+            }
@@ -0,0 +1,118 @@
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"buckets": list(zip(self.buckets + (float("inf"),), self.counts)),
+                    "sum": self.sum, "count": self.count}
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Counters and histograms in the Prometheus text format. Collectors are called on every
+# render and return (name, labels, value) gauges for things that are cheaper to read than to track.
+class MetricsRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def describe(self, name, kind, help_text):
+        self.help[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+        for (name, labels), value in counters:
+            samples.setdefault(name, []).append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+        for (name, labels), histogram in histograms:
+            snapshot = histogram.snapshot()
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in snapshot["buckets"]:
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", format_value(bound))]),
+                                                     cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(snapshot["sum"])))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), snapshot["count"]))
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, []).append("{}{} {}".format(name, format_labels(sorted(labels.items())),
+                                                                     format_value(value)))
+        output = []
+        for name in sorted(samples):
+            kind, help_text = self.help.get(name, ("untyped", ""))
+            output.append("# HELP {} {}".format(name, help_text))
+            output.append("# TYPE {} {}".format(name, kind))
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+# the process-wide registry everything reports to
+registry = MetricsRegistry()
+registry.describe("attendance_command_seconds", "histogram", "Time spent handling /attendance commands")
+registry.describe("attendance_command_errors_total", "counter", "/attendance commands that failed")
+registry.describe("db_query_seconds", "histogram", "Time spent executing database queries")
+registry.describe("db_slow_queries_total", "counter", "Queries slower than slow-query-ms")
+registry.describe("slack_api_call_seconds", "histogram", "Time spent in Slack Web API calls, per attempt")
+registry.describe("slack_api_errors_total", "counter", "Slack Web API calls that returned an error")
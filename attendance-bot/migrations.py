@@ -0,0 +1,173 @@
+import logging
+import dbutils
+
+logger = logging.getLogger(__name__)
+
+# pg advisory lock held while migrating so concurrently starting processes take turns
+MIGRATION_LOCK_ID = 724164
+
+# Each migration is (version, description, statements) and runs in its own transaction.
+# Never edit a migration that has shipped; add a new one instead.
+MIGRATIONS = [
+    (1, "initial schema", [
+        ("CREATE TABLE IF NOT EXISTS members"
+         "(slack_id varchar(255) PRIMARY KEY, "
+         "real_name varchar(255) NOT NULL,"
+         "ignore boolean, "
+         "is_admin boolean DEFAULT FALSE)"),
+        "ALTER TABLE members ADD COLUMN IF NOT EXISTS is_admin boolean DEFAULT FALSE",
+        ("CREATE TABLE IF NOT EXISTS posts"
+         "(post_timestamp varchar(255) PRIMARY KEY, "
+         "rehearsal_date varchar(255) UNIQUE NOT NULL, "
+         "channel_id varchar(255) NOT NULL)"),
+        ("CREATE TABLE IF NOT EXISTS attendance"
+         "(slack_id varchar(255) REFERENCES members(slack_id) ON DELETE CASCADE, "
+         "post_timestamp varchar(255) REFERENCES posts(post_timestamp), "
+         "present boolean, "
+         "PRIMARY KEY (slack_id, post_timestamp))"),
+        ("CREATE TABLE IF NOT EXISTS member_stats"
+         "(slack_id varchar(255) PRIMARY KEY REFERENCES members(slack_id) ON DELETE CASCADE, "
+         "absence_streak integer NOT NULL DEFAULT 0, "
+         "last_present_ts varchar(255), "
+         "last_present_date varchar(255), "
+         "present_total integer NOT NULL DEFAULT 0, "
+         "absent_total integer NOT NULL DEFAULT 0, "
+         "no_reply_total integer NOT NULL DEFAULT 0, "
+         "updated_at timestamptz NOT NULL DEFAULT now())"),
+        "CREATE INDEX IF NOT EXISTS member_stats_absence_streak_idx ON member_stats(absence_streak)",
+    ]),
+    # Slack timestamps become exact numerics and DD/MM/YY strings become dates,
+    # so posts sort and range-scan properly
+    (2, "typed timestamps and dates", [
+        "ALTER TABLE attendance DROP CONSTRAINT IF EXISTS attendance_post_timestamp_fkey",
+        "ALTER TABLE posts ALTER COLUMN post_timestamp TYPE numeric USING post_timestamp::numeric",
+        "ALTER TABLE posts ALTER COLUMN rehearsal_date TYPE date USING to_date(rehearsal_date, 'DD/MM/YY')",
+        "ALTER TABLE attendance ALTER COLUMN post_timestamp TYPE numeric USING post_timestamp::numeric",
+        ("ALTER TABLE attendance ADD CONSTRAINT attendance_post_timestamp_fkey "
+         "FOREIGN KEY (post_timestamp) REFERENCES posts(post_timestamp)"),
+        "ALTER TABLE member_stats ALTER COLUMN last_present_ts TYPE numeric USING last_present_ts::numeric",
+        ("ALTER TABLE member_stats ALTER COLUMN last_present_date TYPE date "
+         "USING to_date(last_present_date, 'DD/MM/YY')"),
+        "CREATE INDEX IF NOT EXISTS attendance_post_timestamp_present_idx ON attendance(post_timestamp, present)",
+        "CREATE INDEX IF NOT EXISTS members_real_name_idx ON members(real_name)",
+    ]),
+    # Every row belongs to a tenant (one choir's channel). Existing rows belong to the
+    # default tenant '', which is configured through the environment as before.
+    (3, "tenant keys", [
+        "ALTER TABLE attendance DROP CONSTRAINT IF EXISTS attendance_slack_id_fkey",
+        "ALTER TABLE attendance DROP CONSTRAINT IF EXISTS attendance_post_timestamp_fkey",
+        "ALTER TABLE member_stats DROP CONSTRAINT IF EXISTS member_stats_slack_id_fkey",
+        "ALTER TABLE members ADD COLUMN tenant varchar(255) NOT NULL DEFAULT ''",
+        "ALTER TABLE posts ADD COLUMN tenant varchar(255) NOT NULL DEFAULT ''",
+        "ALTER TABLE attendance ADD COLUMN tenant varchar(255) NOT NULL DEFAULT ''",
+        "ALTER TABLE member_stats ADD COLUMN tenant varchar(255) NOT NULL DEFAULT ''",
+        "ALTER TABLE members DROP CONSTRAINT members_pkey, ADD PRIMARY KEY (tenant, slack_id)",
+        ("ALTER TABLE posts DROP CONSTRAINT posts_pkey, DROP CONSTRAINT posts_rehearsal_date_key, "
+         "ADD PRIMARY KEY (tenant, post_timestamp), ADD UNIQUE (tenant, rehearsal_date)"),
+        "ALTER TABLE attendance DROP CONSTRAINT attendance_pkey, ADD PRIMARY KEY (tenant, slack_id, post_timestamp)",
+        "ALTER TABLE member_stats DROP CONSTRAINT member_stats_pkey, ADD PRIMARY KEY (tenant, slack_id)",
+        ("ALTER TABLE attendance ADD CONSTRAINT attendance_slack_id_fkey FOREIGN KEY (tenant, slack_id) "
+         "REFERENCES members(tenant, slack_id) ON DELETE CASCADE"),
+        ("ALTER TABLE attendance ADD CONSTRAINT attendance_post_timestamp_fkey FOREIGN KEY (tenant, post_timestamp) "
+         "REFERENCES posts(tenant, post_timestamp)"),
+        ("ALTER TABLE member_stats ADD CONSTRAINT member_stats_slack_id_fkey FOREIGN KEY (tenant, slack_id) "
+         "REFERENCES members(tenant, slack_id) ON DELETE CASCADE"),
+        "DROP INDEX IF EXISTS attendance_post_timestamp_present_idx",
+        "DROP INDEX IF EXISTS members_real_name_idx",
+        "DROP INDEX IF EXISTS member_stats_absence_streak_idx",
+        ("CREATE INDEX IF NOT EXISTS attendance_tenant_post_timestamp_present_idx "
+         "ON attendance(tenant, post_timestamp, present)"),
+        "CREATE INDEX IF NOT EXISTS members_tenant_real_name_idx ON members(tenant, real_name)",
+        "CREATE INDEX IF NOT EXISTS member_stats_tenant_absence_streak_idx ON member_stats(tenant, absence_streak)",
+    ]),
+    (4, "data versions", [
+        ("CREATE TABLE IF NOT EXISTS data_versions"
+         "(tenant varchar(255) PRIMARY KEY, "
+         "version bigint NOT NULL DEFAULT 0, "
+         "updated_at timestamptz NOT NULL DEFAULT now())"),
+    ]),
+    # Slack actions waiting to be carried out (see outbox.py)
+    (5, "outbox", [
+        ("CREATE TABLE IF NOT EXISTS outbox"
+         "(id bigserial PRIMARY KEY, "
+         "tenant varchar(255) NOT NULL DEFAULT '', "
+         "kind varchar(32) NOT NULL, "
+         "payload jsonb NOT NULL, "
+         "dedupe_key varchar(255), "
+         "status varchar(16) NOT NULL DEFAULT 'pending', "
+         "attempts integer NOT NULL DEFAULT 0, "
+         "last_error text, "
+         "available_at timestamptz NOT NULL DEFAULT now(), "
+         "created_at timestamptz NOT NULL DEFAULT now(), "
+         "sent_at timestamptz, "
+         "UNIQUE (tenant, dedupe_key))"),
+        "CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox(available_at, id) WHERE status = 'pending'",
+    ]),
+    # tell every process's invalidation listener what changed (see bus.py)
+    (6, "change notifications", [
+        ("CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$ "
+         "BEGIN "
+         "IF TG_OP = 'DELETE' THEN "
+         "PERFORM pg_notify('attendance_changes', OLD.tenant || ':' || TG_TABLE_NAME); "
+         "ELSE "
+         "PERFORM pg_notify('attendance_changes', NEW.tenant || ':' || TG_TABLE_NAME); "
+         "END IF; "
+         "RETURN NULL; "
+         "END $$ LANGUAGE plpgsql"),
+        "DROP TRIGGER IF EXISTS posts_notify_change ON posts",
+        ("CREATE TRIGGER posts_notify_change AFTER INSERT OR UPDATE OR DELETE ON posts "
+         "FOR EACH ROW EXECUTE PROCEDURE notify_change()"),
+        "DROP TRIGGER IF EXISTS members_notify_change ON members",
+        ("CREATE TRIGGER members_notify_change AFTER INSERT OR UPDATE OR DELETE ON members "
+         "FOR EACH ROW EXECUTE PROCEDURE notify_change()"),
+        "DROP TRIGGER IF EXISTS data_versions_notify_change ON data_versions",
+        ("CREATE TRIGGER data_versions_notify_change AFTER INSERT OR UPDATE OR DELETE ON data_versions "
+         "FOR EACH ROW EXECUTE PROCEDURE notify_change()"),
+    ]),
+    # APScheduler's SQLAlchemyJobStore table, as it would create it. Made here, before any web
+    # process starts, so that workers starting their schedulers together don't race to create it.
+    (7, "scheduler job store", [
+        ("CREATE TABLE IF NOT EXISTS apscheduler_jobs"
+         "(id varchar(191) PRIMARY KEY, "
+         "next_run_time double precision, "
+         "job_state bytea NOT NULL)"),
+        "CREATE INDEX IF NOT EXISTS ix_apscheduler_jobs_next_run_time ON apscheduler_jobs(next_run_time)",
+    ]),
+]
+
+
+def applied_versions(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations"
+                "(version integer PRIMARY KEY, "
+                "description varchar(255) NOT NULL, "
+                "applied_at timestamptz NOT NULL DEFAULT now())")
+    cur.execute("SELECT version FROM schema_migrations")
+    return set(row[0] for row in cur.fetchall())
+
+# apply every migration newer than the database, up to target if given
+def migrate(db, target=None):
+    applied = []
+    with dbutils.checkout(db) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            done = applied_versions(cur)
+            conn.commit()
+            for version, description, statements in MIGRATIONS:
+                if version in done or (target is not None and version > target):
+                    continue
+                logger.info("Applying migration %d: %s", version, description)
+                try:
+                    for statement in statements:
+                        cur.execute(statement)
+                    cur.execute("INSERT INTO schema_migrations(version, description) VALUES(%s, %s)",
+                                (version, description))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(version)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+    return applied
@@ -0,0 +1,246 @@
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import re
+import unicodedata
+
+NON_WORD = re.compile(r"[\W_]+")
+# typed words are compared with the words that share most trigrams with them
+CANDIDATES = 10
+# A fuzzy match is only taken on its own if it is this similar, every typed word is at least
+# WORD_SCORE similar to one of its words, and it is ACCEPT_MARGIN ahead of the next best.
+ACCEPT_SCORE = 0.75
+WORD_SCORE = 0.6
+ACCEPT_MARGIN = 0.15
+# weaker matches are only offered as suggestions
+SUGGEST_SCORE = 0.5
+
+
+# lower case, accents removed and punctuation collapsed to single spaces: "Beyoncé  Knowles-Carter"
+# becomes "beyonce knowles carter"
+def fold(text):
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", text.casefold()).strip()
+
+
+# trigrams of each word, padded as pg_trgm does so that word starts count for more
+def trigrams(folded):
+    grams = set()
+    for word in folded.split():
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+# Optimal string alignment distance: insertions, deletions, substitutions and swaps of
+# neighbouring letters each count as one. Past limit, gives up and returns limit + 1.
+def edit_distance(a, b, limit=None):
+    if limit is None:
+        limit = max(len(a), len(b))
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous, current = None, list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        before, previous, current = previous, current, [i]
+        left = i
+        for j, other in enumerate(b, 1):
+            best = previous[j - 1] + (char != other)
+            if previous[j] + 1 < best:
+                best = previous[j] + 1
+            if left + 1 < best:
+                best = left + 1
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other and before[j - 2] + 1 < best:
+                best = before[j - 2] + 1
+            current.append(best)
+            left = best
+        if min(current) > limit:
+            return limit + 1
+    return min(current[-1], limit + 1)
+
+
+# 1 for the same word, down to 0; anything under SUGGEST_SCORE comes out as 0
+def word_similarity(a, b):
+    longest = max(len(a), len(b))
+    score = 1 - edit_distance(a, b, int(longest * (1 - SUGGEST_SCORE))) / longest
+    return score if score >= SUGGEST_SCORE else 0.0
+
+
+# The result of matching a typed name: the member it means, if there is one clear answer, and
+# otherwise the closest names to offer instead, best first. exact is False when the answer was
+# a guess (a prefix or a close spelling), which a member not synced yet could have beaten.
+class NameMatch(object):
+    def __init__(self, slack_id=None, real_name=None, candidates=(), exact=False):
+        self.slack_id = slack_id
+        self.real_name = real_name
+        self.candidates = list(candidates)
+        self.exact = exact
+
+    # the guess, offered rather than taken
+    def as_suggestion(self):
+        return NameMatch(candidates=[(self.slack_id, self.real_name)])
+
+
+# Folded-name, word and trigram-of-word indexes over member names, updated one member at a
+# time. Fuzzy matching compares the typed words with the distinct words in members' names,
+# which are far fewer than the members themselves. Not thread safe; MemberDirectory locks
+# around it.
+class NameIndex(object):
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.names = {}
+        self.folded = {}
+        self.ids_by_folded = {}
+        self.ids_by_word = {}
+        self.words_by_gram = {}
+        self.words = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, slack_id, real_name):
+        if self.names.get(slack_id) == real_name:
+            return
+        self.remove(slack_id)
+        folded = fold(real_name)
+        self.names[slack_id] = real_name
+        self.folded[slack_id] = folded
+        self.ids_by_folded.setdefault(folded, set()).add(slack_id)
+        for word in set(folded.split()):
+            if word not in self.ids_by_word:
+                self.words = None
+                for gram in trigrams(word):
+                    self.words_by_gram.setdefault(gram, set()).add(word)
+            self.ids_by_word.setdefault(word, set()).add(slack_id)
+
+    def remove(self, slack_id):
+        if slack_id not in self.names:
+            return
+        del self.names[slack_id]
+        folded = self.folded.pop(slack_id)
+        discard(self.ids_by_folded, folded, slack_id)
+        for word in set(folded.split()):
+            if discard(self.ids_by_word, word, slack_id):
+                self.words = None
+                for gram in trigrams(word):
+                    discard(self.words_by_gram, gram, word)
+
+    # known words starting with prefix, from the sorted list of them
+    def words_starting(self, prefix):
+        if self.words is None:
+            self.words = sorted(self.ids_by_word)
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            yield self.words[i]
+            i += 1
+
+    # members with a distinct word starting with each typed word, so "bey" and "bey kno"
+    # both find "Beyonce Knowles"
+    def prefix_ids(self, query_words):
+        found = None
+        for word in query_words:
+            ids = set()
+            for known in self.words_starting(word):
+                ids.update(self.ids_by_word[known])
+            found = ids if found is None else found & ids
+            if not found:
+                return set()
+        if len(query_words) > 1:
+            found = {slack_id for slack_id in found if self.prefixes_distinct(query_words, self.folded[slack_id])}
+        return found
+
+    @staticmethod
+    def prefixes_distinct(query_words, folded):
+        words = folded.split()
+        for prefix in sorted(query_words, key=len, reverse=True):
+            for i, word in enumerate(words):
+                if word.startswith(prefix):
+                    del words[i]
+                    break
+            else:
+                return False
+        return True
+
+    # known words like the typed one, with their similarity to it: words it starts, and those
+    # of the CANDIDATES sharing most trigrams with it that are close enough by edit distance
+    def similar_words(self, word):
+        counts = Counter()
+        for gram in trigrams(word):
+            counts.update(self.words_by_gram.get(gram, ()))
+        similar = {known: 1.0 for known in self.words_starting(word)}
+        candidates = counts.most_common(CANDIDATES)
+        for known, shared in candidates:
+            # words sharing far fewer trigrams than the closest one are rarely worth the edit distance
+            if known not in similar and shared * 2 >= candidates[0][1]:
+                score = word_similarity(word, known)
+                if score >= SUGGEST_SCORE:
+                    similar[known] = score
+        return similar
+
+    # (average, worst word similarity, slack_id) for the best `limit` members with a word like
+    # one of the typed ones, best first. Members with a word like every typed word are
+    # preferred, and only if there are none is everyone with a word like any of them ranked.
+    def ranked(self, query_words, limit):
+        per_word = []
+        for word in query_words:
+            scores = {}
+            for known, score in self.similar_words(word).items():
+                for slack_id in self.ids_by_word[known]:
+                    if score > scores.get(slack_id, 0.0):
+                        scores[slack_id] = score
+            per_word.append(scores)
+        candidates = set.intersection(*(set(scores) for scores in per_word))
+        if not candidates:
+            candidates = set().union(*per_word)
+        ranked = []
+        for slack_id in candidates:
+            scores = [word_scores.get(slack_id, 0.0) for word_scores in per_word]
+            ranked.append((sum(scores) / len(scores), min(scores), slack_id))
+        return heapq.nsmallest(limit, ranked, key=lambda score: (-score[0], self.names[score[2]]))
+
+    # An exact match (ignoring case, accents and punctuation), then a single member whose words
+    # start with the typed words, then a clear winner on edit distance.
+    def match(self, query, limit=5):
+        folded = fold(query)
+        if not folded:
+            return NameMatch()
+        exact = self.ids_by_folded.get(folded, ())
+        if len(exact) == 1:
+            return self.found(next(iter(exact)), exact=True)
+        if exact:
+            return self.suggest(exact, len(folded.split()), limit)
+        query_words = folded.split()
+        prefixed = self.prefix_ids(query_words)
+        if len(prefixed) == 1:
+            return self.found(next(iter(prefixed)))
+        if prefixed:
+            return self.suggest(prefixed, len(query_words), limit)
+        scores = [score for score in self.ranked(query_words, max(limit, 2)) if score[0] >= SUGGEST_SCORE]
+        if scores and scores[0][0] >= ACCEPT_SCORE and scores[0][1] >= WORD_SCORE and (
+                len(scores) == 1 or scores[0][0] - scores[1][0] >= ACCEPT_MARGIN):
+            return self.found(scores[0][2])
+        return NameMatch(candidates=[(score[2], self.names[score[2]]) for score in scores[:limit]])
+
+    def found(self, slack_id, exact=False):
+        return NameMatch(slack_id, self.names[slack_id], exact=exact)
+
+    # everyone in slack_ids matches equally well, so the names with fewest extra words come first
+    def suggest(self, slack_ids, words, limit):
+        best = heapq.nsmallest(limit, slack_ids,
+                               key=lambda slack_id: (len(self.folded[slack_id].split()) - words,
+                                                     self.names[slack_id]))
+        return NameMatch(candidates=[(slack_id, self.names[slack_id]) for slack_id in best])
+
+
+# remove value from the set at index[key], dropping the set once it is empty; True if it was
+def discard(index, key, value):
+    values = index.get(key)
+    if values is None:
+        return False
+    values.discard(value)
+    if not values:
+        del index[key]
+        return True
+    return False
@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+import dbutils
+from metrics import registry as metrics
+from slackapi import SlackAPIError, is_retryable
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# With a dedupe_key, an action is only ever queued once per tenant
+ENQUEUE_QUERY = ("INSERT INTO outbox(tenant, kind, payload, dedupe_key) VALUES(%s, %s, %s, %s) "
+                 "ON CONFLICT (tenant, dedupe_key) DO NOTHING RETURNING id")
+
+# Claiming a row pushes its available_at past the lease, so every other dispatcher skips it
+# until then. If this one dies before recording the outcome, the row is tried again once
+# the lease runs out, which means an action can be carried out twice but never lost.
+CLAIM_QUERY = ("UPDATE outbox SET attempts = attempts + 1, available_at = now() + %s * interval '1 second' "
+               "WHERE id IN (SELECT id FROM outbox WHERE status = 'pending' AND available_at <= now() "
+               "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+               "RETURNING id, tenant, kind, payload, attempts, extract(epoch FROM now() - created_at)")
+
+
+# Queue a Slack action as part of the caller's transaction, so it happens if and only if
+# the rest of the transaction commits. Returns the new row's id, or None if dedupe_key was
+# already taken.
+def enqueue(cur, tenant, kind, payload, dedupe_key=None):
+    cur.execute(ENQUEUE_QUERY, (tenant, kind, json.dumps(payload), dedupe_key))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def pending_count(db):
+    row = dbutils.execute_fetchone(db, "SELECT count(*) FROM outbox WHERE status = 'pending'")
+    return row[0] if row is not None else 0
+
+
+# Carries out queued Slack actions in the background, oldest first, a batch at a time.
+# deliver(tenant, kind, payload) makes the Slack calls and may return a function taking a
+# cursor, for writes that depend on the result; those are committed along with the row
+# being marked sent. Failed actions are retried with exponential backoff until
+# outbox-max-attempts, then left marked failed.
+class OutboxDispatcher(object):
+    def __init__(self, deliver, settings):
+        self.deliver = deliver
+        self.batch_size = settings["outbox-batch-size"]
+        self.poll_interval = settings["outbox-poll-interval"]
+        self.lease = settings["outbox-lease"]
+        self.max_attempts = settings["outbox-max-attempts"]
+        self.backoff = settings["outbox-backoff"]
+        self.max_backoff = settings["outbox-max-backoff"]
+        self.db = None
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target=self.run, name="outbox", daemon=True)
+
+    # the app may be rebuilt with a new pool; the worker picks it up on its next batch
+    def start(self, db):
+        self.db = db
+        if self.worker.ident is None:
+            self.worker.start()
+
+    # look for new rows straight away rather than at the next poll
+    def notify(self):
+        self.wake.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                claimed = self.dispatch()
+            except Exception:
+                logger.exception("Could not dispatch the outbox")
+                claimed = 0
+            if claimed < self.batch_size:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+
+    # claim one batch and carry it out on the calling thread; returns how many rows were claimed
+    def dispatch(self):
+        with dbutils.transaction(self.db) as cur:
+            cur.execute(CLAIM_QUERY, (self.lease, self.batch_size))
+            rows = sorted(cur.fetchall())
+        for row in rows:
+            self.dispatch_row(*row)
+        return len(rows)
+
+    def dispatch_row(self, row_id, tenant, kind, payload, attempts, age):
+        try:
+            record = self.deliver(tenant, kind, payload)
+            with dbutils.transaction(self.db) as cur:
+                if record is not None:
+                    record(cur)
+                cur.execute("UPDATE outbox SET status = %s, sent_at = now(), last_error = NULL WHERE id = %s",
+                            (SENT, row_id))
+        except Exception as e:
+            self.failed(row_id, kind, attempts, e)
+            return
+        metrics.inc("outbox_sent_total", kind=kind)
+        metrics.observe("outbox_delay_seconds", float(age), kind=kind)
+
+    def failed(self, row_id, kind, attempts, error):
+        retry = attempts < self.max_attempts and (not isinstance(error, SlackAPIError) or is_retryable(error.error))
+        if retry:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            logger.warning("Outbox %s %d failed (%s), retrying in %.0fs", kind, row_id, error, delay)
+            query = ("UPDATE outbox SET last_error = %s, available_at = now() + %s * interval '1 second' "
+                     "WHERE id = %s")
+            args = (str(error), delay, row_id)
+            metrics.inc("outbox_retries_total", kind=kind)
+        else:
+            logger.error("Outbox %s %d failed after %d attempts, giving up: %s", kind, row_id, attempts, error)
+            query = "UPDATE outbox SET status = %s, last_error = %s WHERE id = %s"
+            args = (FAILED, str(error), row_id)
+            metrics.inc("outbox_failed_total", kind=kind)
+        try:
+            dbutils.execute_and_commit(self.db, query, args)
+        except Exception:
+            # the lease runs out and the row is tried again anyway
+            logger.exception("Could not record the outcome of outbox %s %d", kind, row_id)
+
+    # Let the current batch finish. Anything still queued is left for whichever process polls next.
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+        if self.worker.is_alive():
+            self.worker.join()
+
+
+metrics.describe("outbox_sent_total", "counter", "Queued Slack actions carried out")
+metrics.describe("outbox_retries_total", "counter", "Queued Slack actions that failed and will be retried")
+metrics.describe("outbox_failed_total", "counter", "Queued Slack actions given up on")
+metrics.describe("outbox_delay_seconds", "histogram", "Time from queueing a Slack action to carrying it out")
@@ -0,0 +1,201 @@
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from datetime import datetime, timedelta
+import logging
+import os
+import select
+import threading
+import dbutils
+
+logger = logging.getLogger(__name__)
+
+# pg advisory lock held by whichever web process is currently allowed to run jobs
+LEADER_LOCK_ID = 724163
+# Jobs edited in a process that isn't the leader are only written to the job store, and the
+# leader won't look at it again until its next job is due, so such edits are announced here.
+CHANGES_CHANNEL = "scheduler_changes"
+
+# Jobs live in the database and refer to the functions below by name, so they find
+# their tenant's bot through the registry in this module rather than holding a reference to it.
+registry = None
+
+# the default tenant's jobs keep their original ids; other tenants' are prefixed with the tenant
+JOB_FUNCS = {"post": "scheduler:post_job", "process": "scheduler:process_job", "report": "scheduler:report_job"}
+
+
+# The post and the report go through the outbox, so a Slack outage delays them rather than
+# losing them. The dedupe key stops a second scheduler run on the same day queueing another post.
+def post_job(message, tenant=""):
+    bot = registry.get(tenant)
+    today = datetime.now().strftime("%d/%m/%y")
+    if bot.get_timestamp(today) is not None or not bot.queue_post(message, dedupe_key="post:" + today):
+        logger.info("Today's attendance message for tenant '%s' has already been posted, skipping", tenant)
+
+def process_job(tenant=""):
+    logger.info(registry.get(tenant).process_attendance())
+
+def report_job(tenant=""):
+    bot = registry.get(tenant)
+    bot.queue_message(bot.create_absence_message())
+
+
+# SQLAlchemy rejects the postgres:// scheme that Heroku hands out, so name the driver explicitly
+def database_url():
+    url = os.environ.get("DATABASE_URL")
+    return "postgresql+psycopg2://" + url.split("://", 1)[1]
+
+def day_of_week(day):
+    return day.strip().lower()[:3]
+
+def job_id(name, tenant):
+    return "{}:{}".format(tenant, name) if tenant else name
+
+def job_tenant(job):
+    return job.kwargs.get("tenant", "")
+
+
+class JobScheduler(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.scheduler = BackgroundScheduler(
+            jobstores={"default": SQLAlchemyJobStore(url=database_url())},
+            executors={"default": ThreadPoolExecutor(1)},
+            job_defaults={"coalesce": True, "max_instances": 1,
+                          "misfire_grace_time": settings["scheduler-misfire-grace"]},
+            timezone=settings["timezone"])
+        self.lock_conn = None
+        self.stopping = threading.Event()
+        self.elector = threading.Thread(target=self.elect, name="scheduler-leader", daemon=True)
+
+    def triggers(self, settings):
+        timezone = settings["timezone"]
+        return {
+            "post": CronTrigger(day_of_week=day_of_week(settings["rehearsal-day"]), hour=settings["post-hour"],
+                                minute=settings["post-minute"], timezone=timezone),
+            "process": CronTrigger(day_of_week=day_of_week(settings["update-day"]), hour=settings["update-hour"],
+                                   minute=settings["update-minute"], timezone=timezone),
+            "report": CronTrigger(day_of_week=day_of_week(settings["check-day"]), hour=settings["post-hour"],
+                                  minute=settings["post-minute"], timezone=timezone),
+        }
+
+    # every process runs the scheduler so it can edit jobs, but only the lock holder runs them
+    def start(self, tenant_registry, post_message):
+        global registry
+        registry = tenant_registry
+        registry.set_scheduler(self)
+        self.scheduler.start(paused=True)
+        self.schedule(post_message)
+        self.elector.start()
+
+    def schedule(self, post_message):
+        tenants = registry.keys()
+        for tenant in tenants:
+            for name, trigger in self.triggers(registry.settings_for(tenant)).items():
+                kwargs = {"message": post_message} if name == "post" else {}
+                if tenant:
+                    kwargs["tenant"] = tenant
+                job = self.scheduler.get_job(job_id(name, tenant))
+                # keep existing jobs untouched so a restart doesn't reset their next run time
+                if job is not None and str(job.trigger) == str(trigger) and job.kwargs == kwargs:
+                    continue
+                self.scheduler.add_job(JOB_FUNCS[name], trigger, id=job_id(name, tenant), kwargs=kwargs,
+                                       replace_existing=True)
+        for job in self.scheduler.get_jobs():
+            if job_tenant(job) not in tenants:
+                logger.info("Removing job %s for a tenant that is no longer configured", job.id)
+                job.remove()
+
+    def is_leader(self):
+        return self.lock_conn is not None
+
+    def elect(self):
+        while not self.stopping.is_set():
+            if self.is_leader() and not self.still_holds_lock():
+                logger.warning("Lost the scheduler lock, pausing jobs")
+                self.lock_conn = None
+                self.scheduler.pause()
+            if not self.is_leader() and self.try_lock():
+                logger.info("Acquired the scheduler lock, running jobs in this process")
+                self.scheduler.resume()
+            if self.is_leader():
+                self.wait_for_changes(self.settings["scheduler-lock-retry"])
+            else:
+                self.stopping.wait(self.settings["scheduler-lock-retry"])
+
+    # as the leader, wait on the lock connection for other processes' job edits
+    def wait_for_changes(self, timeout):
+        conn = self.lock_conn
+        try:
+            if not conn.notifies and not select.select([conn], [], [], timeout)[0]:
+                return
+            conn.poll()
+        except Exception:
+            # still_holds_lock notices on the next round
+            return
+        if conn.notifies:
+            del conn.notifies[:]
+            self.scheduler.wakeup()
+
+    def try_lock(self):
+        conn = None
+        try:
+            conn = dbutils.connect_to_db()
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (LEADER_LOCK_ID,))
+            if cur.fetchone()[0]:
+                cur.execute("LISTEN " + CHANGES_CHANNEL)
+                self.lock_conn = conn
+                return True
+        except Exception:
+            logger.exception("Could not check the scheduler lock")
+        if conn is not None:
+            conn.close()
+        return False
+
+    def still_holds_lock(self):
+        try:
+            self.lock_conn.cursor().execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def tenant_jobs(self, tenant):
+        return [job for job in self.scheduler.get_jobs() if job_tenant(job) == tenant]
+
+    # push every one of the tenant's jobs past the end of the given DD/MM/YY date
+    def pause_until(self, date, tenant=""):
+        resume_at = datetime.strptime(date, "%d/%m/%y") + timedelta(days=1)
+        for job in self.tenant_jobs(tenant):
+            next_run = job.trigger.get_next_fire_time(None, resume_at.replace(tzinfo=self.scheduler.timezone))
+            job.modify(next_run_time=next_run)
+        self.notify_leader()
+        return True
+
+    def resume(self, tenant=""):
+        now = datetime.now(self.scheduler.timezone)
+        for job in self.tenant_jobs(tenant):
+            job.modify(next_run_time=job.trigger.get_next_fire_time(None, now))
+        self.notify_leader()
+        return True
+
+    # the leader's own scheduler wakes up by itself when its jobs are edited
+    def notify_leader(self):
+        if self.is_leader():
+            return
+        conn = dbutils.connect_to_db()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute("NOTIFY " + CHANGES_CHANNEL)
+        finally:
+            conn.close()
+
+    def shutdown(self):
+        self.stopping.set()
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=True)
+        if self.lock_conn is not None:
+            self.lock_conn.close()
+            self.lock_conn = None
@@ -6,4 +6,53 @@ config = {
     "rehearsal-day": "mon",
     "update-day": "sun",
     "check-day": "friday",
+    "async-commands": True,
+    # gunicorn (see gunicorn.conf.py); WEB_CONCURRENCY overrides web-workers, as on Heroku
+    "web-workers": 2,
+    "web-threads": 8,
+    "web-timeout": 30,
+    "web-graceful-timeout": 25,
+    "job-workers": 2,
+    "job-queue-size": 10,
+    "db-pool-min": 1,
+    "db-pool-max": 5,
+    "db-pool-timeout": 10,
+    "db-pool-ping-after": 30,
+    # queries slower than this many milliseconds are logged; None turns the log off
+    "slow-query-ms": 500,
+    "member-cache-ttl": 300,
+    "member-negative-ttl": 600,
+    "member-resync-interval": 300,
+    "member-page-size": 200,
+    "absence-threshold": 4,
+    "stats-window": 8,
+    "slack-max-retries": 3,
+    "slack-backoff": 1.0,
+    "slack-max-concurrency": 4,
+    "backfill-batch-size": 10,
+    "export-batch-size": 2000,
+    "event-batch-size": 50,
+    "event-flush-interval": 1.0,
+    # queued Slack actions (see outbox.py); times are in seconds
+    "outbox-enabled": True,
+    "outbox-batch-size": 20,
+    "outbox-poll-interval": 2.0,
+    "outbox-lease": 120,
+    "outbox-max-attempts": 8,
+    "outbox-backoff": 5.0,
+    "outbox-max-backoff": 900,
+    # serve posts and members from memory, invalidated over LISTEN/NOTIFY (see bus.py); seconds
+    "bus-enabled": True,
+    "bus-ping-interval": 30,
+    "bus-reconnect-interval": 5,
+    "timezone": "Europe/London",
+    "scheduler-enabled": True,
+    "scheduler-misfire-grace": 3600,
+    "scheduler-lock-retry": 60,
+    "tenant-cache-size": 8,
+    # Other choirs served by this deployment, keyed by tenant name. Each needs a "team-id",
+    # a "channel" and a "token-env" naming the variable that holds its bot token; any other
+    # setting above can be overridden too, e.g.
+    # "altos": {"team-id": "T0123", "channel": "C0456", "token-env": "ALTOS_BOT_TOKEN", "rehearsal-day": "tue"}
+    "tenants": {},
 }
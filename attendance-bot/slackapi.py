@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import requests
+from metrics import Histogram, registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Slack's published rate limit tiers, in calls per minute. Each tier may burst up to a
+# minute's worth of calls. chat.postMessage has its own "special" limit of roughly one
+# message per second per channel.
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100, "special": 60}
+METHOD_TIERS = {
+    "users.list": 2,
+    "users.info": 4,
+    "reactions.get": 3,
+    "reactions.add": 3,
+    "chat.postMessage": "special",
+}
+DEFAULT_TIER = 3
+
+# errors worth trying again; anything else is reported straight away
+RETRY_ERRORS = ("ratelimited", "internal_error", "fatal_error", "service_unavailable", "request_timeout")
+
+
+# also true of the request_failed errors raised once a call has run out of retries
+def is_retryable(error):
+    return error in RETRY_ERRORS or (error or "").startswith(("http_5", "request_failed"))
+
+
+class SlackAPIError(Exception):
+    def __init__(self, method, error):
+        super(SlackAPIError, self).__init__("{} failed: {}".format(method, error))
+        self.method = method
+        self.error = error
+
+
+class TokenBucket(object):
+    def __init__(self, per_minute, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    # block until a call is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+# SlackClient-compatible client for a custom API root, such as a local fake Slack server
+class HTTPClient(object):
+    def __init__(self, token, base_url, timeout=10):
+        self.token = token
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+
+    def api_call(self, method, **kwargs):
+        res = requests.post(self.base_url + method, data=kwargs, timeout=self.timeout,
+                            headers={"Authorization": "Bearer {}".format(self.token)})
+        try:
+            result = res.json()
+        except ValueError:
+            result = {"ok": False, "error": "http_{}".format(res.status_code)}
+        result["headers"] = dict(res.headers)
+        return result
+
+
+class SlackAPI(object):
+    def __init__(self, client, settings):
+        self.client = client
+        self.max_retries = settings["slack-max-retries"]
+        self.backoff = settings["slack-backoff"]
+        self.buckets = {tier: TokenBucket(per_minute, per_minute)
+                        for tier, per_minute in TIER_LIMITS.items()}
+        self.executor = ThreadPoolExecutor(max_workers=settings["slack-max-concurrency"])
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    def call(self, method, **kwargs):
+        bucket = self.buckets[METHOD_TIERS.get(method, DEFAULT_TIER)]
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = self.retry_delay(error, attempt)
+                logger.warning("%s failed (%s), retrying in %.1fs", method, error.get("error"), delay)
+                time.sleep(delay)
+            bucket.acquire()
+            start = time.monotonic()
+            try:
+                res = self.client.api_call(method, **kwargs)
+            except requests.RequestException as e:
+                res = {"ok": False, "error": "request_failed: {}".format(e)}
+                error = dict(res, retryable=True)
+                metrics.inc("slack_api_errors_total", method=method, error="request_failed")
+                continue
+            finally:
+                self.observe(method, time.monotonic() - start)
+            # responses without an "ok" field are treated as successful
+            if res.get("ok", True):
+                return res
+            error = dict(res, retryable=self.is_retryable(res.get("error")))
+            metrics.inc("slack_api_errors_total", method=method, error=res.get("error"))
+            if not error["retryable"]:
+                break
+        raise SlackAPIError(method, error.get("error"))
+
+    # Run independent calls concurrently; calls is a list of (method, kwargs) pairs. With
+    # return_errors, a call that fails gives its SlackAPIError in place of a result.
+    def call_many(self, calls, return_errors=False):
+        futures = [self.executor.submit(self.call, method, **kwargs) for method, kwargs in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except SlackAPIError as e:
+                if not return_errors:
+                    raise
+                results.append(e)
+        return results
+
+    def is_retryable(self, error):
+        return is_retryable(error)
+
+    def retry_delay(self, error, attempt):
+        retry_after = error.get("headers", {}).get("Retry-After")
+        if retry_after is not None:
+            return float(retry_after)
+        return self.backoff * 2 ** (attempt - 1)
+
+    def observe(self, method, seconds):
+        with self.lock:
+            histogram = self.latencies.get(method)
+            if histogram is None:
+                histogram = self.latencies[method] = Histogram()
+        histogram.observe(seconds)
+        metrics.observe("slack_api_call_seconds", seconds, method=method)
+
+    def stats(self):
+        with self.lock:
+            latencies = dict(self.latencies)
+        return {method: histogram.snapshot() for method, histogram in latencies.items()}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
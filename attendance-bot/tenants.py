@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import logging
+import threading
+from bot import AttendanceBot
+
+logger = logging.getLogger(__name__)
+
+# the tenant configured through the environment, which owns all data from before tenants existed
+DEFAULT_TENANT = ""
+
+
+# a tenant's settings are the global ones with its own entry from settings["tenants"] on top
+def tenant_settings(settings, tenant):
+    if tenant == DEFAULT_TENANT:
+        return settings
+    return dict(settings, **settings["tenants"][tenant])
+
+# every workspace the deployment answers slash commands from
+def team_ids(settings, default_team_id=None):
+    ids = set(tenant.get("team-id") for tenant in settings["tenants"].values())
+    ids.add(default_team_id)
+    return ids
+
+
+# Hands out the AttendanceBot for each tenant. The default bot is always kept; the others are
+# built on first use, share its connection pool and invalidation bus and are kept in a bounded LRU cache, so a
+# deployment with many choirs doesn't hold a Slack client and member cache for all of them.
+class TenantRegistry(object):
+    def __init__(self, settings, default_bot, default_team_id=None):
+        self.settings = settings
+        self.default = default_bot
+        self.default_team_id = default_team_id
+        self.max_size = settings["tenant-cache-size"]
+        self.bots = OrderedDict()
+        self.scheduler = None
+        self.lock = threading.Lock()
+
+    def keys(self):
+        return [DEFAULT_TENANT] + sorted(self.settings["tenants"])
+
+    def settings_for(self, tenant):
+        return tenant_settings(self.settings, tenant)
+
+    def team_ids(self):
+        return team_ids(self.settings, self.default_team_id)
+
+    # work out which tenant a request is for: the tenant whose channel it came from, otherwise the
+    # tenant for its workspace, otherwise the default tenant
+    def resolve(self, team_id=None, channel_id=None):
+        tenants = self.settings["tenants"]
+        for key, tenant in tenants.items():
+            if channel_id is not None and tenant.get("channel") == channel_id:
+                return key
+        if team_id is not None and team_id != self.default_team_id:
+            for key, tenant in sorted(tenants.items()):
+                if tenant.get("team-id") == team_id:
+                    return key
+        return DEFAULT_TENANT
+
+    def get(self, tenant):
+        if tenant == DEFAULT_TENANT:
+            return self.default
+        with self.lock:
+            bot = self.bots.get(tenant)
+            if bot is not None:
+                self.bots.move_to_end(tenant)
+                return bot
+            bot = AttendanceBot(self.settings_for(tenant), tenant, self.default.db, self.default.bus)
+            bot.scheduler = self.scheduler
+            self.bots[tenant] = bot
+            # anything still using an evicted bot keeps its own reference to it
+            while len(self.bots) > self.max_size:
+                evicted, _ = self.bots.popitem(last=False)
+                logger.info("Dropped tenant %s from the bot cache", evicted)
+        return bot
+
+    # the bots built so far, default first
+    def loaded(self):
+        with self.lock:
+            return [self.default] + list(self.bots.values())
+
+    def for_request(self, team_id=None, channel_id=None):
+        return self.get(self.resolve(team_id, channel_id))
+
+    def set_scheduler(self, scheduler):
+        with self.lock:
+            self.scheduler = scheduler
+            self.default.scheduler = scheduler
+            for bot in self.bots.values():
+                bot.scheduler = scheduler
+
+    # reaction events carry the channel of the message reacted to, which picks the tenant
+    def apply_reaction_events(self, events):
+        by_tenant = OrderedDict()
+        for event in events:
+            tenant = self.resolve(channel_id=event.get("item", {}).get("channel"))
+            by_tenant.setdefault(tenant, []).append(event)
+        for tenant, tenant_events in by_tenant.items():
+            self.get(tenant).apply_reaction_events(tenant_events)
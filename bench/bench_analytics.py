@@ -0,0 +1,87 @@
+# Times loading the attendance matrix and computing the stats from it over a generated
+# dataset, against working the per-member rates out in SQL. Runs against DATABASE_URL
+# inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_analytics.py [members] [years]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+
+SCHEMA = "analytics_bench"
+FIRST_POST = 1262563200  # Monday 4th January 2010
+WINDOW = 8
+
+SQL_RATES = ("SELECT slack_id, avg(CASE WHEN present THEN 1.0 ELSE 0.0 END) FROM attendance "
+             "WHERE tenant = '' GROUP BY slack_id")
+
+
+def generate(db, members, years):
+    with dbutils.transaction(db) as cur:
+        cur.execute("INSERT INTO members(slack_id, real_name, ignore) "
+                    "SELECT 'U' || lpad(i::text, 6, '0'), 'Member ' || i, FALSE FROM generate_series(1, %s) AS i",
+                    (members,))
+        cur.execute("INSERT INTO posts(post_timestamp, rehearsal_date, channel_id) "
+                    "SELECT %s + w * 604800, to_timestamp(%s + w * 604800)::date, 'C0BENCH' "
+                    "FROM generate_series(0, %s) AS w", (FIRST_POST, FIRST_POST, years * 52 - 1))
+        # members join at random points in the history
+        cur.execute("INSERT INTO attendance(slack_id, post_timestamp, present) "
+                    "SELECT m.slack_id, p.post_timestamp, "
+                    "CASE WHEN random() < 0.6 THEN TRUE WHEN random() < 0.5 THEN FALSE END "
+                    "FROM members AS m, posts AS p "
+                    "WHERE p.post_timestamp >= %s + (hashtext(m.slack_id) & 255) * 604800", (FIRST_POST,))
+        cur.execute("ANALYZE")
+
+
+def timed(label, func, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    print("{:<28} {:>10.2f} ms".format(label, (time.perf_counter() - start) / repeat * 1000))
+    return result
+
+
+def main(members, years):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("CREATE SCHEMA IF NOT EXISTS " + SCHEMA)
+    dbutils.commit_or_rollback(db)
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from settings import config
+    from analytics import load_matrix
+    bot = AttendanceBot(config)
+    bot.create_tables()
+    try:
+        print("Generating {} members x {} weekly posts...".format(members, years * 52))
+        generate(bot.db, members, years)
+        bot.refresh_member_stats()
+
+        timed("rates in SQL", lambda: dbutils.execute_fetchall(bot.db, SQL_RATES))
+        matrix = timed("load matrix", lambda: load_matrix(bot.db, ""))
+        print("matrix is {} x {}, {:.1f} MB".format(matrix.codes.shape[0], matrix.codes.shape[1],
+                                                     matrix.codes.nbytes / 1e6))
+        def cold_matrix():
+            bot.cache.clear()
+            return bot.attendance_matrix()
+        timed("bot matrix, cold", cold_matrix)
+        bot.attendance_matrix()
+        timed("bot matrix, cached", bot.attendance_matrix, repeat=50)
+        timed("member rates", matrix.member_rates, repeat=50)
+        timed("rolling {}-week rates".format(WINDOW), lambda: matrix.rolling_rates(WINDOW), repeat=20)
+        timed("turnout trend", lambda: matrix.turnout_trend(WINDOW), repeat=50)
+        timed("cohorts", lambda: matrix.cohorts(WINDOW), repeat=50)
+        timed("stats message", bot.create_stats_message, repeat=20)
+        timed("member stats message", lambda: bot.create_member_stats_message("U000042", "Member 42"), repeat=20)
+    finally:
+        bot.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    args = [int(n) for n in sys.argv[1:]]
+    main(*(args + [2000, 5][len(args):]))
@@ -0,0 +1,91 @@
+# Compares the lookups every command makes (the timestamp for a date, the latest post, a
+# member's id and the cached absence report) read from Postgres each time with the same
+# lookups served from memory while an InvalidationBus is listening. Also measures how long a
+# write in one connection takes to invalidate the cache. Runs against DATABASE_URL inside a
+# scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_bus.py [lookups]
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+
+SCHEMA = "bus_bench"
+POSTS = 200
+MEMBERS = 300
+
+
+def seed(db):
+    with dbutils.transaction(db) as cur:
+        cur.execute("INSERT INTO members(slack_id, real_name, ignore) "
+                    "SELECT 'U' || lpad(i::text, 6, '0'), 'Member ' || i, FALSE FROM generate_series(0, %s) AS i",
+                    (MEMBERS - 1,))
+        cur.execute("INSERT INTO posts(post_timestamp, rehearsal_date, channel_id) "
+                    "SELECT 1477908000 + i * 604800, to_timestamp(1477908000 + i * 604800)::date, 'C0BENCH' "
+                    "FROM generate_series(0, %s) AS i", (POSTS - 1,))
+
+
+def lookups(bot, date):
+    bot.get_timestamp(date)
+    bot.get_latest_post_data()
+    bot.get_slack_id("Member 42")
+    bot.create_absence_message()
+
+
+def timed(bot, date, n):
+    lookups(bot, date)
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        lookups(bot, date)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def invalidation_delay(bus, db, n):
+    delays = []
+    for i in range(n):
+        before = bus.generation("", "posts")
+        start = time.perf_counter()
+        dbutils.execute_and_commit(db, "UPDATE posts SET channel_id = %s WHERE post_timestamp = 1477908000",
+                                   ("C{}".format(i),))
+        while bus.generation("", "posts") == before:
+            time.sleep(0.0001)
+        delays.append(time.perf_counter() - start)
+    return statistics.median(delays) * 1000
+
+
+def main(n):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from bus import InvalidationBus
+    from settings import config
+    bus = InvalidationBus(config)
+    bus.start()
+    direct = AttendanceBot(config)
+    direct.create_tables()
+    cached = AttendanceBot(config, db=direct.db, bus=bus)
+    try:
+        seed(direct.db)
+        bus.listening.wait(5)
+        date = "31/10/16"
+        print("{:<32} {:>10.3f}".format("lookups from Postgres (ms)", timed(direct, date, n)))
+        print("{:<32} {:>10.3f}".format("lookups from memory (ms)", timed(cached, date, n)))
+        print("{:<32} {:>10.3f}".format("write to invalidation (ms)", invalidation_delay(bus, direct.db, 50)))
+    finally:
+        bus.stop()
+        direct.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
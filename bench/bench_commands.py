@@ -0,0 +1,73 @@
+# Compares finding and parsing a /attendance command the old way (a chain of substring checks,
+# then each handler splitting the text again) with the command router. Needs no database.
+#
+#   python bench/bench_commands.py [iterations]
+from datetime import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+from commands import CommandRouter, Arg, DATE, FLAG, REST
+
+TEXTS = ["", "report", "stats Beyonce Knowles", "post Bohemian Rhapsody", "here 31/10/16 Beyonce Knowles",
+         "absent 31/10/16 Beyonce Knowles", "ignore stop Beyonce Knowles", "past 04/09/17 18/12/17",
+         "resumejobs", "foo"]
+LEGACY = ("help", "report", "stats", "updatemembers", "post", "process", "here", "absent", "ignore", "past",
+          "bankholiday", "resumejobs")
+
+
+# the old dispatch and argument handling, without the handlers themselves
+def legacy(text):
+    if len(text) == 0:
+        return "help", ()
+    for name in LEGACY:
+        if name in text:
+            break
+    else:
+        return None, ()
+    words = text.strip().split()
+    if name in ("here", "absent"):
+        if len(words) < 3:
+            return name, ()
+        try:
+            datetime.strptime(words[1], "%d/%m/%y")
+        except ValueError:
+            return name, ()
+        return name, (words[1], " ".join(words[2:]))
+    if name == "ignore":
+        return name, ("stop" in text, " ".join(w for w in words[1:] if w != "stop"))
+    if name in ("stats", "post"):
+        return name, (" ".join(words[1:]),)
+    if name == "past":
+        return name, tuple(words[1:3])
+    return name, ()
+
+
+def build_router():
+    router = CommandRouter(default="help")
+    for name in ("help", "report", "updatemembers", "process", "resumejobs"):
+        router.register(name, None)
+    for name in ("stats", "post"):
+        router.register(name, None, [Arg("rest", REST, required=False)])
+    for name in ("here", "absent"):
+        router.register(name, None, [Arg("date", DATE, missing="", invalid=""), Arg("real_name", REST, missing="")])
+    router.register("ignore", None, [Arg("stop", FLAG), Arg("real_name", REST, missing="")])
+    router.register("past", None, [Arg("start", DATE, missing="", invalid=""),
+                                   Arg("end", DATE, required=False, invalid="")])
+    router.register("bankholiday", None, [Arg("date", DATE, missing="", invalid="")])
+    return router
+
+
+def main(iterations):
+    router = build_router()
+    print("{:<34} {:>12} {:>12}".format("text", "legacy (us)", "router (us)"))
+    for text in TEXTS:
+        old = timeit.timeit(lambda: legacy(text), number=iterations) / iterations * 1e6
+        new = timeit.timeit(lambda: router.parse(text), number=iterations) / iterations * 1e6
+        print("{:<34} {:>12.2f} {:>12.2f}".format(repr(text), old, new))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,72 @@
+# Compares entering attendance by hand one name per command (a timestamp lookup, a name
+# lookup and a commit each) with one command listing every name. Runs against DATABASE_URL
+# inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_entry.py 10 50 200
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+
+SCHEMA = "entry_bench"
+DATE = "31/10/16"
+TIMESTAMP = "1477908000"
+MEMBERS = 500
+
+
+def seed(db):
+    with dbutils.transaction(db) as cur:
+        cur.execute("DELETE FROM member_stats; DELETE FROM attendance; DELETE FROM posts; DELETE FROM members")
+        cur.execute("INSERT INTO members(slack_id, real_name, ignore) "
+                    "SELECT 'U' || lpad(i::text, 6, '0'), 'Member ' || i, FALSE FROM generate_series(0, %s) AS i",
+                    (MEMBERS - 1,))
+        cur.execute("INSERT INTO posts VALUES(%s, %s, %s)", (TIMESTAMP, DATE, "C0BENCH"))
+
+
+def one_by_one(bot, names):
+    for name in names:
+        ts = bot.get_timestamp(DATE)
+        bot.record_presence(bot.get_slack_id(name), ts)
+
+
+def listed(bot, names):
+    bot.record_attendance_by_name(bot.get_timestamp(DATE), names, True)
+
+
+def timed(bot, func, names):
+    seed(bot.db)
+    bot.update_attendance_table(TIMESTAMP)
+    bot.load_member_directory()
+    start = time.perf_counter()
+    func(bot, names)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from settings import config
+    bot = AttendanceBot(config)
+    bot.create_tables()
+    try:
+        print("{:>6} {:>16} {:>12} {:>8}".format("names", "one by one (s)", "listed (s)", "speedup"))
+        for n in sizes:
+            names = ["member {}".format(i) for i in range(n)]
+            slow = timed(bot, one_by_one, names)
+            fast = timed(bot, listed, names)
+            print("{:>6} {:>16.4f} {:>12.4f} {:>7.1f}x".format(n, slow, fast, slow / fast))
+    finally:
+        bot.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10, 50, 200])
@@ -0,0 +1,251 @@
+# Load test for the /attendance endpoint. Starts the Flask app on a local port with its
+# database in a scratch schema of DATABASE_URL and Slack replaced by a fake API server,
+# generates a workspace, then fires concurrent slash commands at it and writes latency
+# percentiles and throughput for each command to a JSON file, so runs from different
+# commits can be compared. The scratch schema is dropped afterwards.
+#
+#   python bench/bench_load.py --members 500 --posts 104 --reactions 300 --requests 200 --concurrency 8
+#
+# Background commands (process) run inline, so their timings are for the whole job.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import requests
+from werkzeug.serving import make_server
+
+import dbutils
+
+SCHEMA = "load_bench"
+FIRST_REHEARSAL = date(2010, 1, 4)  # a Monday
+SLASH_TOKEN = "bench-token"
+TEAM_ID = "TBENCH"
+CHANNEL = "CBENCH"
+ADMIN = "U000000"
+COMMANDS = ("here", "absent", "report", "process")
+
+
+def member_id(i):
+    return "U{:06d}".format(i)
+
+
+def rehearsal(week):
+    day = FIRST_REHEARSAL + timedelta(weeks=week)
+    return str(int(datetime(day.year, day.month, day.day, 9).timestamp())), day
+
+
+# A Slack Web API stand-in for the handful of methods the bot calls, answering for a
+# workspace of the given size. Every post has the same reactions, and every call takes
+# at least `delay` seconds.
+class FakeSlack(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, members, reactions, delay=0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeSlackHandler)
+        self.members = [{"id": member_id(i), "name": "member{}".format(i), "real_name": "Member {}".format(i),
+                         "deleted": False, "is_admin": i == 0} for i in range(members)]
+        reactors = [member_id(i) for i in range(min(reactions, members))]
+        self.reactions = [{"name": "thumbsup", "users": reactors[::2]},
+                          {"name": "thumbsdown", "users": reactors[1::2]}]
+        self.delay = delay
+        self.posted = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api/".format(self.server_address[1])
+
+    def answer(self, method, params):
+        if method == "users.list":
+            start = int(params.get("cursor") or 0)
+            end = start + int(params.get("limit", 200))
+            cursor = str(end) if end < len(self.members) else ""
+            return {"ok": True, "members": self.members[start:end], "response_metadata": {"next_cursor": cursor}}
+        if method == "users.info":
+            return {"ok": True, "user": {"id": params.get("user"), "is_admin": params.get("user") == ADMIN}}
+        if method == "reactions.get":
+            return {"ok": True, "message": {"reactions": self.reactions}}
+        if method == "chat.postMessage":
+            with self.lock:
+                self.posted += 1
+                ts = "{}.{:06d}".format(int(time.time()), self.posted)
+            return {"ok": True, "ts": ts, "channel": params.get("channel")}
+        return {"ok": True}
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        time.sleep(self.server.delay)
+        payload = json.dumps(self.server.answer(self.path.rsplit("/", 1)[-1], params)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def generate(db, members, posts, reactions):
+    with dbutils.transaction(db) as cur:
+        cur.execute("INSERT INTO members(slack_id, real_name, ignore, is_admin) "
+                    "SELECT 'U' || lpad(i::text, 6, '0'), 'Member ' || i, FALSE, i = 0 "
+                    "FROM generate_series(0, %s) AS i", (members - 1,))
+        dbutils.execute_values(cur, "INSERT INTO posts(post_timestamp, rehearsal_date, channel_id) VALUES %s",
+                               [rehearsal(week) + (CHANNEL,) for week in range(posts)])
+        # the first `reactions` members replied to every post, alternately present and absent
+        cur.execute("INSERT INTO attendance(slack_id, post_timestamp, present) "
+                    "SELECT m.slack_id, p.post_timestamp, "
+                    "CASE WHEN substr(m.slack_id, 2)::int >= %s THEN NULL ELSE substr(m.slack_id, 2)::int %% 2 = 0 END "
+                    "FROM members AS m, posts AS p", (reactions,))
+        cur.execute("ANALYZE")
+
+
+def command_text(command, posts, members):
+    if command in ("here", "absent"):
+        day = rehearsal(random.randrange(posts))[1]
+        return "{} {} Member {}".format(command, day.strftime("%d/%m/%y"), random.randrange(members))
+    return command
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run(url, command, requests_count, concurrency, posts, members):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def send(_):
+        data = {"token": SLASH_TOKEN, "team_id": TEAM_ID, "channel_id": CHANNEL, "user_id": ADMIN,
+                "command": "/attendance", "text": command_text(command, posts, members)}
+        start = time.perf_counter()
+        res = session.post(url, data=data)
+        elapsed = time.perf_counter() - start
+        failed = res.status_code != 200 or b"Sorry" in res.content
+        return elapsed, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests_count)))
+    wall = time.perf_counter() - start
+    latencies = sorted(elapsed for elapsed, _ in results)
+    return {
+        "requests": requests_count,
+        "errors": sum(1 for _, failed in results if failed),
+        "throughput_rps": requests_count / wall,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    random.seed(args.seed)
+    fake_slack = FakeSlack(args.members, args.reactions)
+    threading.Thread(target=fake_slack.serve_forever, daemon=True).start()
+
+    db = dbutils.connect_to_db()
+    # start from an empty schema, in case an earlier run was interrupted
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    # every connection opened from here on (including the app's) works inside the scratch schema
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    os.environ.update(SLACK_API_URL=fake_slack.url, SLASH_TOKEN=SLASH_TOKEN, SLACK_TEAM_ID=TEAM_ID,
+                      CHANNEL=CHANNEL, BOT_TOKEN="xoxb-bench", EMOJI_PRESENT="thumbsup", EMOJI_ABSENT="thumbsdown")
+    # migrate first, as the release phase would, so the app's outbox dispatcher finds its table
+    import migrations
+    scratch = dbutils.connect_to_db()
+    migrations.migrate(scratch)
+    scratch.close()
+    from settings import config
+    config.update({"scheduler-enabled": False, "async-commands": False})
+    import app
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    if not args.rate_limits:
+        # the fake server has no limits, so don't let the client-side token buckets dominate the timings
+        for bucket in app.get_bot().slack.buckets.values():
+            bucket.capacity = bucket.tokens = float("inf")
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/attendance".format(server.server_port)
+    try:
+        print("Generating {} members x {} posts, {} reactions per post...".format(args.members, args.posts,
+                                                                                 args.reactions))
+        generate(app.get_bot().db, args.members, args.posts, args.reactions)
+        app.get_bot().refresh_member_stats()
+        results = {}
+        for command in args.commands:
+            # one request first so caches are warm, as they would be in a long-running process
+            run(url, command, 1, 1, args.posts, args.members)
+            results[command] = run(url, command, args.requests, args.concurrency, args.posts, args.members)
+            print("{:<8} {:>8.1f} req/s  p50 {:>8.1f} ms  p95 {:>8.1f} ms  p99 {:>8.1f} ms  errors {}".format(
+                command, results[command]["throughput_rps"], results[command]["p50_ms"],
+                results[command]["p95_ms"], results[command]["p99_ms"], results[command]["errors"]))
+        report = {
+            "commit": git_commit(),
+            "time": datetime.utcnow().isoformat() + "Z",
+            "workspace": {"members": args.members, "posts": args.posts, "reactions": args.reactions},
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Wrote {}".format(args.output))
+    finally:
+        server.shutdown()
+        fake_slack.shutdown()
+        app.shutdown()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Load test the /attendance endpoint")
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=52, help="historical rehearsal posts")
+    parser.add_argument("--reactions", type=int, default=150, help="members reacting to each post")
+    parser.add_argument("--requests", type=int, default=200, help="requests per command")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--commands", type=lambda s: s.split(","), default=list(COMMANDS),
+                        help="comma separated, from " + ",".join(COMMANDS))
+    parser.add_argument("--rate-limits", action="store_true", help="keep Slack's rate limits in place")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", default="bench-load.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
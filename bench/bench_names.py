@@ -0,0 +1,108 @@
+# Compares looking up a typed name with the SQL equality query get_slack_id used to run
+# against the in-memory NameIndex, over a generated workspace. The SQL lookup only finds exact
+# names; the others are the typos and short forms that used to fall through to a members sync.
+# Runs against DATABASE_URL inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_names.py [members]
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+from names import NameIndex
+
+SCHEMA = "names_bench"
+FIRST = ["Beyoncé", "Chaka", "Kelly", "Michelle", "Robbie", "Ann", "Zoë", "José", "Siobhán", "Mary", "John",
+         "Aisha", "Wei", "Priya", "Tomás", "Olu", "Freya", "Oscar", "Nadia", "Ewan", "Grace", "Hamish"]
+LAST = ["Knowles", "Khan", "Rowland", "Williams", "O'Neill", "Smith", "Nguyen", "García", "Müller", "Patel",
+        "Okafor", "Brown", "MacDonald", "Kowalski", "Jones", "Fitzgerald", "Lindqvist", "Adeyemi"]
+SYLLABLES = ["ka", "ro", "lin", "ski", "son", "ber", "ta", "mi", "ova", "ez", "and", "er", "wood", "ham", "ne",
+             "ly", "ch", "ish", "ma", "dö", "gu", "sh", "ton", "vi", "ć"]
+SQL_LOOKUP = "SELECT slack_id FROM members WHERE real_name = %s"
+
+
+# first names repeat a lot, surnames much less
+def generate(n):
+    rng = random.Random(1)
+    names = set()
+    while len(names) < n:
+        surname = rng.choice(LAST) if rng.random() < 0.3 else "".join(
+            rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+        names.add("{} {}".format(rng.choice(FIRST), surname))
+    return [("U{:06d}".format(i), name) for i, name in enumerate(sorted(names))]
+
+
+def typo(name, rng):
+    chars = list(name)
+    i = rng.randrange(1, len(chars) - 1)
+    chars[i], chars[i + 1] = chars[i + 1], chars[i]
+    return "".join(chars)
+
+
+def queries(members):
+    rng = random.Random(2)
+    sample = [name for _, name in rng.sample(members, 200)]
+    return {
+        "exact": sample,
+        "lower case": [name.lower() for name in sample],
+        "first name": [name.split()[0] for name in sample],
+        "prefixes": [" ".join(word[:3] for word in name.split()) for name in sample],
+        "typo": [typo(name, rng) for name in sample],
+    }
+
+
+def timings(func, texts):
+    results = []
+    for text in texts:
+        start = time.perf_counter()
+        func(text)
+        results.append((time.perf_counter() - start) * 1e6)
+    results.sort()
+    return statistics.median(results), results[int(len(results) * 0.99) - 1]
+
+
+def main(n):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from settings import config
+    bot = AttendanceBot(config)
+    bot.create_tables()
+    try:
+        members = generate(n)
+        with dbutils.transaction(bot.db) as cur:
+            cur.executemany("INSERT INTO members(slack_id, real_name, ignore) VALUES(%s, %s, FALSE)", members)
+            cur.execute("ANALYZE")
+        index = NameIndex()
+        start = time.perf_counter()
+        for slack_id, name in members:
+            index.add(slack_id, name)
+        print("indexed {} members in {:.1f} ms".format(n, (time.perf_counter() - start) * 1000))
+
+        print("{:<12} {:>14} {:>14} {:>14} {:>14} {:>8} {:>8}".format(
+            "query", "SQL p50 (us)", "SQL p99 (us)", "index p50 (us)", "index p99 (us)", "SQL hit", "index"))
+        for label, texts in queries(members).items():
+            sql = timings(lambda text: dbutils.execute_fetchone(bot.db, SQL_LOOKUP, (text,)), texts)
+            fuzzy = timings(index.match, texts)
+            sql_hits = sum(1 for text in texts if dbutils.execute_fetchone(bot.db, SQL_LOOKUP, (text,)))
+            matches = [index.match(text) for text in texts]
+            # resolved to one member, or a short list to choose from
+            answered = sum(1 for match in matches if match.slack_id or match.candidates)
+            print("{:<12} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f} {:>8} {:>8}".format(
+                label, sql[0], sql[1], fuzzy[0], fuzzy[1], "{}%".format(sql_hits * 100 // len(texts)),
+                "{}%".format(answered * 100 // len(texts))))
+    finally:
+        bot.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
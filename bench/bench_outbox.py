@@ -0,0 +1,73 @@
+# Compares how long `/attendance post` keeps the caller waiting when it posts and reacts
+# straight away with how long it takes to queue the post in the outbox, against a fake Slack
+# that answers every call after a fixed delay. Also times the dispatcher draining the queue.
+# Runs against DATABASE_URL inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_outbox.py [runs] [slack delay in ms]
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+
+SCHEMA = "outbox_bench"
+
+
+class SlowSlack(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.posts = 0
+
+    def api_call(self, method, **kwargs):
+        time.sleep(self.delay)
+        if method == "chat.postMessage":
+            self.posts += 1
+            return {"ok": True, "ts": "{}.{:06d}".format(1477908000 + self.posts, self.posts),
+                    "channel": kwargs["channel"]}
+        return {"ok": True}
+
+
+def timed(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main(runs, delay):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from outbox import OutboxDispatcher, pending_count
+    from settings import config
+    bot = AttendanceBot(config)
+    bot.create_tables()
+    bot.slack.client = SlowSlack(delay / 1000.0)
+    dispatcher = OutboxDispatcher(lambda tenant, kind, payload: bot.deliver(kind, payload), config)
+    dispatcher.db = bot.db
+    try:
+        direct = timed(lambda: bot.post_message_with_reactions("bench"), runs)
+        queued = timed(lambda: bot.queue_post("bench"), runs)
+        start = time.perf_counter()
+        while pending_count(bot.db):
+            dispatcher.dispatch()
+        drained = (time.perf_counter() - start) * 1000
+        print("{:<28} {:>10.1f}".format("direct post (ms)", direct))
+        print("{:<28} {:>10.1f}".format("queued post (ms)", queued))
+        print("{:<28} {:>10.1f}".format("drain {} posts (ms)".format(runs), drained))
+    finally:
+        bot.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20, float(sys.argv[2]) if len(sys.argv) > 2 else 150)
@@ -0,0 +1,75 @@
+# Compares the per-row attendance write path against the bulk one used by process_with_ts.
+# Runs against DATABASE_URL inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_process.py 10 100 1000
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+
+SCHEMA = "attendance_bench"
+TIMESTAMP = "1477908000"
+
+
+def seed(db, n):
+    with dbutils.transaction(db) as cur:
+        cur.execute("DELETE FROM attendance; DELETE FROM posts; DELETE FROM members")
+        cur.executemany("INSERT INTO members VALUES(%s, %s, FALSE)",
+                        [("U{:06d}".format(i), "Member {}".format(i)) for i in range(n)])
+        cur.execute("INSERT INTO posts VALUES(%s, %s, %s)", (TIMESTAMP, "31/10/16", "C0BENCH"))
+
+
+def reactions(n):
+    return {"U{:06d}".format(i): i % 3 != 0 for i in range(n)}
+
+
+# the UPDATE and commit per reacting member that process_with_ts used to make. record_attendance
+# also refreshes the member's stats now, which process_with_ts does once for everyone instead,
+# so it would overstate the difference.
+def per_row(bot, attendance):
+    query = "UPDATE attendance SET present=(%s) WHERE tenant=(%s) AND slack_id=(%s) AND post_timestamp=(%s)"
+    for slack_id, present in attendance.items():
+        bot.execute_write(query, [present, bot.tenant, slack_id, TIMESTAMP])
+
+
+def bulk(bot, attendance):
+    bot.record_attendance_bulk(TIMESTAMP, attendance)
+
+
+def timed(bot, func, n):
+    seed(bot.db, n)
+    bot.update_attendance_table(TIMESTAMP)
+    attendance = reactions(n)
+    start = time.perf_counter()
+    func(bot, attendance)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("CREATE SCHEMA IF NOT EXISTS " + SCHEMA)
+    dbutils.commit_or_rollback(db)
+    # every connection opened from here on (including the bot's) works inside the scratch schema
+    os.environ["PGOPTIONS"] = "-c search_path=" + SCHEMA
+    from bot import AttendanceBot
+    from settings import config
+    bot = AttendanceBot(config)
+    bot.create_tables()
+    try:
+        print("{:>8} {:>12} {:>12} {:>8}".format("reactors", "per-row (s)", "bulk (s)", "speedup"))
+        for n in sizes:
+            slow = timed(bot, per_row, n)
+            fast = timed(bot, bulk, n)
+            print("{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x".format(n, slow, fast, slow / fast))
+    finally:
+        bot.db.close()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10, 100, 1000])
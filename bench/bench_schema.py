@@ -0,0 +1,120 @@
+# Times the report and lookup queries on the original varchar schema against the typed,
+# indexed schema from migration 2, over a generated multi-year dataset.
+# Runs against DATABASE_URL inside scratch schemas, which are dropped afterwards.
+#
+#   python bench/bench_schema.py [members] [years]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+import migrations
+
+LEGACY = "bench_legacy"
+TYPED = "bench_typed"
+REPEAT = 20
+FIRST_POST = 1262563200  # Monday 4th January 2010
+
+LEGACY_REPORT = ("SELECT DISTINCT m.real_name "
+                 "FROM (SELECT a.slack_id FROM attendance as a "
+                 "WHERE a.post_timestamp IN "
+                 "(SELECT p.post_timestamp FROM posts AS p "
+                 "ORDER BY p.post_timestamp DESC LIMIT 5) "
+                 "AND a.present IS NULL "
+                 "GROUP BY slack_id "
+                 "HAVING COUNT(slack_id) >= 4) "
+                 "AS Q NATURAL JOIN MEMBERS AS M")
+
+QUERIES = [
+    ("latest post", "SELECT post_timestamp, channel_id FROM posts ORDER BY post_timestamp DESC LIMIT 1",
+     "SELECT post_timestamp, channel_id FROM posts ORDER BY post_timestamp DESC LIMIT 1", ()),
+    ("timestamp for date", "SELECT post_timestamp FROM posts WHERE rehearsal_date = %s",
+     "SELECT post_timestamp FROM posts WHERE rehearsal_date = %s", ("04/01/16",)),
+    ("posts in date range",
+     "SELECT count(*) FROM posts WHERE to_date(rehearsal_date, 'DD/MM/YY') BETWEEN %s AND %s",
+     "SELECT count(*) FROM posts WHERE rehearsal_date BETWEEN %s AND %s", ("01/01/15", "31/12/15")),
+    ("member by name", "SELECT slack_id FROM members WHERE real_name = %s",
+     "SELECT slack_id FROM members WHERE real_name = %s", ("Member 42",)),
+    ("absence report", LEGACY_REPORT,
+     "SELECT m.real_name FROM member_stats AS s JOIN members AS m ON m.slack_id = s.slack_id "
+     "WHERE s.absence_streak >= 4 ORDER BY m.real_name", ()),
+]
+
+
+def use_schema(db, schema):
+    cur = db.cursor()
+    cur.execute("CREATE SCHEMA IF NOT EXISTS " + schema)
+    cur.execute("SET search_path TO " + schema)
+    dbutils.commit_or_rollback(db)
+
+
+def generate(db, members, years):
+    with dbutils.transaction(db) as cur:
+        cur.execute("INSERT INTO members SELECT 'U' || lpad(i::text, 6, '0'), 'Member ' || i, FALSE, FALSE "
+                    "FROM generate_series(1, %s) AS i", (members,))
+        cur.execute("INSERT INTO posts SELECT (%s + w * 604800)::text || '.000100', "
+                    "to_char(to_timestamp(%s + w * 604800), 'DD/MM/YY'), 'C0BENCH' "
+                    "FROM generate_series(0, %s) AS w", (FIRST_POST, FIRST_POST, years * 52 - 1))
+        cur.execute("INSERT INTO attendance SELECT m.slack_id, p.post_timestamp, "
+                    "CASE WHEN random() < 0.6 THEN TRUE WHEN random() < 0.5 THEN FALSE END "
+                    "FROM members AS m, posts AS p")
+        cur.execute("ANALYZE")
+
+
+def timed(db, query, args):
+    cur = db.cursor()
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        cur.execute(query, args)
+        cur.fetchall()
+    db.rollback()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main(members, years):
+    db = dbutils.connect_to_db()
+    try:
+        print("Generating {} members x {} weekly posts...".format(members, years * 52))
+        use_schema(db, LEGACY)
+        migrations.migrate(db, target=1)
+        generate(db, members, years)
+        use_schema(db, TYPED)
+        migrations.migrate(db, target=1)
+        generate(db, members, years)
+
+        start = time.perf_counter()
+        migrations.migrate(db)
+        print("Migration 2 took {:.2f}s".format(time.perf_counter() - start))
+
+        # the bot works out member_stats for the report when attendance is processed
+        os.environ["PGOPTIONS"] = "-c search_path=" + TYPED
+        from bot import AttendanceBot
+        from settings import config
+        bot = AttendanceBot(config)
+        start = time.perf_counter()
+        bot.refresh_member_stats()
+        print("Refreshing member_stats took {:.2f}s".format(time.perf_counter() - start))
+        bot.db.close()
+        dbutils.execute_and_commit(db, "ANALYZE")
+
+        print("{:<22} {:>14} {:>14}".format("query", "varchar (ms)", "typed (ms)"))
+        for name, legacy_query, typed_query, args in QUERIES:
+            use_schema(db, LEGACY)
+            before = timed(db, legacy_query, args)
+            use_schema(db, TYPED)
+            after = timed(db, typed_query, args)
+            print("{:<22} {:>14.3f} {:>14.3f}".format(name, before, after))
+    finally:
+        db.rollback()
+        cur = db.cursor()
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(LEGACY))
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(TYPED))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    args = [int(n) for n in sys.argv[1:]]
+    main(*(args + [500, 5][len(args):]))
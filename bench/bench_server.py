@@ -0,0 +1,122 @@
+# Compares concurrent request throughput of the Flask development server (the old
+# `python attendance-bot/app.py`, both single-threaded as older Flask ran it and threaded as
+# Flask 1.0+ does) with gunicorn started the way the Procfile does it.
+# Half the requests are reports, which only touch the database; the other half come from
+# people the bot hasn't seen before, so each one waits on a users.info call to a fake Slack
+# server that takes --slack-delay seconds to answer. Runs against DATABASE_URL inside a
+# scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_server.py --requests 160 --concurrency 16 --slack-delay 0.2
+#
+# Keep --requests under about 180: Slack allows 100 users.info calls a minute, and the
+# client-side rate limiter in each process enforces that even against the fake server.
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import requests
+
+import dbutils
+import migrations
+from bench_load import CHANNEL, FakeSlack, SLASH_TOKEN, TEAM_ID, percentile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCHEMA = "server_bench"
+PORT = 5123
+SERVERS = {
+    "flask-single": [sys.executable, "-c", "import os, sys; sys.path.insert(0, 'attendance-bot'); import app; "
+                     "app.app.run(port=int(os.environ['PORT']), threaded=False)"],
+    "flask": [sys.executable, "attendance-bot/app.py"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "--config", "attendance-bot/gunicorn.conf.py",
+                 "--chdir", "attendance-bot", "app:app"],
+}
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with status {}".format(process.returncode))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start within {}s".format(timeout))
+
+
+def drive(url, requests_count, concurrency):
+    newcomers = itertools.count()
+
+    def send(i):
+        text, user_id = ("report", "U000000") if i % 2 else ("post", "UNEW{:06d}".format(next(newcomers)))
+        data = {"token": SLASH_TOKEN, "team_id": TEAM_ID, "channel_id": CHANNEL, "user_id": user_id,
+                "command": "/attendance", "text": text}
+        start = time.perf_counter()
+        # a new connection each time, as Slack makes
+        res = requests.post(url, data=data, timeout=60)
+        return time.perf_counter() - start, res.status_code != 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(requests_count)))
+    wall = time.perf_counter() - start
+    latencies = sorted(elapsed for elapsed, _ in results)
+    return {"throughput_rps": requests_count / wall, "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000, "errors": sum(1 for _, failed in results if failed)}
+
+
+def main(args):
+    fake_slack = FakeSlack(1, 0, delay=args.slack_delay)
+    threading.Thread(target=fake_slack.serve_forever, daemon=True).start()
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    # what the release phase does before the servers start
+    migrations.migrate(db)
+    env = dict(os.environ, PGOPTIONS="-c search_path=" + SCHEMA, SLACK_API_URL=fake_slack.url, PORT=str(PORT),
+               SLASH_TOKEN=SLASH_TOKEN, SLACK_TEAM_ID=TEAM_ID, CHANNEL=CHANNEL, BOT_TOKEN="xoxb-bench",
+               WEB_CONCURRENCY=str(args.workers))
+    base_url = "http://127.0.0.1:{}/".format(PORT)
+    try:
+        print("{:<13} {:>10} {:>10} {:>10} {:>7}".format("server", "req/s", "p50 (ms)", "p99 (ms)", "errors"))
+        for name in args.servers:
+            process = subprocess.Popen(SERVERS[name], cwd=ROOT, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(base_url, process)
+                drive(base_url + "attendance", args.concurrency, args.concurrency)  # warm up every worker
+                result = drive(base_url + "attendance", args.requests, args.concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+            print("{:<13} {:>10.1f} {:>10.1f} {:>10.1f} {:>7}".format(name, result["throughput_rps"],
+                                                                         result["p50_ms"], result["p99_ms"],
+                                                                         result["errors"]))
+    finally:
+        fake_slack.shutdown()
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Compare request throughput of the dev server and gunicorn")
+    parser.add_argument("--requests", type=int, default=160)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--slack-delay", type=float, default=0.2, help="seconds each Slack call takes")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers (WEB_CONCURRENCY)")
+    parser.add_argument("--servers", type=lambda s: s.split(","), default=list(SERVERS),
+                        help="comma separated, from " + ",".join(SERVERS))
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,73 @@
+# Measures cold start: how long a fresh process takes to import the app and then answer its
+# first /attendance report. "eager" builds the bot, checks migrations and starts the scheduler
+# before serving, as the app used to; "lazy" builds everything on the first request; "warm" starts building in
+# the background straight after import, as the gunicorn workers do. Each run is a new
+# Python process. Runs against DATABASE_URL inside a scratch schema, which is dropped afterwards.
+#
+#   python bench/bench_startup.py [runs]
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attendance-bot'))
+
+import dbutils
+import migrations
+
+SCHEMA = "startup_bench"
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in a child process; prints the timings as JSON
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, 'attendance-bot')
+import app
+imported = time.perf_counter()
+if sys.argv[1] == 'eager':
+    import migrations
+    migrations.migrate(app.get_bot().db)
+    app.start_scheduler()
+ready = time.perf_counter()
+if sys.argv[1] == 'warm':
+    app.warm_up()
+res = app.app.test_client().post('/attendance', data={
+    'text': 'report', 'command': 'attendance', 'token': 'bench-token', 'team_id': 'TBENCH'})
+assert b'Sorry' not in res.data, res.data
+assert res.status_code == 200, res.status_code
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'ready': ready - start, 'first_request': done - ready,
+                  'total': done - start}))
+app.shutdown()
+"""
+
+
+def run(mode, env):
+    out = subprocess.check_output([sys.executable, "-c", CHILD, mode], cwd=ROOT, env=env)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main(runs):
+    db = dbutils.connect_to_db()
+    db.cursor().execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}".format(SCHEMA))
+    dbutils.commit_or_rollback(db)
+    migrations.migrate(db)
+    env = dict(os.environ, PGOPTIONS="-c search_path=" + SCHEMA, SLASH_TOKEN="bench-token", SLACK_TEAM_ID="TBENCH")
+    try:
+        print("{:<6} {:>12} {:>12} {:>16} {:>12}".format("mode", "import (ms)", "ready (ms)", "1st request (ms)",
+                                                        "total (ms)"))
+        for mode in ("eager", "lazy", "warm"):
+            results = [run(mode, env) for _ in range(runs)]
+            median = {key: statistics.median(result[key] for result in results) * 1000 for key in results[0]}
+            print("{:<6} {:>12.0f} {:>12.0f} {:>16.0f} {:>12.0f}".format(mode, median["import"], median["ready"],
+                                                                         median["first_request"], median["total"]))
+    finally:
+        db.cursor().execute("DROP SCHEMA {} CASCADE".format(SCHEMA))
+        dbutils.commit_or_rollback(db)
+        db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,116 @@
+from settings import config
+import unittest
+from unittest.mock import patch
+import numpy as np
+from bot import AttendanceBot
+from analytics import AttendanceMatrix, load_matrix, PRESENT as P, ABSENT as A, NO_REPLY as N, NOT_ASKED as X
+import dbutils
+
+
+def matrix(codes, dates=("2016-10-31", "2016-11-07", "2017-01-09", "2017-01-16")):
+    codes = np.array(codes, dtype=np.int8)
+    return AttendanceMatrix(["U{}".format(i) for i in range(len(codes))], ["Member {}".format(i) for i in range(len(codes))],
+                            [str(n) for n in range(codes.shape[1])], np.array(dates, dtype="datetime64[D]"), codes)
+
+
+class TestAttendanceMatrix(unittest.TestCase):
+    def setUp(self):
+        self.matrix = matrix([[P, P, A, P],
+                              [A, N, N, N],
+                              [X, X, P, P]])
+
+    def test_member_rates(self):
+        np.testing.assert_allclose(self.matrix.member_rates(), [0.75, 0.0, 1.0])
+        self.assertEqual(list(self.matrix.member_totals()["no_reply"]), [0, 3, 0])
+
+    def test_rolling_rates(self):
+        rates = self.matrix.rolling_rates(2)
+        np.testing.assert_allclose(rates[0], [1.0, 1.0, 0.5, 0.5])
+        np.testing.assert_allclose(rates[2], [np.nan, np.nan, 1.0, 1.0])
+
+    def test_turnout_and_trend(self):
+        present, asked = self.matrix.turnout()
+        self.assertEqual(list(present), [1, 1, 1, 2])
+        self.assertEqual(list(asked), [2, 2, 3, 3])
+        self.assertAlmostEqual(self.matrix.turnout_trend(4), 0.3)
+
+    def test_cohorts(self):
+        self.assertEqual(self.matrix.cohorts(2), [
+            {"year": 2016, "members": 2, "rate": 3 / 8, "active": 1},
+            {"year": 2017, "members": 1, "rate": 1.0, "active": 1},
+        ])
+
+    def test_member_summary(self):
+        self.assertEqual(self.matrix.member_summary("U0", 2),
+                         {"present": 3, "asked": 4, "no_reply": 0, "recent_present": 1, "recent_asked": 2,
+                          "previous_rate": 1.0})
+        self.assertTrue(np.isnan(self.matrix.member_summary("U2", 2)["previous_rate"]))
+        self.assertTrue(np.isnan(self.matrix.member_summary("U0", 4)["previous_rate"]))
+        self.assertIsNone(self.matrix.member_summary("U9", 2))
+
+
+class TestAnalytics(unittest.TestCase):
+    test_db = dbutils.connect_to_db()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bot = AttendanceBot(config)
+        cls.bot.create_tables()
+
+    def setUp(self):
+        cur = self.test_db.cursor()
+        cur.execute("INSERT INTO members VALUES('12345', 'Bobby Tables', FALSE), ('23456', 'Tobias Funke', FALSE)")
+        cur.execute("INSERT INTO posts VALUES('1477908000', '31/10/16', 'abc123'), "
+                    "('1478512800', '07/11/16', 'abc123')")
+        cur.execute("INSERT INTO attendance VALUES('12345', '1477908000', TRUE), ('23456', '1477908000', FALSE), "
+                    "('12345', '1478512800', NULL)")
+        dbutils.commit_or_rollback(self.test_db)
+        self.bot.refresh_member_stats()
+
+    def test_load_matrix(self):
+        loaded = load_matrix(self.bot.db, "")
+        self.assertEqual(loaded.slack_ids, ["12345", "23456"])
+        self.assertEqual(loaded.timestamps, ["1477908000", "1478512800"])
+        self.assertEqual(loaded.codes.tolist(), [[P, N], [A, X]])
+
+    def test_matrix_is_cached_until_attendance_changes(self):
+        first = self.bot.attendance_matrix()
+        self.assertIs(self.bot.attendance_matrix(), first)
+        self.bot.record_presence("12345", "1478512800")
+        second = self.bot.attendance_matrix()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.codes[0, 1], P)
+
+    def test_create_member_stats_message(self):
+        self.assertEqual(self.bot.create_member_stats_message("12345", "Bobby Tables"),
+                         "Bobby Tables has been at 1 of 2 rehearsals (50%), and 1 of the last 2. "
+                         "They didn't reply 1 times. :bar_chart:")
+
+    def test_member_stats_compare_windows(self):
+        with patch.dict(self.bot.settings, {"stats-window": 1}):
+            self.assertEqual(self.bot.create_member_stats_message("12345", "Bobby Tables"),
+                             "Bobby Tables has been at 1 of 2 rehearsals (50%), and 0 of the last 1 "
+                             "(0%, against 100% over the 1 before). They didn't reply 1 times. :bar_chart:")
+
+    def test_create_stats_message(self):
+        msg = self.bot.create_stats_message()
+        self.assertIn("Attendance over the last 8 rehearsals was 33%", msg)
+        self.assertIn("0 of 1 were at the last one (07/11/16)", msg)
+        self.assertIn("2016: 2 members, 33% attendance, 1 came in the last 8 weeks", msg)
+
+    def test_create_stats_message_nobody_asked(self):
+        dbutils.execute_and_commit(self.test_db, "delete from attendance")
+        msg = self.bot.create_stats_message()
+        self.assertIn("Attendance over the last 8 rehearsals was n/a", msg)
+        self.assertNotIn("nan", msg)
+
+    def tearDown(self):
+        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from posts; delete from members")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bot.db.close()
+        cur = cls.test_db.cursor()
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
+        dbutils.commit_or_rollback(cls.test_db)
+        cls.test_db.close()
@@ -1,8 +1,24 @@
 import unittest
 from unittest.mock import patch
+import threading
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime, timedelta
 import app
+import dbutils
+import jobs
+import scheduler
+from bot import ENTRY_DUPLICATE, ENTRY_NOT_FOUND, ENTRY_RECORDED, ENTRY_UNCHANGED
+from names import NameMatch
 import os
 class TestApp(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        app.get_bot().create_tables()  # other test modules drop the tables when they finish
+        app.start_scheduler()
+
     def setUp(self):
         self.app = app.app.test_client()
         self.token = os.environ.get('SLASH_TOKEN')
@@ -68,7 +84,37 @@ class TestApp(unittest.TestCase):
         })
         assert b"that date doesn\'t seem to match up" in res.data
 
-    def test_bankholiday_call_no_args(self):
+    @patch("app.AttendanceBot.record_presence")
+    @patch("app.AttendanceBot.record_attendance_by_name")
+    @patch("app.AttendanceBot.get_timestamp")
+    def test_process_attendance_list(self, mock_timestamp, mock_by_name, mock_presence):
+        mock_timestamp.return_value = "1477908000"
+        mock_by_name.return_value = [
+            ("beyonce", NameMatch("U1", "Beyonce Knowles"), ENTRY_RECORDED),
+            ("Kelly Rowland", NameMatch("U2", "Kelly Rowland"), ENTRY_UNCHANGED),
+            ("Beyonce Knowles", NameMatch("U1", "Beyonce Knowles"), ENTRY_DUPLICATE),
+            ("Chaka", NameMatch(candidates=[("U3", "Chaka Khan"), ("U4", "Chaka Demus")]), ENTRY_NOT_FOUND),
+            ("Foo Bar", NameMatch(), ENTRY_NOT_FOUND)]
+        res = self.app.post('/attendance', data={
+            'text': "here 31/10/16 beyonce, Kelly Rowland\nBeyonce Knowles,Chaka, Foo Bar,",
+            'command': "attendance",
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        mock_by_name.assert_called_with("1477908000", ["beyonce", "Kelly Rowland", "Beyonce Knowles", "Chaka",
+                                                       "Foo Bar"], True)
+        mock_presence.assert_not_called()
+        text = res.data.decode()
+        self.assertIn("on 31/10/16 for 2 of 5 names", text)
+        self.assertIn(":white_check_mark: Beyonce Knowles", text)
+        self.assertIn("Kelly Rowland was already marked present", text)
+        self.assertIn("Beyonce Knowles is already on the list", text)
+        self.assertIn("Chaka - did you mean `Chaka Khan` or `Chaka Demus`?", text)
+        self.assertIn("Foo Bar - I couldn't find anyone with that name", text)
+
+    @patch("app.AttendanceBot.is_admin", return_value=True)
+    def test_bankholiday_call_no_args(self, mock_admin):
         res = self.app.post('/attendance', data={
             'text': "bankholiday",
             'command': "attendance",
@@ -79,7 +125,8 @@ class TestApp(unittest.TestCase):
         assert b"Date needed!" in res.data
 
     @patch("app.AttendanceBot.pause_scheduled_jobs")
-    def test_bankholiday_call(self, mock_pause):
+    @patch("app.AttendanceBot.is_admin", return_value=True)
+    def test_bankholiday_call(self, mock_admin, mock_pause):
         mock_pause.return_value = True
         res = self.app.post('/attendance', data={
             'text': "bankholiday 31/10/16",
@@ -90,7 +137,8 @@ class TestApp(unittest.TestCase):
         })
         assert b"I have been paused until the week after 31/10/16" in res.data
 
-    def test_resume_job(self):
+    @patch("app.AttendanceBot.is_admin", return_value=True)
+    def test_resume_job(self, mock_admin):
         res = self.app.post('/attendance', data={
             'text': "resumejobs",
             'command': "attendance",
@@ -100,29 +148,99 @@ class TestApp(unittest.TestCase):
         })
         assert b"jobs resumed" in res.data
 
-    @patch("app.AttendanceBot.get_slack_id")
+    @patch("app.AttendanceBot.resume_scheduled_jobs")
+    @patch("app.AttendanceBot.pause_scheduled_jobs")
+    @patch("app.AttendanceBot.is_admin", return_value=False)
+    def test_scheduling_needs_admin(self, mock_admin, mock_pause, mock_resume):
+        for text in ("bankholiday 31/10/16", "resumejobs"):
+            res = self.app.post('/attendance', data={
+                'text': text,
+                'command': "attendance",
+                'token': self.token,
+                'team_id': self.team,
+                'method': ['POST']
+            })
+            assert b"you don't have permission" in res.data
+        mock_pause.assert_not_called()
+        mock_resume.assert_not_called()
+
+    def test_pause_and_resume_scheduled_jobs(self):
+        holiday = datetime.now() + timedelta(days=14)
+        app.get_bot().pause_scheduled_jobs(holiday.strftime("%d/%m/%y"))
+        for job in app.get_bot().scheduler.scheduler.get_jobs():
+            self.assertGreater(job.next_run_time.replace(tzinfo=None), holiday)
+        app.get_bot().resume_scheduled_jobs()
+        for job in app.get_bot().scheduler.scheduler.get_jobs():
+            self.assertLess(job.next_run_time.replace(tzinfo=None), datetime.now() + timedelta(days=8))
+
+    def test_job_edits_wake_the_leader(self):
+        job_scheduler = app.get_bot().scheduler
+        deadline = time.monotonic() + 5
+        while not job_scheduler.is_leader() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(job_scheduler.is_leader())
+        woken = threading.Event()
+        with patch.object(job_scheduler.scheduler, "wakeup", side_effect=woken.set):
+            # what notify_leader sends from a process that isn't the leader
+            conn = dbutils.connect_to_db()
+            conn.autocommit = True
+            conn.cursor().execute("NOTIFY " + scheduler.CHANGES_CHANNEL)
+            conn.close()
+            self.assertTrue(woken.wait(5))
+
+    @patch("app.AttendanceBot.find_member")
+    @patch("app.AttendanceBot.create_member_stats_message")
+    def test_stats_for_member(self, mock_stats, mock_find):
+        mock_find.return_value = NameMatch("12345", "Tobias Funke")
+        mock_stats.return_value = "Tobias Funke has been at 3 of 4 rehearsals"
+        res = self.app.post('/attendance', data={
+            'text': 'stats tobi',
+            'command': 'attendance',
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"has been at 3 of 4" in res.data
+        mock_find.assert_called_with("tobi")
+        mock_stats.assert_called_with("12345", "Tobias Funke")
+
+    @patch("app.AttendanceBot.find_member")
+    def test_stats_suggests_names(self, mock_find):
+        mock_find.return_value = NameMatch(candidates=[("U3", "Chaka Khan"), ("U4", "Chaka Demus")])
+        res = self.app.post('/attendance', data={
+            'text': 'stats Chaka',
+            'command': 'attendance',
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"Did you mean `Chaka Khan` or `Chaka Demus`?" in res.data
+        mock_find.assert_called_with("Chaka")
+
+    @patch("app.AttendanceBot.find_member")
     @patch("app.AttendanceBot.is_admin")
     @patch("app.AttendanceBot.set_ignore")
-    def test_set_ignore(self, mock_ignore, mock_admin, mock_slack_id):
+    def test_set_ignore(self, mock_ignore, mock_admin, mock_find):
         mock_admin.return_value = True
         mock_ignore.return_value = None
-        mock_slack_id.return_value = "12345"
+        mock_find.return_value = NameMatch("12345", "Tobias Funke")
         res = self.app.post('/attendance', data= {
-            'text': 'ignore Tobias Funke',
+            'text': 'ignore Tobi',
             'command': 'attendance',
             'token': self.token,
             'team_id': self.team,
             'method': ['POST']
         })
         assert b"Tobias Funke has been set to ignore = True" in res.data
+        mock_ignore.assert_called_with("12345", True)
 
-    @patch("app.AttendanceBot.get_slack_id")
+    @patch("app.AttendanceBot.find_member")
     @patch("app.AttendanceBot.is_admin")
     @patch("app.AttendanceBot.set_ignore")
-    def test_set_ignore_stop(self, mock_ignore, mock_admin, mock_slack_id):
+    def test_set_ignore_stop(self, mock_ignore, mock_admin, mock_find):
         mock_admin.return_value = True
         mock_ignore.return_value = None
-        mock_slack_id.return_value = "12345"
+        mock_find.return_value = NameMatch("12345", "Tobias Funke")
         res = self.app.post('/attendance', data={
             'text': 'ignore stop Tobias Funke',
             'command': 'attendance',
@@ -135,14 +253,253 @@ class TestApp(unittest.TestCase):
     @patch("app.AttendanceBot.is_admin")
     def test_check_admin_true(self, mock_admin):
         mock_admin.return_value = True
-        res = app.check_admin("12345", self.dummy_func)
+        res = app.check_admin(app.get_bot(), "12345", self.dummy_func)
         self.assertTrue(res)
 
     @patch("app.AttendanceBot.is_admin")
     def test_check_admin_false(self, mock_admin):
         mock_admin.return_value = False
-        res = app.check_admin("12345", self.dummy_func)
+        res = app.check_admin(app.get_bot(), "12345", self.dummy_func)
         assert "Sorry, you don't have permission" in res
 
+    @patch("jobs.post_delayed_response")
+    @patch("app.AttendanceBot.process_attendance")
+    @patch("app.AttendanceBot.is_admin")
+    def test_process_runs_in_background(self, mock_admin, mock_process, mock_post):
+        done = threading.Event()
+        mock_admin.return_value = True
+        mock_process.return_value = "Attendance processed!"
+        mock_post.side_effect = lambda url, text: done.set()
+        res = self.app.post('/attendance', data={
+            'text': 'process',
+            'command': 'attendance',
+            'token': self.token,
+            'team_id': self.team,
+            'response_url': 'https://hooks.slack.com/commands/1234',
+            'method': ['POST']
+        })
+        assert b"On it!" in res.data
+        self.assertTrue(done.wait(5))
+        mock_post.assert_called_with('https://hooks.slack.com/commands/1234', "Attendance processed!")
+
+    @patch("app.AttendanceBot.deliver")
+    @patch("app.AttendanceBot.is_admin")
+    def test_post_goes_through_outbox(self, mock_admin, mock_deliver):
+        done = threading.Event()
+        mock_admin.return_value = True
+        mock_deliver.side_effect = lambda kind, payload: done.set()
+        res = self.app.post('/attendance', data={
+            'text': 'post Bohemian Rhapsody',
+            'command': 'attendance',
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"OK, posting a message now." in res.data
+        self.assertTrue(done.wait(5))
+        kind, payload = mock_deliver.call_args[0]
+        self.assertEqual(kind, "post")
+        self.assertIn("Today we'll be doing *Bohemian Rhapsody*.", payload["text"])
+        self.assertEqual(payload["reactions"], ["thumbsup", "thumbsdown"])
+
+    def test_job_runner_rejects_duplicates(self):
+        release = threading.Event()
+        runner = jobs.JobRunner(1, 5)
+        with patch("jobs.post_delayed_response"):
+            self.assertEqual(runner.submit("process", "url", release.wait), jobs.ACCEPTED)
+            self.assertEqual(runner.submit("process", "url", release.wait), jobs.DUPLICATE)
+            release.set()
+            runner.shutdown()
+        self.assertFalse(runner.is_running("process"))
+
+    # each runner has its own pool, just as separate web processes would
+    def test_job_runners_share_dedupe(self):
+        started, release = threading.Event(), threading.Event()
+        pools = [dbutils.create_pool(app.config), dbutils.create_pool(app.config)]
+        first, second = jobs.JobRunner(1, 5, pools[0]), jobs.JobRunner(1, 5, pools[1])
+
+        def job():
+            started.set()
+            release.wait(5)
+            return "done"
+        with patch("jobs.post_delayed_response") as mock_post:
+            self.assertEqual(first.submit(("", "process"), "url", job), jobs.ACCEPTED)
+            self.assertTrue(started.wait(5))
+            second.submit(("", "process"), "url", lambda: "again")
+            second.submit(("tenors", "process"), "url", lambda: "tenors")
+            second.shutdown()
+            self.assertEqual([call[0][1] for call in mock_post.call_args_list],
+                             [jobs.JOB_RUNNING_ELSEWHERE, "tenors"])
+            release.set()
+            first.shutdown()
+            third = jobs.JobRunner(1, 5, pools[1])
+            third.submit(("", "process"), "url", lambda: "again")
+            third.shutdown()
+            mock_post.assert_called_with("url", "again")
+        self.assertEqual([pool.stats()["in_use"] for pool in pools], [0, 0])
+        for pool in pools:
+            pool.close()
+
+    def test_progress_reporter_posts_a_few_updates(self):
+        with patch("jobs.post_delayed_response") as mock_post:
+            progress = jobs.progress_reporter("url", "{done}/{total}")
+            for done in range(1, 11):
+                progress(done, 10)
+        self.assertEqual([call[0][1] for call in mock_post.call_args_list], ["3/10", "5/10", "8/10"])
+
+    @patch("app.AttendanceBot.backfill")
+    @patch("app.AttendanceBot.is_admin")
+    def test_past_with_two_dates_backfills(self, mock_admin, mock_backfill):
+        mock_admin.return_value = True
+        mock_backfill.return_value = "Backfill done!"
+        res = self.app.post('/attendance', data={
+            'text': 'past 04/09/17 18/12/17',
+            'command': 'attendance',
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"Backfill done!" in res.data
+        self.assertEqual(mock_backfill.call_args[0][:2], ("04/09/17", "18/12/17"))
+
+    @patch("app.EXPORT_TOKEN", "sekrit")
+    def test_export_needs_token(self):
+        self.assertEqual(self.app.get('/export').status_code, 401)
+        res = self.app.get('/export', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(res.status_code, 401)
+
+    @patch("app.EXPORT_TOKEN", "sekrit")
+    def test_export_csv(self):
+        res = self.app.get('/export?format=csv&from=01/01/99', headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.data, b"rehearsal_date,post_timestamp,channel_id,slack_id,real_name,present\r\n")
+
+    @patch("app.EXPORT_TOKEN", "sekrit")
+    def test_export_bad_date(self):
+        res = self.app.get('/export?from=1999-01-01', headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(res.status_code, 400)
+
+    @patch("app.AttendanceBot.create_absence_message")
+    def test_metrics(self, mock_attendance_msg):
+        mock_attendance_msg.return_value = "Nobody has been absent"
+        self.app.post('/attendance', data={'text': "report", 'command': "attendance", 'token': self.token,
+                                           'team_id': self.team, 'method': ['POST']})
+        res = self.app.get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'attendance_command_seconds_count{command="report"}', res.data)
+        self.assertIn(b'db_pool_in_use 0', res.data)
+        self.assertIn(b'members_fuzzy_hits{tenant=""}', res.data)
+        with patch("app.METRICS_TOKEN", "sekrit"):
+            self.assertEqual(self.app.get('/metrics').status_code, 401)
+            self.assertEqual(self.app.get('/metrics', headers={'Authorization': 'Bearer sekrit'}).status_code, 200)
+
+    def test_bot_is_built_once_on_first_use(self):
+        bot = app.get_bot()
+        with patch("app.tenants", None), patch("app.bot", None), patch("app.scheduler", None):
+            threads = [threading.Thread(target=app.get_tenants) for _ in range(4)]
+            with patch("app.AttendanceBot", return_value=bot) as mock_bot, \
+                    patch.dict(app.config, {"scheduler-enabled": False}):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertIs(app.get_bot(), bot)
+            self.assertEqual(mock_bot.call_count, 1)
+
+    @patch("app.AttendanceBot.record_attendance_by_name")
+    @patch("app.AttendanceBot.get_timestamp")
+    def test_names_containing_command_words(self, mock_timestamp, mock_by_name):
+        mock_timestamp.return_value = "1477908000"
+        mock_by_name.return_value = [("Report Postlethwaite", NameMatch("12345", "Report Postlethwaite"),
+                                      ENTRY_RECORDED)]
+        res = self.app.post('/attendance', data={
+            'text': "here 31/10/16 Report Postlethwaite",
+            'command': "attendance",
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"I have updated attendance for Report Postlethwaite on 31/10/16" in res.data
+        mock_by_name.assert_called_with("1477908000", ["Report Postlethwaite"], True)
+
+    @patch("app.AttendanceBot.record_attendance_by_name")
+    @patch("app.AttendanceBot.get_timestamp")
+    def test_single_name_not_found(self, mock_timestamp, mock_by_name):
+        mock_timestamp.return_value = "1477908000"
+        mock_by_name.return_value = [("Chaka", NameMatch(candidates=[("U3", "Chaka Khan")]), ENTRY_NOT_FOUND)]
+        res = self.app.post('/attendance', data={
+            'text': "absent 31/10/16 Chaka",
+            'command': "attendance",
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"Did you mean `Chaka Khan`?" in res.data
+        assert b"Thanks" not in res.data
+        mock_by_name.assert_called_with("1477908000", ["Chaka"], False)
+
+    @patch("app.AttendanceBot.record_attendance_by_name")
+    @patch("app.AttendanceBot.get_timestamp")
+    def test_single_name_replies_with_match(self, mock_timestamp, mock_by_name):
+        mock_timestamp.return_value = "1477908000"
+        mock_by_name.return_value = [("bob", NameMatch("U5", "Bob Loblaw"), ENTRY_RECORDED)]
+        res = self.app.post('/attendance', data={
+            'text': "here 31/10/16 bob",
+            'command': "attendance",
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"I have updated attendance for Bob Loblaw on 31/10/16" in res.data
+
+    @patch("app.AttendanceBot.is_admin", return_value=True)
+    def test_bankholiday_bad_date(self, mock_admin):
+        res = self.app.post('/attendance', data={
+            'text': "bankholiday 31/13/16",
+            'command': "attendance",
+            'token': self.token,
+            'team_id': self.team,
+            'method': ['POST']
+        })
+        assert b"that date doesn\'t seem to match up" in res.data
+
+    def post_event(self, payload, secret="secret"):
+        body = json.dumps(payload).encode()
+        timestamp = str(int(time.time()))
+        signature = "v0=" + hmac.new(secret.encode(), b"v0:" + timestamp.encode() + b":" + body,
+                                     hashlib.sha256).hexdigest()
+        with patch("app.SIGNING_SECRET", "secret"):
+            return self.app.post('/events', data=body, content_type='application/json', headers={
+                'X-Slack-Request-Timestamp': timestamp,
+                'X-Slack-Signature': signature
+            })
+
+    def test_events_url_verification(self):
+        res = self.post_event({"type": "url_verification", "challenge": "abc123"})
+        assert res.status_code == 200
+        self.assertEqual(res.get_json(), {"challenge": "abc123"})
+
+    def test_events_rejects_bad_signature(self):
+        res = self.post_event({"type": "url_verification", "challenge": "abc123"}, secret="wrong")
+        assert res.status_code == 403
+
+    @patch("app.reactions.put")
+    def test_events_queues_reactions(self, mock_put):
+        event = {"type": "reaction_added", "user": "12345", "reaction": "thumbsup",
+                 "item": {"type": "message", "channel": "abc123", "ts": "1477908000.000100"}}
+        res = self.post_event({"type": "event_callback", "event": event})
+        assert res.status_code == 200
+        mock_put.assert_called_with(event)
+
+    def test_reaction_queue_batches(self):
+        batches = []
+        queue = app.ReactionQueue(batches.append, 2, 0.05)
+        queue.start()
+        for n in range(3):
+            queue.put(n)
+        queue.stop()
+        self.assertEqual(batches, [[0, 1], [2]])
+
     def dummy_func(self, *args):
         return True
\ No newline at end of file
@@ -1,8 +1,11 @@
 from settings import config
+from datetime import date
 import unittest
 from unittest.mock import patch
-from bot import AttendanceBot
+from bot import AttendanceBot, ENTRY_DUPLICATE, ENTRY_NOT_FOUND, ENTRY_RECORDED, ENTRY_UNCHANGED
+from slackapi import SlackAPIError
 import dbutils
+import outbox
 
 
 class TestBot(unittest.TestCase):
@@ -20,6 +23,8 @@ class TestBot(unittest.TestCase):
         self.test_db.cursor().execute("INSERT INTO Attendance(slack_id, post_timestamp) VALUES(%s, %s)",
                                       ("12345", "1477908000"))
         dbutils.commit_or_rollback(self.test_db)
+        self.bot.members.clear()
+        self.bot.cache.clear()
 
     def test_init_func(self):
         self.assertEqual(self.bot.bot_name, "attendance-bot")
@@ -46,13 +51,49 @@ class TestBot(unittest.TestCase):
         expected_value = "27/10/16"
         mock_api_call.return_value = {"ts": "1477581478", "channel": "abc123"}
         self.bot.post_message("test_message")
-        query = "select rehearsal_date from posts where post_timestamp=(%s)"
+        query = "select to_char(rehearsal_date, 'DD/MM/YY') from posts where post_timestamp=(%s)"
         result = dbutils.execute_fetchone(self.test_db, query, (test_ts,))[0]
         self.assertEqual(result, expected_value)
 
+    @patch("bot.SlackClient.api_call")
+    def test_post_message_without_ts(self, mock_api_call):
+        mock_api_call.return_value = {"channel": "abc123"}
+        with self.assertRaises(SlackAPIError):
+            self.bot.post_message("test_message")
+
+    @patch("bot.SlackClient.api_call")
+    def test_queue_post(self, mock_api_call):
+        self.assertTrue(self.bot.queue_post("test_message", dedupe_key="post:27/10/16"))
+        self.assertFalse(self.bot.queue_post("test_message", dedupe_key="post:27/10/16"))
+        self.assertEqual(outbox.pending_count(self.test_db), 1)
+        mock_api_call.assert_not_called()
+
+    @patch("bot.SlackClient.api_call")
+    def test_deliver_post(self, mock_api_call):
+        mock_api_call.return_value = {"ts": "1477581478", "channel": "abc123"}
+        record = self.bot.deliver("post", {"text": "test_message", "reactions": ["thumbsup", "thumbsdown"]})
+        self.assertEqual(mock_api_call.call_args[0][0], "chat.postMessage")
+        with dbutils.transaction(self.bot.db) as cur:
+            record(cur)
+        query = "select to_char(rehearsal_date, 'DD/MM/YY') from posts where post_timestamp='1477581478'"
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query)[0], "27/10/16")
+        query = "SELECT kind, payload FROM outbox ORDER BY id"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query), [
+            ("react", {"channel": "abc123", "timestamp": "1477581478", "name": "thumbsup"}),
+            ("react", {"channel": "abc123", "timestamp": "1477581478", "name": "thumbsdown"}),
+        ])
+
+    @patch("bot.SlackClient.api_call")
+    def test_deliver_react(self, mock_api_call):
+        mock_api_call.return_value = {"ok": False, "error": "already_reacted"}
+        self.assertIsNone(self.bot.deliver("react", {"channel": "abc123", "timestamp": "1", "name": "thumbsup"}))
+        mock_api_call.return_value = {"ok": False, "error": "message_not_found"}
+        with self.assertRaises(SlackAPIError):
+            self.bot.deliver("react", {"channel": "abc123", "timestamp": "1", "name": "thumbsup"})
+
     def test_get_latest_post_data(self):
-        dbutils.execute_and_commit(self.test_db,"insert into posts values('1477908005', '30/10/16', 'abc123'), "
-                    "('1477908006', '32/10/16', 'abc123'), ('1477908007', '33/10/16', 'abc123')")
+        dbutils.execute_and_commit(self.test_db,"insert into posts values('1477908005', '24/10/16', 'abc123'), "
+                    "('1477908006', '17/10/16', 'abc123'), ('1477908007', '10/10/16', 'abc123')")
         expected_value = {"ts": "1477908007", "channel_id": "abc123"}
         result = self.bot.get_latest_post_data()
         self.assertEqual(result, expected_value)
@@ -91,11 +132,59 @@ class TestBot(unittest.TestCase):
         result = self.bot.get_slack_id("Buster Bluth")
         self.assertIsNone(result)
 
+    @patch("bot.SlackClient.api_call")
+    def test_get_slack_id_remembers_missing_names(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "234567", "real_name": "Bob Loblaw", "deleted": False}]}
+        self.assertIsNone(self.bot.get_slack_id("Buster Bluth"))
+        self.assertIsNone(self.bot.get_slack_id("Buster Bluth"))
+        self.assertEqual(mock_api_call.call_count, 1)
+        self.assertEqual(self.bot.members.stats()["negative_hits"], 1)
+
+    @patch("bot.SlackClient.api_call")
+    def test_get_slack_id_rate_limits_resyncs(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "234567", "real_name": "Bob Loblaw", "deleted": False}]}
+        self.assertIsNone(self.bot.get_slack_id("Buster Bluth"))
+        self.assertIsNone(self.bot.get_slack_id("Lucille Bluth"))
+        self.assertEqual(mock_api_call.call_count, 1)
+
+    @patch("bot.SlackClient.api_call")
+    def test_get_slack_id_close_names(self, mock_api_call):
+        self.assertEqual(self.bot.get_slack_id("bobby"), "12345")
+        self.assertEqual(self.bot.get_slack_id("Boby Tabels"), "12345")
+        self.assertEqual(mock_api_call.call_count, 0)
+        self.assertEqual(self.bot.members.stats()["fuzzy_hits"], 2)
+
+    @patch("bot.SlackClient.api_call")
+    def test_find_member_suggests_names(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False},
+                                                  {"id": "234567", "real_name": "Bobby Brown", "deleted": False}]}
+        self.bot.update_members()
+        match = self.bot.find_member("Bobby")
+        self.assertIsNone(match.slack_id)
+        self.assertEqual(match.candidates, [("234567", "Bobby Brown"), ("12345", "Bobby Tables")])
+        self.assertEqual(self.bot.suggest_members("Bobby T"), [])
+        self.assertEqual(self.bot.find_member("Bobby T").real_name, "Bobby Tables")
+
+    def test_get_slack_id_served_from_cache(self):
+        self.bot.get_slack_id("Bobby Tables")
+        self.assertEqual(self.bot.get_slack_id("Bobby Tables"), "12345")
+        self.assertEqual(self.bot.members.stats()["hits"], 2)
+
     def test_get_timestamp(self):
         expected_value = "1477908000"
         result = self.bot.get_timestamp("31/10/16")
         self.assertEqual(result, expected_value)
 
+    def test_get_timestamp_malformed_date(self):
+        result = self.bot.get_timestamp("2016-10-31")
+        self.assertIsNone(result)
+
+    def test_create_tables_is_idempotent(self):
+        self.bot.create_tables()
+        query = "select data_type from information_schema.columns where table_name = 'posts' and column_name = (%s)"
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query, ("post_timestamp",)), ("numeric",))
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query, ("rehearsal_date",)), ("date",))
+
     def test_get_timestamp_bad_ts(self):
         result = self.bot.get_timestamp("32/10/16")
         self.assertIsNone(result)
@@ -114,9 +203,34 @@ class TestBot(unittest.TestCase):
                                                   {"id": "345678", "real_name": "Michael Bluth", "deleted": False},
                                                   {"id": "101011", "real_name": "GOB Bluth", "deleted": True}]}
         self.bot.update_members()
-        result = dbutils.execute_fetchall(self.test_db, "select slack_id from members")
+        result = dbutils.execute_fetchall(self.test_db, "select slack_id from members order by slack_id")
         self.assertEqual(result, expected_value)
 
+    @patch("bot.SlackClient.api_call")
+    def test_update_members_paginates(self, mock_api_call):
+        mock_api_call.side_effect = [
+            {"members": [{"id": "234567", "real_name": "Bob Loblaw", "deleted": False}],
+             "response_metadata": {"next_cursor": "page2"}},
+            {"members": [{"id": "345678", "real_name": "Michael Bluth", "deleted": False}],
+             "response_metadata": {"next_cursor": ""}}]
+        self.bot.update_members()
+        self.assertEqual(mock_api_call.call_count, 2)
+        self.assertEqual(mock_api_call.call_args[1]["cursor"], "page2")
+        result = dbutils.execute_fetchall(self.test_db, "select slack_id from members order by slack_id")
+        self.assertEqual(result, [("12345",), ("234567",), ("345678",)])
+
+    @patch("bot.SlackClient.api_call")
+    def test_update_members_only_writes_changes(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False},
+                                                  {"id": "234567", "real_name": "Bob Loblaw", "deleted": False}]}
+        result = self.bot.update_members()
+        self.assertEqual((result["inserted"], result["updated"], result["deleted"]), (1, 0, 0))
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Robert Tables", "deleted": False},
+                                                  {"id": "234567", "real_name": "Bob Loblaw", "deleted": True}]}
+        result = self.bot.update_members()
+        self.assertEqual((result["inserted"], result["updated"], result["deleted"]), (0, 1, 1))
+        self.assertEqual(self.bot.get_slack_id("Robert Tables"), "12345")
+
     def test_record_presence(self):
         expected_value = True
         self.bot.record_presence("12345", "1477908000")
@@ -132,11 +246,103 @@ class TestBot(unittest.TestCase):
 
         self.assertEqual(result, expected_value)
 
+    def test_record_attendance_bulk(self):
+        expected_value = [("12345", False), ("23456", True), ("34567", None)]
+        dbutils.execute_and_commit(self.test_db, "insert into members values ('23456', 'Tobias Funke', FALSE ),('34567', 'GOB Bluth', FALSE)")
+        self.bot.update_attendance_table("1477908000")
+        self.bot.record_attendance_bulk("1477908000", {"12345": False, "23456": True, "99999": True})
+        query = "select slack_id, present from attendance where post_timestamp = '1477908000' order by slack_id"
+        result = dbutils.execute_fetchall(self.test_db, query)
+        self.assertEqual(result, expected_value)
+
+    @patch("bot.SlackClient.api_call")
+    def test_record_attendance_by_name(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False},
+                                                  {"id": "23456", "real_name": "Tobias Funke", "deleted": False},
+                                                  {"id": "34567", "real_name": "GOB Bluth", "deleted": False}]}
+        self.bot.update_members()
+        self.bot.update_attendance_table("1477908000")
+        self.bot.record_presence("23456", "1477908000")
+        mock_api_call.reset_mock()
+        results = self.bot.record_attendance_by_name("1477908000", ["bobby", "Tobias Funke", "Gob", "Bobby Tables",
+                                                                    "Buster Bluth"], True)
+        self.assertEqual([(real_name, match.slack_id, status) for real_name, match, status in results],
+                         [("bobby", "12345", ENTRY_RECORDED), ("Tobias Funke", "23456", ENTRY_UNCHANGED),
+                          ("Gob", "34567", ENTRY_RECORDED), ("Bobby Tables", "12345", ENTRY_DUPLICATE),
+                          ("Buster Bluth", None, ENTRY_NOT_FOUND)])
+        # one members sync checks the guesses and the name nobody matched
+        self.assertEqual(mock_api_call.call_count, 1)
+        query = "select slack_id, present from attendance where post_timestamp = '1477908000' order by slack_id"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query),
+                         [("12345", True), ("23456", True), ("34567", True)])
+        query = "select slack_id, present_total from member_stats order by slack_id"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query), [("12345", 1), ("23456", 1), ("34567", 1)])
+
+    @patch("bot.SlackClient.api_call")
+    def test_record_attendance_by_name_checks_guesses(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False},
+                                                  {"id": "23456", "real_name": "Bobby Tabler", "deleted": False}]}
+        self.bot.update_attendance_table("1477908000")
+        # the members sync has been used up, so the guess isn't written
+        self.bot.members.claim_resync()
+        results = self.bot.record_attendance_by_name("1477908000", ["Bobby Tabler"], True)
+        [(_, match, status)] = results
+        self.assertEqual((match.slack_id, match.candidates, status),
+                         (None, [("12345", "Bobby Tables")], ENTRY_NOT_FOUND))
+        mock_api_call.assert_not_called()
+        self.assertEqual(self.bot.get_slack_id("Bobby Tabler"), "12345")
+        # a sync finds the new member the name really belongs to
+        self.bot.members.last_resync = None
+        results = self.bot.record_attendance_by_name("1477908000", ["Bobby Tabler"], True)
+        self.assertEqual([(match.slack_id, status) for _, match, status in results], [("23456", ENTRY_RECORDED)])
+        query = "select slack_id, present from attendance where post_timestamp = '1477908000' order by slack_id"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query), [("12345", None), ("23456", True)])
+
+    def test_record_attendance_by_name_without_attendance_row(self):
+        dbutils.execute_and_commit(self.test_db, "insert into members values ('23456', 'Tobias Funke', FALSE)")
+        results = self.bot.record_attendance_by_name("1477908000", ["Tobias Funke"], False)
+        self.assertEqual([(match.slack_id, status) for _, match, status in results], [("23456", ENTRY_RECORDED)])
+        query = "select present from attendance where slack_id = '23456' and post_timestamp = '1477908000'"
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query), (False,))
+        # deleted after the directory was loaded
+        dbutils.execute_and_commit(self.test_db, "delete from attendance where slack_id = '23456'; "
+                                                 "delete from member_stats; delete from members where slack_id = '23456'")
+        results = self.bot.record_attendance_by_name("1477908000", ["Tobias Funke"], True)
+        self.assertEqual([status for _, _, status in results], [ENTRY_NOT_FOUND])
+
+    def reaction_event(self, event_type, user, reaction, ts="1477908000"):
+        return {"type": event_type, "user": user, "reaction": reaction,
+                "item": {"type": "message", "channel": "abc123", "ts": ts}}
+
+    def test_apply_reaction_events(self):
+        expected_value = [("12345", None), ("23456", False), ("34567", True)]
+        dbutils.execute_and_commit(self.test_db, "insert into members values ('23456', 'Tobias Funke', FALSE ),"
+                                                 "('34567', 'GOB Bluth', FALSE), ('45678', 'Buster Bluth', TRUE)")
+        self.bot.record_presence("12345", "1477908000")
+        self.bot.apply_reaction_events([
+            self.reaction_event("reaction_removed", "12345", "thumbsup"),
+            self.reaction_event("reaction_added", "23456", "thumbsup"),
+            self.reaction_event("reaction_added", "23456", "thumbsdown"),
+            self.reaction_event("reaction_added", "34567", "thumbsup"),
+            self.reaction_event("reaction_added", "34567", "tada"),
+            self.reaction_event("reaction_added", "45678", "thumbsup"),
+            self.reaction_event("reaction_added", "34567", "thumbsup", ts="999"),
+        ])
+        query = "select slack_id, present from attendance where post_timestamp = '1477908000' order by slack_id"
+        result = dbutils.execute_fetchall(self.test_db, query)
+        self.assertEqual(result, expected_value)
+
+    def test_apply_reaction_events_keeps_other_reaction(self):
+        self.bot.record_absence("12345", "1477908000")
+        self.bot.apply_reaction_events([self.reaction_event("reaction_removed", "12345", "thumbsup")])
+        query = "select present from attendance where slack_id = '12345' and post_timestamp = '1477908000'"
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query), (False,))
+
     def test_update_attendance_table(self):
         expected_value = [("12345",), ("23456",), ("34567",)]
         dbutils.execute_and_commit(self.test_db, "insert into members values ('23456', 'Tobias Funke', FALSE ),('34567', 'GOB Bluth', FALSE)")
         self.bot.update_attendance_table("1477908000")
-        result = dbutils.execute_fetchall(self.test_db, "select slack_id from attendance where post_timestamp = '1477908000'")
+        result = dbutils.execute_fetchall(self.test_db, "select slack_id from attendance where post_timestamp = '1477908000' order by slack_id")
         self.assertEqual(result, expected_value)
 
     def test_get_absent_names(self):
@@ -147,6 +353,43 @@ class TestBot(unittest.TestCase):
         assert "Buster Bluth" in result
         assert len(result) is 4
 
+    def test_ignored_members_left_out_of_absence_report(self):
+        self.set_up_db_for_absence_tests()
+        self.bot.set_ignore("45678", True)
+        result = self.bot.get_absent_names()
+        assert "Buster Bluth" not in result
+        assert "Tobias Funke" in result
+        assert "Buster Bluth" not in self.bot.create_absence_message()
+
+    def test_refresh_member_stats(self):
+        self.set_up_db_for_absence_tests()
+        query = ("select absence_streak, last_present_date, present_total, absent_total, no_reply_total "
+                 "from member_stats where slack_id = (%s)")
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query, ("12345",)), (0, date(2016, 11, 25), 3, 1, 1))
+        self.assertEqual(dbutils.execute_fetchone(self.test_db, query, ("45678",)), (4, date(2016, 10, 31), 1, 0, 4))
+
+    def test_record_attendance_updates_streak(self):
+        self.set_up_db_for_absence_tests()
+        self.bot.record_presence("45678", "1497908000")
+        result = self.bot.get_absent_names()
+        assert "Buster Bluth" not in result
+        assert "Tobias Funke" in result
+
+    def test_absence_report_is_cached_until_data_changes(self):
+        self.set_up_db_for_absence_tests()
+        first = self.bot.create_absence_message()
+        self.assertEqual(self.bot.create_absence_message(), first)
+        self.assertEqual(self.bot.cache.stats()["absence-report"], {"hits": 1, "misses": 1, "hit_rate": 0.5})
+        self.bot.set_ignore("56789", True)
+        self.bot.create_absence_message()
+        self.assertEqual(self.bot.cache.stats()["absence-report"]["misses"], 2)
+
+    def test_writes_bump_data_version(self):
+        before = self.bot.data_version()
+        self.bot.record_presence("12345", "1477908000")
+        self.bot.record_attendance_bulk("1477908000", {"12345": False})
+        self.assertEqual(self.bot.data_version(), before + 3)
+
     def test_get_absent_names_none(self):
         result = self.bot.get_absent_names()
         assert len(result) is 0
@@ -195,17 +438,63 @@ class TestBot(unittest.TestCase):
         result = cur.fetchall()
         self.assertEqual(result, expected_value)
 
+    @patch("bot.SlackClient.api_call")
+    def test_backfill(self, mock_api_call):
+        reactions = {"1477908000": [{"name": "thumbsup", "users": ["12345", "23456"]}],
+                     "1478512800": [{"name": "thumbsdown", "users": ["23456"]}]}
+
+        def api_call(method, channel, timestamp):
+            if timestamp not in reactions:
+                return {"ok": False, "error": "message_not_found"}
+            return {"ok": True, "message": {"reactions": reactions[timestamp]}}
+
+        mock_api_call.side_effect = api_call
+        progress = []
+        dbutils.execute_and_commit(self.test_db, "insert into members values ('23456', 'Tobias Funke', FALSE)")
+        dbutils.execute_and_commit(self.test_db, "insert into posts values ('1478512800', '07/11/16', 'abc123'), "
+                                                 "('1479117600', '14/11/16', 'abc123'), "
+                                                 "('1479722400', '21/11/16', 'abc123')")
+        with patch.dict(self.bot.settings, {"backfill-batch-size": 2}):
+            res = self.bot.backfill("14/11/16", "31/10/16", lambda done, total: progress.append((done, total)))
+        self.assertEqual(res, "Backfill done! I processed 2 rehearsals between 14/11/16 and 31/10/16: "
+                              "2 present and 1 absences. I couldn't read 1 of the posts from Slack, so they were skipped.")
+        self.assertEqual(progress, [(2, 3), (3, 3)])
+        query = "select slack_id, post_timestamp::text, present from attendance order by post_timestamp, slack_id"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query),
+                         [("12345", "1477908000", True), ("23456", "1477908000", True),
+                          ("23456", "1478512800", False)])
+
+    def test_backfill_bad_date(self):
+        self.assertIsNone(self.bot.backfill("31/10/16", "31/13/16"))
+
     @patch("bot.SlackClient.api_call")
     def test_is_admin_true(self, mock_api_call):
-        mock_api_call.return_value = {"user": {"id": "U023BECGF", "name": "bobby", "is_admin": True}}
+        dbutils.execute_and_commit(self.test_db, "update members set is_admin = TRUE where slack_id = '12345'")
         result = self.bot.is_admin("12345")
         self.assertTrue(result)
+        mock_api_call.assert_not_called()
 
     @patch("bot.SlackClient.api_call")
     def test_is_admin_false(self, mock_api_call):
-        mock_api_call.return_value = {"user": {"id": "U023BECGF", "name": "bobby", "is_admin": False}}
         result = self.bot.is_admin("12345")
         self.assertFalse(result)
+        mock_api_call.assert_not_called()
+
+    @patch("bot.SlackClient.api_call")
+    def test_is_admin_unknown_member(self, mock_api_call):
+        mock_api_call.return_value = {"user": {"id": "U023BECGF", "name": "bobby", "is_admin": True}}
+        self.assertTrue(self.bot.is_admin("U023BECGF"))
+        self.assertTrue(self.bot.is_admin("U023BECGF"))
+        self.assertEqual(mock_api_call.call_count, 1)
+
+    @patch("bot.SlackClient.api_call")
+    def test_update_members_stores_admins(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False,
+                                                   "is_admin": True}]}
+        self.bot.update_members()
+        result = dbutils.execute_fetchone(self.test_db, "select is_admin from members where slack_id = '12345'")[0]
+        self.assertTrue(result)
+        self.assertTrue(self.bot.is_admin("12345"))
 
     def test_set_ignore(self):
         test_id = "12345"
@@ -233,14 +522,16 @@ class TestBot(unittest.TestCase):
                          (True, '34567', '1487908000'), (False, '56789', '1487908000'),
                          (True, '12345', '1497908000'), (True, '34567', '1497908000'), (False, '56789', '1497908000')))
         dbutils.commit_or_rollback(self.test_db)
+        self.bot.refresh_member_stats()
 
     def tearDown(self):
-        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from posts; delete from members")
+        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from posts; delete from members; "
+                                                 "delete from outbox")
 
     @classmethod
     def tearDownClass(cls):
         cls.bot.db.close()
         cur = cls.test_db.cursor()
-        cur.execute("DROP TABLE Members, Posts, Attendance")
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
         dbutils.commit_or_rollback(cls.test_db)
         cls.test_db.close()
@@ -0,0 +1,168 @@
+from settings import config
+import time
+import unittest
+from unittest.mock import patch
+from bot import AttendanceBot
+from bus import InvalidationBus, CHANNEL, DATA, MEMBERS, POSTS
+import dbutils
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestBus(unittest.TestCase):
+    test_db = dbutils.connect_to_db()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bus = InvalidationBus(dict(config, **{"bus-reconnect-interval": 0.05}))
+        cls.bus.start()
+        cls.bot = AttendanceBot(config, bus=cls.bus)
+        cls.bot.create_tables()
+        cls.bus.listening.wait(5)
+
+    def setUp(self):
+        cur = self.test_db.cursor()
+        cur.execute("INSERT INTO members VALUES('12345', 'Bobby Tables')")
+        cur.execute("INSERT INTO posts VALUES('1477908000', '31/10/16', 'abc123')")
+        dbutils.commit_or_rollback(self.test_db)
+        self.settle()
+        self.bot.members.clear()
+        self.bot.cache.clear()
+
+    # Wait for the bus to hear about everything committed so far. Notifications arrive in
+    # commit order, so once one sent now has arrived, so have all the earlier ones.
+    def settle(self):
+        before = self.bus.generation("test", "settle")
+        dbutils.execute_and_commit(self.test_db, "SELECT pg_notify(%s, 'test:settle')", (CHANNEL,))
+        self.assertTrue(wait_for(lambda: self.bus.generation("test", "settle") != before))
+
+    # a write from another connection, once its notification has arrived
+    def external_write(self, query, tenant="", topic=POSTS):
+        before = self.bus.generation(tenant, topic)
+        dbutils.execute_and_commit(self.test_db, query)
+        self.settle()
+        self.assertNotEqual(self.bus.generation(tenant, topic), before)
+
+    def test_notifications_count_changes(self):
+        members = self.bus.generation("", MEMBERS)
+        tenors = self.bus.generation("tenors", POSTS)
+        self.external_write("INSERT INTO posts VALUES('1478512800', '07/11/16', 'abc123')")
+        self.assertEqual(self.bus.generation("", MEMBERS), members)
+        self.assertEqual(self.bus.generation("tenors", POSTS), tenors)
+        self.external_write("DELETE FROM members WHERE slack_id = '12345'", topic=MEMBERS)
+        self.external_write("INSERT INTO data_versions VALUES('tenors', 1)", tenant="tenors", topic=DATA)
+
+    def test_reconnect_starts_new_epoch(self):
+        before = self.bus.generation("", POSTS)
+        self.bus.listening.clear()
+        pid = self.bus.conn.get_backend_pid()
+        dbutils.execute_and_commit(self.test_db, "SELECT pg_terminate_backend(%s)", (pid,))
+        self.assertTrue(self.bus.listening.wait(5))
+        after = self.bus.generation("", POSTS)
+        self.assertIsNotNone(after)
+        self.assertNotEqual(after, before)
+
+    def test_posts_from_memory(self):
+        self.assertEqual(self.bot.get_timestamp("31/10/16"), "1477908000")
+        with patch("dbutils.execute_fetchall") as mock_fetchall, patch("dbutils.execute_fetchone") as mock_fetchone:
+            self.assertEqual(self.bot.get_timestamp("31/10/16"), "1477908000")
+            self.assertIsNone(self.bot.get_timestamp("07/11/16"))
+            self.assertEqual(self.bot.get_latest_post_data(), {"ts": "1477908000", "channel_id": "abc123"})
+            mock_fetchall.assert_not_called()
+            mock_fetchone.assert_not_called()
+        self.external_write("INSERT INTO posts VALUES('1478512800', '07/11/16', 'def456')")
+        self.assertEqual(self.bot.get_timestamp("07/11/16"), "1478512800")
+        self.assertEqual(self.bot.get_latest_post_data(), {"ts": "1478512800", "channel_id": "def456"})
+
+    @patch("bot.SlackClient.api_call")
+    def test_own_post_seen_straight_away(self, mock_api_call):
+        self.assertIsNone(self.bot.get_timestamp("07/11/16"))
+        mock_api_call.return_value = {"ts": "1478512800", "channel": "abc123"}
+        self.bot.post_message("test_message")
+        self.assertEqual(self.bot.get_timestamp("07/11/16"), "1478512800")
+
+    def test_members_reloaded_on_change(self):
+        self.assertEqual(self.bot.get_slack_id("Bobby Tables"), "12345")
+        with patch("dbutils.execute_fetchall") as mock_fetchall:
+            self.assertEqual(self.bot.get_slack_id("Bobby Tables"), "12345")
+            mock_fetchall.assert_not_called()
+        self.external_write("UPDATE members SET real_name = 'Robert Tables' WHERE slack_id = '12345'",
+                            topic=MEMBERS)
+        self.assertEqual(self.bot.get_slack_id("Robert Tables"), "12345")
+
+    @patch("bot.SlackClient.api_call")
+    def test_member_sync_keeps_directory_current(self, mock_api_call):
+        mock_api_call.return_value = {"members": [{"id": "12345", "real_name": "Bobby Tables", "deleted": False},
+                                                  {"id": "23456", "real_name": "Tobias Funke", "deleted": False}]}
+        self.bot.load_member_directory()
+        self.bot.update_members()
+        # the sync's own notification coming back doesn't undo it
+        self.settle()
+        self.assertFalse(self.bot.members_stale())
+        with patch("dbutils.execute_fetchall") as mock_fetchall:
+            self.assertEqual(self.bot.get_slack_id("Tobias Funke"), "23456")
+            mock_fetchall.assert_not_called()
+        self.external_write("UPDATE members SET real_name = 'Robert Tables' WHERE slack_id = '12345'",
+                            topic=MEMBERS)
+        self.assertTrue(self.bot.members_stale())
+
+    def test_own_write_with_changes_from_elsewhere(self):
+        seen = self.bus.generation("", MEMBERS)
+        self.bus.received(":" + MEMBERS)
+        self.assertIsNone(self.bus.own_write("", MEMBERS, seen))
+        self.assertIsNone(self.bus.own_write("", MEMBERS, None))
+
+    def test_set_ignore_skips_no_change(self):
+        self.bot.load_member_directory()
+        self.bot.set_ignore("12345", True)
+        self.assertTrue(self.bot.members.is_ignored("12345"))
+        self.assertTrue(self.bot.members_stale())
+        self.settle()
+        self.bot.load_member_directory()
+        with patch("dbutils.execute_and_commit") as mock_write:
+            self.bot.set_ignore("12345", True)
+            mock_write.assert_not_called()
+        self.external_write("UPDATE members SET ignore = FALSE WHERE slack_id = '12345'", topic=MEMBERS)
+        self.bot.set_ignore("12345", True)
+        query = "SELECT ignore FROM members WHERE slack_id = '12345'"
+        self.assertTrue(dbutils.execute_fetchone(self.test_db, query)[0])
+
+    def test_absence_report_without_version_check(self):
+        self.bot.create_absence_message()
+        with patch("bot.AttendanceBot.data_version") as mock_version:
+            self.bot.create_absence_message()
+            mock_version.assert_not_called()
+        self.assertEqual(self.bot.cache.stats()["absence-report"]["hits"], 1)
+        self.bot.record_presence("12345", "1477908000")
+        self.bot.create_absence_message()
+        self.assertEqual(self.bot.cache.stats()["absence-report"]["misses"], 2)
+
+    def test_falls_back_to_postgres(self):
+        with patch.object(self.bus, "live", False):
+            self.assertIsNone(self.bus.generation("", POSTS))
+            self.assertEqual(self.bot.get_timestamp("31/10/16"), "1477908000")
+            self.assertNotIn("posts", self.bot.cache.stats())
+
+    def tearDown(self):
+        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from member_stats; "
+                                                 "delete from posts; delete from members")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bus.stop()
+        cls.bot.db.close()
+        cur = cls.test_db.cursor()
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
+        dbutils.commit_or_rollback(cls.test_db)
+        cls.test_db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+from datetime import datetime
+import random
+import unittest
+from commands import Arg, CommandRouter, ParseError, is_date, DATE, DATE_FORMAT, FLAG, LIST, REST, WORD
+
+WORDS = ["here", "absent", "report", "post", "past", "stop", "help", "HERE", "31/10/16", "31/13/16", "2016-10-31",
+         "Bobby", "Tables", "{text}", "{0}", "%s", "`", "é", "​", "\xa0", ""]
+
+
+class TestCommandRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = CommandRouter(default="help")
+        self.router.register("help", None)
+        self.router.register("here", None, [Arg("date", DATE, missing="No date in {text}", invalid="Bad date"),
+                                            Arg("real_name", REST, missing="No name")])
+        self.router.register("ignore", None, [Arg("stop", FLAG), Arg("real_name", REST, missing="No name")],
+                             admin=True)
+        self.router.register("past", None, [Arg("start", DATE, missing="No date", invalid="Bad date"),
+                                            Arg("end", DATE, required=False, invalid="Bad date")], background=True)
+        self.router.register("say", None, [Arg("word", WORD, required=False)])
+        self.router.register("all", None, [Arg("names", LIST, missing="No names")])
+
+    def test_routes_on_the_first_word(self):
+        call = self.router.parse("  Here 31/10/16  Report   Postlethwaite ")
+        self.assertEqual(call.command.name, "here")
+        self.assertEqual(call.args, {"date": "31/10/16", "real_name": "Report   Postlethwaite"})
+        self.assertEqual(self.router.parse("").command.name, "help")
+        self.assertIsNone(self.router.parse("reporthere 31/10/16"))
+
+    def test_arguments(self):
+        self.assertEqual(self.router.parse("ignore stop Bobby Tables").args, {"stop": True, "real_name": "Bobby Tables"})
+        self.assertEqual(self.router.parse("ignore Stopford Smith").args,
+                         {"stop": False, "real_name": "Stopford Smith"})
+        self.assertEqual(self.router.parse("past 04/09/17").args, {"start": "04/09/17", "end": None})
+        self.assertEqual(self.router.parse("say hello there").args, {"word": "hello"})
+        self.assertEqual(self.router.parse("all Bobby Tables, Bob Loblaw\n\n GOB ,").args,
+                         {"names": ["Bobby Tables", "Bob Loblaw", "GOB"]})
+
+    def test_errors(self):
+        with self.assertRaisesRegex(ParseError, "^No date in here$"):
+            self.router.parse("here")
+        with self.assertRaisesRegex(ParseError, "^Bad date$"):
+            self.router.parse("here 2016-10-31 Bobby Tables")
+        with self.assertRaisesRegex(ParseError, "^Bad date$"):
+            self.router.parse("past 04/09/17 31/02/17")
+        with self.assertRaisesRegex(ParseError, "^No name$"):
+            self.router.parse("here 31/10/16 ")
+        with self.assertRaisesRegex(ParseError, "^No names$"):
+            self.router.parse("all , \n,")
+
+    def test_duplicate_commands(self):
+        with self.assertRaises(ValueError):
+            self.router.register("here", None)
+
+    def test_fuzz(self):
+        rng = random.Random(1234)
+        alphabet = "abcdehilnoprst /0123456789{}%`\t\n\xa0"
+        for _ in range(5000):
+            if rng.random() < 0.5:
+                text = "".join(rng.choice(alphabet) for _ in range(rng.randrange(30)))
+            else:
+                text = rng.choice([" ", "  ", "\t"]).join(rng.choice(WORDS) for _ in range(rng.randrange(6)))
+            try:
+                call = self.router.parse(text)
+            except ParseError as e:
+                self.assertIsInstance(str(e), str)
+                continue
+            words = text.split()
+            if call is None:
+                self.assertNotIn(words[0].lower(), self.router.commands)
+                continue
+            self.assertEqual(call.command.name, words[0].lower() if words else "help")
+            for arg in call.command.args:
+                value = call.args[arg.name]
+                if arg.kind == DATE and value is not None:
+                    self.assertRegex(value, r"^\d\d/\d\d/\d\d$")
+                if arg.kind == LIST and value is not None:
+                    self.assertTrue(all(item and item == item.strip() and item in text for item in value))
+                if arg.kind == REST and value is not None:
+                    self.assertEqual(value, value.strip())
+                    self.assertIn(value, text)
+
+    def test_dates_match_strptime(self):
+        rng = random.Random(1234)
+        for _ in range(5000):
+            token = "/".join(str(rng.randrange(40)).zfill(rng.randrange(3)) for _ in range(3))
+            try:
+                datetime.strptime(token, DATE_FORMAT)
+                expected = True
+            except ValueError:
+                expected = False
+            self.assertEqual(is_date(token), expected, token)
+        self.assertTrue(is_date("29/02/00"))
+        self.assertFalse(is_date("29/02/99"))
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import patch
+import psycopg2
+from settings import config
+from metrics import registry as metrics
+import dbutils
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = dbutils.ConnectionPool(1, 2, 1, config["db-pool-ping-after"])
+
+    def test_connects_on_first_checkout(self):
+        self.assertIsNone(self.pool._pool)
+        self.assertEqual(dbutils.execute_fetchone(self.pool, "SELECT 1"), (1,))
+        self.assertIsNotNone(self.pool._pool)
+
+    def test_checkout_counts(self):
+        with self.pool.connection():
+            self.assertEqual(self.pool.stats()["in_use"], 1)
+        stats = self.pool.stats()
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_reconnects_dropped_connection(self):
+        with self.pool.connection() as conn:
+            conn.close()
+        result = dbutils.execute_fetchone(self.pool, "SELECT 1")
+        self.assertEqual(result, (1,))
+
+    def test_discards_every_dead_connection(self):
+        # both connections stay idle in the pool between checkouts
+        self.pool.close()
+        self.pool = dbutils.ConnectionPool(2, 2, 1, config["db-pool-ping-after"])
+        with self.pool.connection() as first, self.pool.connection() as second:
+            pids = (first.get_backend_pid(), second.get_backend_pid())
+        other = dbutils.connect_to_db()
+        dbutils.execute_and_commit(other, "SELECT pg_terminate_backend(pid) FROM unnest(%s) AS pid", (list(pids),))
+        other.close()
+        self.pool.last_used.clear()
+        self.assertEqual(dbutils.execute_fetchone(self.pool, "SELECT 1"), (1,))
+        self.assertEqual(self.pool.stats()["reconnects"], 2)
+
+    def test_gives_up_on_dead_connections(self):
+        # only this pool's checks, not those of pools other threads are using
+        with patch.object(self.pool, "is_healthy", return_value=False) as mock_healthy:
+            with self.assertRaises(psycopg2.OperationalError):
+                with self.pool.connection():
+                    pass
+        self.assertEqual(mock_healthy.call_count, 3)
+        self.assertEqual(self.pool.stats()["in_use"], 0)
+
+    def test_failed_statement_does_not_abort_connection(self):
+        self.assertIsNone(dbutils.execute_fetchone(self.pool, "SELECT * FROM no_such_table"))
+        self.assertEqual(dbutils.execute_fetchone(self.pool, "SELECT 1"), (1,))
+
+    def test_timeout_when_exhausted(self):
+        with self.pool.connection(), self.pool.connection():
+            with self.assertRaises(dbutils.PoolTimeout):
+                with self.pool.connection():
+                    pass
+
+    def test_transaction_rolls_back_on_error(self):
+        with self.assertRaises(psycopg2.Error):
+            with dbutils.transaction(self.pool) as cur:
+                cur.execute("CREATE TABLE pool_test (id int)")
+                cur.execute("SELECT * FROM no_such_table")
+        result = dbutils.execute_fetchone(self.pool, "SELECT to_regclass('pool_test')")
+        self.assertEqual(result, (None,))
+
+    def test_query_label(self):
+        self.assertEqual(dbutils.query_label("SELECT real_name FROM members WHERE slack_id = %s"), "select:members")
+        self.assertEqual(dbutils.query_label(b"INSERT INTO posts VALUES (1)"), "insert:posts")
+        self.assertEqual(dbutils.query_label("UPDATE attendance SET present = TRUE"), "update:attendance")
+        self.assertEqual(dbutils.query_label("SELECT 1"), "select")
+
+    @patch("dbutils.TimedCursor.slow_query_ms", 0)
+    def test_queries_are_timed_and_slow_ones_logged(self):
+        with self.assertLogs("dbutils", "WARNING") as logs:
+            dbutils.execute_fetchone(self.pool, "SELECT pg_sleep(0) FROM pg_class LIMIT 1")
+        self.assertIn("Slow query", logs.output[0])
+        key = ("db_query_seconds", (("query", "select:pg_class"),))
+        self.assertGreaterEqual(metrics.histograms[key].count, 1)
+        self.assertIn('db_slow_queries_total{query="select:pg_class"}', metrics.render())
+
+    def tearDown(self):
+        self.pool.close()
@@ -0,0 +1,85 @@
+from settings import config
+import io
+import unittest
+from unittest.mock import patch
+from bot import AttendanceBot
+import dbutils
+import export
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class TestExport(unittest.TestCase):
+    test_db = dbutils.connect_to_db()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bot = AttendanceBot(config)
+        cls.bot.create_tables()
+        cls.settings = dict(config, **{"export-batch-size": 2})
+
+    def setUp(self):
+        cur = self.test_db.cursor()
+        cur.execute("INSERT INTO members VALUES('12345', 'Bobby Tables'), ('23456', 'Tobias Funke')")
+        cur.execute("INSERT INTO posts VALUES('1477908000', '31/10/16', 'abc123'), "
+                    "('1478512800', '07/11/16', 'abc123')")
+        cur.execute("INSERT INTO attendance VALUES('12345', '1477908000', TRUE), ('23456', '1477908000', FALSE), "
+                    "('12345', '1478512800', NULL), ('23456', '1478512800', TRUE)")
+        dbutils.commit_or_rollback(self.test_db)
+
+    def read_csv(self, **kwargs):
+        return b"".join(export.export(self.bot.db, self.settings, "csv", **kwargs)).decode().splitlines()
+
+    def test_csv(self):
+        self.assertEqual(self.read_csv(), [
+            "rehearsal_date,post_timestamp,channel_id,slack_id,real_name,present",
+            "2016-10-31,1477908000,abc123,12345,Bobby Tables,True",
+            "2016-10-31,1477908000,abc123,23456,Tobias Funke,False",
+            "2016-11-07,1478512800,abc123,12345,Bobby Tables,",
+            "2016-11-07,1478512800,abc123,23456,Tobias Funke,True",
+        ])
+
+    def test_csv_filters(self):
+        self.assertEqual(self.read_csv(start="01/11/16", members=["Tobias Funke"])[1:],
+                         ["2016-11-07,1478512800,abc123,23456,Tobias Funke,True"])
+        self.assertEqual(self.read_csv(end="31/10/16", members=["12345"])[1:],
+                         ["2016-10-31,1477908000,abc123,12345,Bobby Tables,True"])
+
+    def test_csv_is_streamed_in_chunks(self):
+        chunks = list(export.export(self.bot.db, self.settings, "csv"))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(self.bot.db.stats()["in_use"], 0)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(export.ExportError):
+            export.export(self.bot.db, self.settings, "xlsx")
+        with self.assertRaises(export.ExportError):
+            export.export(self.bot.db, self.settings, "csv", start="2016-10-31")
+
+    @patch("importlib.util.find_spec", return_value=None)
+    def test_parquet_without_pyarrow(self, mock_find_spec):
+        with self.assertRaises(export.ExportError):
+            export.export(self.bot.db, self.settings, "parquet")
+        mock_find_spec.assert_called_with("pyarrow")
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        data = b"".join(export.export(self.bot.db, self.settings, "parquet"))
+        table = pyarrow.parquet.read_table(io.BytesIO(data))
+        self.assertEqual(table.column("present").to_pylist(), [True, False, None, True])
+        self.assertEqual(table.column("post_timestamp").to_pylist()[0], "1477908000")
+        self.assertEqual(pyarrow.parquet.ParquetFile(io.BytesIO(data)).num_row_groups, 2)
+
+    def tearDown(self):
+        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from posts; delete from members")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bot.db.close()
+        cur = cls.test_db.cursor()
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
+        dbutils.commit_or_rollback(cls.test_db)
+        cls.test_db.close()
@@ -0,0 +1,34 @@
+import unittest
+from metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+        self.metrics.describe("requests_total", "counter", "Requests handled")
+        self.metrics.describe("request_seconds", "histogram", "Request time")
+
+    def test_counters(self):
+        self.metrics.inc("requests_total", command="here")
+        self.metrics.inc("requests_total", 2, command="here")
+        self.metrics.inc("requests_total", command='say "hi"')
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(lines[:2], ["# HELP requests_total Requests handled", "# TYPE requests_total counter"])
+        self.assertIn('requests_total{command="here"} 3', lines)
+        self.assertIn('requests_total{command="say \\"hi\\""} 1', lines)
+
+    def test_histogram_buckets_are_cumulative(self):
+        self.metrics.observe("request_seconds", 0.02, command="report")
+        self.metrics.observe("request_seconds", 3.0, command="report")
+        with self.metrics.timed("request_seconds", command="report"):
+            pass
+        lines = self.metrics.render().splitlines()
+        self.assertIn('request_seconds_bucket{command="report",le="0.005"} 1', lines)
+        self.assertIn('request_seconds_bucket{command="report",le="0.025"} 2', lines)
+        self.assertIn('request_seconds_bucket{command="report",le="5.0"} 3', lines)
+        self.assertIn('request_seconds_bucket{command="report",le="+Inf"} 3', lines)
+        self.assertIn('request_seconds_count{command="report"} 3', lines)
+
+    def test_collectors(self):
+        self.metrics.add_collector(lambda: [("queue_size", {}, 4)])
+        self.assertIn("queue_size 4", self.metrics.render().splitlines())
@@ -0,0 +1,46 @@
+import unittest
+from datetime import date
+from decimal import Decimal
+import dbutils
+import migrations
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.db = dbutils.connect_to_db()
+        cur = self.db.cursor()
+        cur.execute("CREATE SCHEMA migration_test")
+        cur.execute("SET search_path TO migration_test")
+        dbutils.commit_or_rollback(self.db)
+
+    def test_upgrades_legacy_schema(self):
+        self.assertEqual(migrations.migrate(self.db, target=1), [1])
+        cur = self.db.cursor()
+        cur.execute("INSERT INTO members VALUES('12345', 'Bobby Tables', FALSE)")
+        cur.execute("INSERT INTO posts VALUES('1477908000.000200', '31/10/16', 'abc123')")
+        cur.execute("INSERT INTO attendance VALUES('12345', '1477908000.000200', TRUE)")
+        dbutils.commit_or_rollback(self.db)
+
+        self.assertEqual(migrations.migrate(self.db), [2, 3, 4, 5, 6, 7])
+        result = dbutils.execute_fetchone(self.db, "SELECT post_timestamp, rehearsal_date FROM posts")
+        self.assertEqual(result, (Decimal("1477908000.000200"), date(2016, 10, 31)))
+        result = dbutils.execute_fetchone(self.db, "SELECT post_timestamp FROM attendance")
+        self.assertEqual(str(result[0]), "1477908000.000200")
+
+    # the table APScheduler would otherwise create as each web process starts its scheduler
+    def test_creates_job_store_table(self):
+        migrations.migrate(self.db)
+        query = ("SELECT column_name, data_type FROM information_schema.columns "
+                 "WHERE table_schema = 'migration_test' AND table_name = 'apscheduler_jobs' ORDER BY ordinal_position")
+        self.assertEqual(dbutils.execute_fetchall(self.db, query),
+                         [("id", "character varying"), ("next_run_time", "double precision"), ("job_state", "bytea")])
+
+    def test_migrate_twice_is_a_no_op(self):
+        migrations.migrate(self.db)
+        self.assertEqual(migrations.migrate(self.db), [])
+
+    def tearDown(self):
+        cur = self.db.cursor()
+        cur.execute("DROP SCHEMA migration_test CASCADE")
+        dbutils.commit_or_rollback(self.db)
+        self.db.close()
@@ -0,0 +1,61 @@
+import unittest
+from names import NameIndex, edit_distance, fold, trigrams
+
+MEMBERS = [("U1", "Beyoncé Knowles"), ("U2", "Chaka Khan"), ("U3", "Chaka Demus"), ("U4", "Kelly Rowland"),
+           ("U5", "Michelle Williams"), ("U6", "Robbie Williams"), ("U7", "Ann O'Neill")]
+
+
+class TestNames(unittest.TestCase):
+    def setUp(self):
+        self.index = NameIndex()
+        for slack_id, real_name in MEMBERS:
+            self.index.add(slack_id, real_name)
+
+    def test_fold(self):
+        self.assertEqual(fold("  Beyoncé   Knowles-Carter "), "beyonce knowles carter")
+        self.assertEqual(fold("ANN O'NEILL"), "ann o neill")
+        self.assertEqual(trigrams("bo"), {"  b", " bo", "bo "})
+
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance("kitten", "sitting"), 3)
+        self.assertEqual(edit_distance("khan", "kahn"), 1)
+        self.assertEqual(edit_distance("", "ann"), 3)
+        self.assertEqual(edit_distance("beyonce", "rowland", 2), 3)
+
+    def test_exact_ignoring_case_and_accents(self):
+        match = self.index.match("beyonce knowles")
+        self.assertEqual((match.slack_id, match.real_name), ("U1", "Beyoncé Knowles"))
+        self.assertEqual(self.index.match("ann oneill").slack_id, "U7")
+        self.assertEqual(self.index.match("Ann O Neill").slack_id, "U7")
+
+    def test_prefixes(self):
+        self.assertEqual(self.index.match("beyonce").slack_id, "U1")
+        self.assertEqual(self.index.match("kel row").slack_id, "U4")
+        self.assertEqual(self.index.match("Michelle W").slack_id, "U5")
+        # both words have to match different words of the name
+        self.assertIsNone(self.index.match("will williams").slack_id)
+
+    def test_ambiguous_prefix_lists_candidates(self):
+        match = self.index.match("Chaka")
+        self.assertIsNone(match.slack_id)
+        self.assertEqual(sorted(match.candidates), [("U2", "Chaka Khan"), ("U3", "Chaka Demus")])
+        self.assertEqual(len(self.index.match("williams").candidates), 2)
+
+    def test_typos(self):
+        self.assertEqual(self.index.match("Beyonce Knowels").slack_id, "U1")
+        self.assertEqual(self.index.match("Kely Rowlnd").slack_id, "U4")
+        match = self.index.match("Buster Bluth")
+        self.assertEqual((match.slack_id, match.candidates), (None, []))
+        self.assertEqual(self.index.match("").candidates, [])
+
+    def test_incremental_updates(self):
+        self.index.add("U2", "Chaka Kahn-Smith")
+        self.assertEqual(self.index.match("Chaka Khan").slack_id, "U2")
+        self.assertEqual(self.index.match("Chaka").candidates[0][1], "Chaka Demus")
+        self.index.remove("U3")
+        self.assertEqual(self.index.match("Chaka").slack_id, "U2")
+        self.index.add("U8", "Demus Chakra")
+        self.assertEqual(self.index.match("demus").slack_id, "U8")
+        self.index.remove("U8")
+        self.assertNotIn("demus", self.index.ids_by_word)
+        self.assertEqual(len(self.index), 6)
@@ -0,0 +1,123 @@
+from settings import config
+import unittest
+from bot import AttendanceBot
+from outbox import OutboxDispatcher, enqueue, pending_count
+from slackapi import SlackAPIError
+import dbutils
+
+
+class TestOutbox(unittest.TestCase):
+    test_db = dbutils.connect_to_db()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.bot = AttendanceBot(config)
+        cls.bot.create_tables()
+
+    def setUp(self):
+        self.delivered = []
+        self.errors = []
+        settings = dict(config, **{"outbox-batch-size": 10, "outbox-max-attempts": 3, "outbox-backoff": 60})
+        self.dispatcher = OutboxDispatcher(self.deliver, settings)
+        self.dispatcher.db = self.bot.db
+
+    def deliver(self, tenant, kind, payload):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.delivered.append((tenant, kind, payload))
+
+    def enqueue(self, kind, payload, dedupe_key=None, tenant=""):
+        with dbutils.transaction(self.bot.db) as cur:
+            return enqueue(cur, tenant, kind, payload, dedupe_key)
+
+    def row(self, row_id):
+        query = ("SELECT status, attempts, last_error, available_at > now() + interval '30 seconds' "
+                 "FROM outbox WHERE id = %s")
+        return dbutils.execute_fetchone(self.test_db, query, (row_id,))
+
+    def test_enqueue_dedupes(self):
+        self.assertIsNotNone(self.enqueue("post", {"text": "hi"}, "post:31/10/16"))
+        self.assertIsNone(self.enqueue("post", {"text": "hi again"}, "post:31/10/16"))
+        self.assertIsNotNone(self.enqueue("post", {"text": "hi"}, "post:31/10/16", tenant="tenors"))
+        self.assertIsNotNone(self.enqueue("message", {"text": "no key"}))
+        self.assertIsNotNone(self.enqueue("message", {"text": "no key"}))
+        self.assertEqual(pending_count(self.test_db), 4)
+
+    def test_dispatch_in_order(self):
+        first = self.enqueue("message", {"text": "one"})
+        self.enqueue("message", {"text": "two"}, tenant="tenors")
+        self.assertEqual(self.dispatcher.dispatch(), 2)
+        self.assertEqual(self.delivered, [("", "message", {"text": "one"}), ("tenors", "message", {"text": "two"})])
+        self.assertEqual(self.row(first)[:3], ("sent", 1, None))
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+
+    def test_record_commits_with_sent(self):
+        row_id = self.enqueue("post", {"text": "hi"})
+        self.dispatcher.deliver = lambda tenant, kind, payload: lambda cur: enqueue(cur, tenant, "react", {})
+        self.dispatcher.dispatch()
+        self.assertEqual(self.row(row_id)[0], "sent")
+        self.assertEqual(pending_count(self.test_db), 1)
+
+    def test_failed_record_is_retried(self):
+        def record(cur):
+            cur.execute("SELECT 1/0")
+        row_id = self.enqueue("post", {"text": "hi"})
+        self.dispatcher.deliver = lambda tenant, kind, payload: record
+        self.dispatcher.dispatch()
+        status, attempts, error, later = self.row(row_id)
+        self.assertEqual((status, attempts, later), ("pending", 1, True))
+        self.assertIn("division by zero", error)
+
+    def test_retry_with_backoff(self):
+        row_id = self.enqueue("message", {"text": "hi"})
+        self.errors = [SlackAPIError("chat.postMessage", "ratelimited")]
+        self.dispatcher.dispatch()
+        status, attempts, error, later = self.row(row_id)
+        self.assertEqual((status, attempts, later), ("pending", 1, True))
+        self.assertIn("ratelimited", error)
+        # not due again until the backoff runs out
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+        dbutils.execute_and_commit(self.test_db, "UPDATE outbox SET available_at = now()")
+        self.dispatcher.dispatch()
+        self.assertEqual(self.row(row_id)[:3], ("sent", 2, None))
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_gives_up(self):
+        row_id = self.enqueue("message", {"text": "hi"})
+        self.errors = [SlackAPIError("chat.postMessage", "channel_not_found")]
+        self.dispatcher.dispatch()
+        self.assertEqual(self.row(row_id)[:2], ("failed", 1))
+        other = self.enqueue("message", {"text": "hi"})
+        self.errors = [IOError("connection reset")] * 3
+        for _ in range(3):
+            dbutils.execute_and_commit(self.test_db, "UPDATE outbox SET available_at = now()")
+            self.dispatcher.dispatch()
+        self.assertEqual(self.row(other)[:2], ("failed", 3))
+        self.assertEqual(pending_count(self.test_db), 0)
+
+    def test_claims_skip_locked_rows(self):
+        locked = self.enqueue("message", {"text": "one"})
+        self.enqueue("message", {"text": "two"})
+        cur = self.test_db.cursor()
+        cur.execute("SELECT id FROM outbox WHERE id = %s FOR UPDATE", (locked,))
+        try:
+            self.assertEqual(self.dispatcher.dispatch(), 1)
+        finally:
+            dbutils.commit_or_rollback(self.test_db)
+        self.assertEqual(self.delivered, [("", "message", {"text": "two"})])
+        self.assertEqual(self.dispatcher.dispatch(), 1)
+
+    def tearDown(self):
+        dbutils.execute_and_commit(self.test_db, "delete from outbox")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bot.db.close()
+        cur = cls.test_db.cursor()
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
+        dbutils.commit_or_rollback(cls.test_db)
+        cls.test_db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
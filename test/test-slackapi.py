@@ -0,0 +1,110 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+import json
+import threading
+import time
+import unittest
+from settings import config
+import slackapi
+
+
+class FakeSlackServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeSlackHandler)
+        self.calls = []
+        # method -> list of (status, headers, body) served in order, the last one repeating
+        self.responses = {}
+        self.delay = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api/".format(self.server_address[1])
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length", 0))
+        params = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.server.calls.append((method, params))
+        time.sleep(self.server.delay)
+        queue = self.server.responses.get(method, [(200, {}, {"ok": True})])
+        status, headers, body = queue.pop(0) if len(queue) > 1 else queue[0]
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSlackAPI(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSlackServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        settings = dict(config, **{"slack-backoff": 0.01})
+        self.api = slackapi.SlackAPI(slackapi.HTTPClient("xoxb-test", self.server.url), settings)
+
+    def test_call_returns_payload(self):
+        self.server.responses["users.info"] = [(200, {}, {"ok": True, "user": {"is_admin": True}})]
+        res = self.api.call("users.info", user="U123")
+        self.assertTrue(res["user"]["is_admin"])
+        self.assertEqual(self.server.calls, [("users.info", {"user": "U123"})])
+
+    def test_retries_after_rate_limit(self):
+        self.server.responses["reactions.get"] = [(429, {"Retry-After": "0"}, {"ok": False, "error": "ratelimited"}),
+                                                  (200, {}, {"ok": True, "message": {"reactions": []}})]
+        res = self.api.call("reactions.get", channel="C1", timestamp="1477908000.000100")
+        self.assertEqual(res["message"], {"reactions": []})
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.responses["users.list"] = [(500, {}, {"ok": False, "error": "internal_error"})]
+        with self.assertRaises(slackapi.SlackAPIError):
+            self.api.call("users.list")
+        self.assertEqual(len(self.server.calls), config["slack-max-retries"] + 1)
+
+    def test_does_not_retry_client_errors(self):
+        self.server.responses["chat.postMessage"] = [(200, {}, {"ok": False, "error": "channel_not_found"})]
+        with self.assertRaises(slackapi.SlackAPIError) as raised:
+            self.api.call("chat.postMessage", channel="C1", text="hi")
+        self.assertEqual(raised.exception.error, "channel_not_found")
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_call_many_runs_concurrently(self):
+        self.server.delay = 0.2
+        start = time.monotonic()
+        self.api.call_many([("reactions.add", {"name": "thumbsup"}), ("reactions.add", {"name": "thumbsdown"})])
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual(sorted(params["name"] for _, params in self.server.calls), ["thumbsdown", "thumbsup"])
+
+    def test_records_latency(self):
+        self.api.call("users.info", user="U123")
+        self.api.call("users.info", user="U123")
+        self.assertEqual(self.api.stats()["users.info"]["count"], 2)
+
+    def test_token_bucket_waits_for_tokens(self):
+        clock = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            clock[0] += seconds
+
+        bucket = slackapi.TokenBucket(60, 1, clock=lambda: clock[0], sleep=sleep)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(slept, [1.0])
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,95 @@
+from settings import config
+import unittest
+from unittest.mock import patch
+from bot import AttendanceBot
+from tenants import TenantRegistry
+import dbutils
+
+TENANTS = {
+    "altos": {"team-id": "T1", "channel": "C_ALTOS", "token-env": "ALTOS_BOT_TOKEN"},
+    "tenors": {"team-id": "T2", "channel": "C_TENORS", "token-env": "TENORS_BOT_TOKEN", "absence-threshold": 1},
+}
+
+
+class TestTenants(unittest.TestCase):
+    test_db = dbutils.connect_to_db()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = dict(config, tenants=TENANTS, **{"tenant-cache-size": 1})
+        cls.default = AttendanceBot(cls.settings)
+        cls.default.create_tables()
+
+    def setUp(self):
+        self.registry = TenantRegistry(self.settings, self.default, "T1")
+        cur = self.test_db.cursor()
+        cur.execute("INSERT INTO members VALUES('12345', 'Bobby Tables', FALSE, FALSE, ''), "
+                    "('12345', 'Bobby Tables', FALSE, FALSE, 'tenors')")
+        cur.execute("INSERT INTO posts VALUES('1477908000', '31/10/16', 'C_DEFAULT', ''), "
+                    "('1477908100', '31/10/16', 'C_TENORS', 'tenors'), "
+                    "('1478512900', '07/11/16', 'C_TENORS', 'tenors')")
+        dbutils.commit_or_rollback(self.test_db)
+
+    def test_resolve(self):
+        self.assertEqual(self.registry.resolve("T1", "C_ALTOS"), "altos")
+        self.assertEqual(self.registry.resolve("T2", "C_ANYWHERE"), "tenors")
+        self.assertEqual(self.registry.resolve("T1", "C_ANYWHERE"), "")
+        self.assertEqual(self.registry.resolve(channel_id="C_TENORS"), "tenors")
+
+    def test_tenant_settings(self):
+        tenors = self.registry.get("tenors")
+        self.assertEqual(tenors.channel, "C_TENORS")
+        self.assertEqual(tenors.settings["absence-threshold"], 1)
+        self.assertIs(tenors.db, self.default.db)
+        self.assertIs(self.registry.get(""), self.default)
+
+    def test_bots_are_cached_up_to_the_limit(self):
+        altos = self.registry.get("altos")
+        self.assertIs(self.registry.get("altos"), altos)
+        self.registry.get("tenors")
+        self.assertEqual(list(self.registry.bots), ["tenors"])
+        self.assertIsNot(self.registry.get("altos"), altos)
+
+    def test_latest_post_is_per_tenant(self):
+        self.assertEqual(self.default.get_latest_post_data(), {"ts": "1477908000", "channel_id": "C_DEFAULT"})
+        self.assertEqual(self.registry.get("tenors").get_latest_post_data(),
+                         {"ts": "1478512900", "channel_id": "C_TENORS"})
+        self.assertIsNone(self.registry.get("altos").get_latest_post_data())
+
+    @patch("bot.AttendanceBot.get_reactions")
+    def test_process_with_date_uses_the_posts_channel(self, mock_get_reactions):
+        mock_get_reactions.return_value = [{"name": "thumbsup", "users": ["12345"]}]
+        self.registry.get("tenors").process_with_date("31/10/16")
+        mock_get_reactions.assert_called_with("1477908100", "C_TENORS")
+        query = "SELECT tenant, present FROM attendance ORDER BY tenant"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query), [("tenors", True)])
+
+    def test_absence_report_is_per_tenant(self):
+        tenors = self.registry.get("tenors")
+        tenors.update_attendance_table("1478512900")
+        tenors.refresh_member_stats()
+        self.default.refresh_member_stats()
+        self.assertEqual(tenors.get_absent_names(), ["\n", "Bobby Tables"])
+        self.assertEqual(self.default.get_absent_names(), [])
+
+    def test_reaction_events_are_routed_by_channel(self):
+        self.registry.get("tenors").update_attendance_table("1477908100")
+        self.registry.apply_reaction_events([
+            {"type": "reaction_added", "user": "12345", "reaction": "thumbsdown",
+             "item": {"type": "message", "channel": "C_TENORS", "ts": "1477908100"}},
+            {"type": "reaction_added", "user": "12345", "reaction": "thumbsup",
+             "item": {"type": "message", "channel": "C_DEFAULT", "ts": "1477908000"}},
+        ])
+        query = "SELECT tenant, present FROM attendance ORDER BY tenant"
+        self.assertEqual(dbutils.execute_fetchall(self.test_db, query), [("", True), ("tenors", False)])
+
+    def tearDown(self):
+        dbutils.execute_and_commit(self.test_db, "delete from attendance; delete from posts; delete from members")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.default.db.close()
+        cur = cls.test_db.cursor()
+        cur.execute("DROP TABLE Members, Posts, Attendance, Member_Stats, Data_Versions, Outbox, Schema_Migrations")
+        dbutils.commit_or_rollback(cls.test_db)
+        cls.test_db.close()